@@ -20,6 +20,16 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = "emailnotify2832002022@gmx.com" # client to change this
 EMAIL_HOST_PASSWORD = "nyksic-zisMim-zanme8" # client to change this
 
+# Notification outbox (drained by manage.py run_notification_worker)
+# The worker sends through EMAIL_BACKEND unless this is set. For testing offline, use
+# 'django.core.mail.backends.filebased.EmailBackend' (writes to EMAIL_FILE_PATH) or
+# 'django.core.mail.backends.locmem.EmailBackend'
+NOTIFICATION_EMAIL_BACKEND = None
+NOTIFICATION_MAX_ATTEMPTS = 8
+NOTIFICATION_RETRY_BASE_DELAY = 30 # seconds, doubled after every failed attempt
+NOTIFICATION_RETRY_MAX_DELAY = 60 * 60
+NOTIFICATION_LEASE = 5 * 60 # seconds a claimed notification is hidden from other workers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -53,11 +63,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that it times the other middleware too (see visitorsite/instrumentation.py)
+    'visitorsite.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # request.visitor (see visitorsite/middleware.py)
+    'visitorsite.middleware.VisitorMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -66,7 +80,8 @@ ROOT_URLCONF = 'VisitorManagementApp.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the Django backend, timing template rendering (see visitorsite/instrumentation.py)
+        'BACKEND': 'visitorsite.instrumentation.InstrumentedTemplates',
         'DIRS': [
             os.path.join(BASE_DIR, "templates")
         ],
@@ -101,6 +116,57 @@ DATABASES = {
 
 
 
+# Cache
+# Without CACHES, Django keeps an in-memory cache in each process. Deployments running several
+# worker processes should configure a shared cache (e.g. Redis or Memcached) so that changes
+# made through one worker invalidate the cached data of all of them.
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+# Cache holding the list of visitors currently on each site (see visitorsite/occupancy.py)
+OCCUPANCY_CACHE = "default"
+OCCUPANCY_MAX_AGE = 60 * 60 # seconds
+
+# Cache holding the e-mail addresses of each site's managers (see visitorsite/recipients.py)
+RECIPIENTS_CACHE = "default"
+RECIPIENTS_MAX_AGE = 5 * 60 # seconds
+
+# Cache holding the rendered public pages (see visitorsite/pagecache.py). The site contacts page is
+# refreshed when a contact changes; other processes not sharing the cache follow within PAGE_CACHE_MAX_AGE
+PAGE_CACHE = "default"
+PAGE_CACHE_MAX_AGE = 5 * 60 # seconds
+
+# Cache holding every role, for the role fields of the forms and registration (see visitorsite/rolecache.py)
+ROLES_CACHE = "default"
+ROLES_MAX_AGE = 60 * 60 # seconds
+
+
+# Login and registration attempts allowed per client address and per username (see
+# visitorsite/throttling.py): (attempts, seconds to refill all of them). Attempts over the limit are
+# refused before any password is hashed. With THROTTLE_CACHE = None each worker process counts on
+# its own; set it to a shared cache to count across processes. The address is REMOTE_ADDR, so behind
+# a reverse proxy, the proxy must set it to the client's address.
+THROTTLE_RATES = {
+    "login" : {"ip" : (20, 60), "username" : (5, 60)},
+    "register" : {"ip" : (10, 60)},
+}
+THROTTLE_CACHE = None
+
+
+# Visits that departed more than this many days ago are moved to the archive table by
+# manage.py archive_visits (see visitorsite/archive.py)
+VISIT_ARCHIVE_AFTER_DAYS = 2 * 365
+
+
+# The visit and visitor admin lists count their rows exactly up to this many rows; above it, they show
+# PostgreSQL's estimate instead, which does not get slower as the tables grow (see visitorsite/adminpagination.py)
+ADMIN_EXACT_COUNT_LIMIT = 10000
+
+
+# Country calling code of phone numbers entered without one (e.g. 0412 345 678). Visitors without an
+# account are recognised by their e-mail address and phone number in E.164 form (see visitorsite/identity.py)
+PHONE_COUNTRY_CODE = "61"
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -119,6 +185,27 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Same hashers as Django's default, the first one timed per request (see visitorsite/instrumentation.py).
+# It replaces Django's PBKDF2PasswordHasher: both are called pbkdf2_sha256, and Django checks stored
+# hashes with the last hasher listed under a name, so listing both would leave logins untimed
+PASSWORD_HASHERS = [
+    'visitorsite.instrumentation.InstrumentedPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+
+# Monitoring
+# Every request is timed (SQL, template rendering and password hashing) and the timings are
+# published at /metrics in the Prometheus format (see visitorsite/instrumentation.py)
+
+# addresses that can read /metrics without logging in as a site manager
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# SQL queries taking longer than this are logged (logger visitorsite.instrumentation) and counted
+METRICS_SLOW_QUERY_MS = 200
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
@@ -139,6 +226,15 @@ STATIC_URL = 'static/'
 
 STATICFILES_DIRS = [os.path.join(BASE_DIR, STATIC_URL)]
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static'),]
+
+# manage.py collectstatic copies the static files here with a hash of their contents in the file
+# names, and writes compressed copies (see visitorsite/staticstorage.py). When DEBUG is off, they
+# are served by visitorsite/staticviews.py unless a web server is set up to serve this directory
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+STATICFILES_STORAGE = 'visitorsite.staticstorage.CompressedManifestStaticFilesStorage'
+STATIC_MAX_AGE = 365 * 24 * 60 * 60 # seconds browsers keep files with a hash in their name
+STATIC_UNHASHED_MAX_AGE = 10 * 60 # seconds browsers keep other files before checking them again
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -13,12 +13,19 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
+
+from visitorsite import staticviews
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('', include("visitorsite.urls"))
+    path('', include("visitorsite.urls")),
+    # collected static files (runserver serves the uncollected files itself when DEBUG is on)
+    re_path(r'^{}(?P<path>.+)$'.format(re.escape(settings.STATIC_URL.lstrip('/'))), staticviews.serve)
 ]
 
 admin.site.site_header = "Site Manager Panel"
@@ -4,6 +4,14 @@ from .models import *
 import datetime
 from django.utils import timezone
 from django.utils.html import format_html
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
+from django.urls import path
+from .exportservice import visits_csv_response
+from .globals import SITES
+from .adminpagination import KeysetPaginationMixin
+from . import rollups
+from .search import FIELDS as SEARCH_FIELDS, VisitorSearchMixin
 
 admin.site.register(Role)
 admin.site.register(EmergencyContact)
@@ -32,54 +40,181 @@ class VisitFilter(admin.SimpleListFilter):
                 departure__gte=now,
             )
 
-class VisitorAdmin(admin.ModelAdmin):
+@admin.action(description = "Export selected visits as CSV", permissions = ["view"])
+def export_visits_csv(modeladmin, request, queryset):
+    # streamed, so selecting every visit across all pages is fine
+    return visits_csv_response(queryset, "{}s.csv".format(modeladmin.model._meta.model_name))
+
+class VisitorAdmin(VisitorSearchMixin, KeysetPaginationMixin, admin.ModelAdmin):
     list_display = ('visitor', 'firstname', 'lastname', 'e_mail', 'phonenumber', 'role', 'emname', 'emphone',
                     'emrelation')
+    # searched with the trigram index (see search.py)
+    search_fields = SEARCH_FIELDS
+    # joined into the changelist query so the columns do not need one query per row
+    list_select_related = ('user', 'role', 'emergencycontact')
 
-class VisitAdmin(admin.ModelAdmin):
+class VisitAdmin(VisitorSearchMixin, KeysetPaginationMixin, admin.ModelAdmin):
     list_display = ('visitor', 'arrival', 'departure', 'induction',
                     'houserules', 'overnight', 'number')
+    keyset = ('arrival', 'pk') # newest arrivals first
+    search_fields = tuple('visitor__' + i for i in SEARCH_FIELDS)
+    search_visitor = 'visitor'
     list_filter = ('arrival', 'departure', VisitFilter)
+    list_select_related = ('visitor__user',)
 
+    @admin.display(description = "Phone Number", ordering = "visitor__phone_number")
     def number(self, obj):
         return format_html('<a href="tel:{}"> {} </a>',
-                           obj.visitor.phonenumber(),
-                           obj.visitor.phonenumber())
-
-    number.short_description = "Phone Number"
-
-
-class RidgefieldVisitAdmin(admin.ModelAdmin):
+                           obj.visitor.phone_number,
+                           obj.visitor.phone_number)
+
+
+class SiteVisitAdmin(VisitorSearchMixin, KeysetPaginationMixin, admin.ModelAdmin):
+    """
+    Changelist shared by the Visit-derived models of every site. The visitor, their user, role
+    and emergency contact are joined into the changelist query, and the columns below read
+    from the joined rows, so a page costs the same number of queries whatever its size. Pages
+    seek by arrival instead of counting rows (see adminpagination.py), so later pages are as
+    fast as the first one. Searches use the visitor search index (see search.py).
+    """
     list_display = ('name', 'visitor', 'number', 'emname', 'emnumber', 'emrelation', 'arrival', 'departure', 'induction',
                     'houserules', 'overnight')
     list_filter = ('arrival', 'departure', VisitFilter)
+    list_select_related = ('visitor__user', 'visitor__role', 'visitor__emergencycontact')
+    actions = [export_visits_csv]
+    keyset = ('arrival', 'pk') # newest arrivals first
+    search_fields = tuple('visitor__' + i for i in SEARCH_FIELDS)
+    search_visitor = 'visitor'
 
-    def emnumber(self, obj):
-        return format_html('<a href="tel:{emn}"> {emn} </a>',
-                           emn = obj.visitor.emphone())
+    @admin.display(description = "Name", ordering = "visitor__last_name")
+    def name(self, obj):
+        return "{} {}".format(obj.visitor.first_name, obj.visitor.last_name)
+
+    @admin.display(description = "Phone Number", ordering = "visitor__phone_number")
     def number(self, obj):
         return format_html('<a href="tel:{}"> {} </a>',
-                           obj.visitor.phonenumber(),
-                           obj.visitor.phonenumber())
+                           obj.visitor.phone_number,
+                           obj.visitor.phone_number)
 
-    emnumber.short_description = "Emergency Contact Phone Number"
-    number.short_description = "Phone Number"
-
-class GinginVisitAdmin(admin.ModelAdmin):
-    list_display = ('name', 'visitor', 'number', 'emname', 'emnumber', 'emrelation', 'arrival', 'departure', 'induction',
-                    'houserules', 'overnight')
-    list_filter = ('arrival', 'departure', VisitFilter)
+    @admin.display(description = "Emergency Contact Name", ordering = "visitor__emergencycontact__name")
+    def emname(self, obj):
+        return obj.visitor.emergencycontact.name if (obj.visitor.emergencycontact != None) else None
 
+    @admin.display(description = "Emergency Contact Phone Number")
     def emnumber(self, obj):
+        if (obj.visitor.emergencycontact == None): return None
         return format_html('<a href="tel:{emn}"> {emn} </a>',
-                           emn = obj.visitor.emphone())
-    def number(self, obj):
-        return format_html('<a href="tel:{}"> {} </a>',
-                           obj.visitor.phonenumber(),
-                           obj.visitor.phonenumber())
-
-    emnumber.short_description = "Emergency Contact Phone Number"
-    number.short_description = "Phone Number"
+                           emn = obj.visitor.emergencycontact.phone)
+
+    @admin.display(description = "Emergency Contact Relationship to Visitor")
+    def emrelation(self, obj):
+        return obj.visitor.emergencycontact.relationship if (obj.visitor.emergencycontact != None) else None
+
+class RidgefieldVisitAdmin(SiteVisitAdmin): pass
+
+class GinginVisitAdmin(SiteVisitAdmin): pass
+
+class ArchivedVisitAdmin(KeysetPaginationMixin, admin.ModelAdmin):
+    """
+    Read-only list of archived visits for audits. Site managers see the archived visits of the
+    sites whose visits they can view, and can export them like the current visits.
+    """
+    list_display = ('id', 'site', 'visitor', 'arrival', 'departure', 'induction', 'houserules', 'overnight', 'paddock')
+    list_filter = ('site', 'month')
+    list_select_related = ('visitor__user',)
+    date_hierarchy = 'month'
+    actions = [export_visits_csv]
+    keyset = ('arrival', 'pk')
+
+    def sites(self, request):
+        return [site for site in SITES if (request.user.has_perm("visitorsite.view_{}visit".format(site)))]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(site__in = self.sites(request))
+
+    def has_view_permission(self, request, obj = None):
+        return len(self.sites(request)) != 0 and (obj == None or obj.site in self.sites(request))
+
+    def has_module_permission(self, request):
+        return self.has_view_permission(request) or super().has_module_permission(request)
+
+    def has_add_permission(self, request): return False
+
+    def has_change_permission(self, request, obj = None): return False
+
+    def has_delete_permission(self, request, obj = None): return False
+
+class DailyOccupancyAdmin(admin.ModelAdmin):
+    """
+    Occupancy dashboard: visitors and overnight stays of a site per day, week or month, charted
+    from the daily occupancy rows (see rollups.py), so any date range is quick to show. Site
+    managers see the sites whose visits they can view.
+    """
+    DEFAULT_DAYS = 30
+
+    def sites(self, request):
+        return [site for site in SITES if (request.user.has_perm("visitorsite.view_{}visit".format(site)))]
+
+    def has_view_permission(self, request, obj = None):
+        return len(self.sites(request)) != 0
+
+    def has_module_permission(self, request):
+        return self.has_view_permission(request)
+
+    def has_add_permission(self, request): return False
+
+    def has_change_permission(self, request, obj = None): return False
+
+    def has_delete_permission(self, request, obj = None): return False
+
+    def get_urls(self):
+        # only the dashboard, the rows are not edited one by one
+        info = (self.model._meta.app_label, self.model._meta.model_name)
+        return [path("", self.admin_site.admin_view(self.changelist_view), name = "%s_%s_changelist" % info)]
+
+    def _date(self, value, default):
+        try:
+            return datetime.date.fromisoformat(value) if (value) else default
+        except ValueError:
+            return default
+
+    def changelist_view(self, request, extra_context = None):
+        sites = self.sites(request)
+        if (len(sites) == 0): raise PermissionDenied
+        site = request.GET.get("site", "")
+        selected = [site] if (site in sites) else sites
+        end = self._date(request.GET.get("end"), timezone.localdate())
+        start = self._date(request.GET.get("start"), end - datetime.timedelta(days = self.DEFAULT_DAYS - 1))
+        period = request.GET.get("period", "day")
+        if (period not in rollups.PERIODS): period = "day"
+        rows = rollups.series(selected, start, end, period)
+        roles = sorted(set(name for row in rows for name in row["roles"]))
+        top = max([row["visitors"] for row in rows] + [1])
+        for row in rows:
+            row["width"] = round(100 * row["visitors"] / top)
+            row["nightwidth"] = round(100 * row["overnight"] / top)
+            row["byrole"] = [row["roles"].get(name, 0) for name in roles]
+        context = {
+            **self.admin_site.each_context(request),
+            "title" : "Occupancy",
+            "opts" : self.model._meta,
+            "sites" : [(i, SITES[i]) for i in sites],
+            "site" : site if (site in sites) else "",
+            "start" : start,
+            "end" : end,
+            "period" : period,
+            "periods" : list(rollups.PERIODS),
+            "roles" : roles,
+            "rows" : rows,
+            "totalvisitors" : sum(row["visitors"] for row in rows),
+            "totalovernight" : sum(row["overnight"] for row in rows),
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, "admin/occupancy_dashboard.html", context)
+
+class QueuedNotificationAdmin(admin.ModelAdmin):
+    list_display = ('site', 'visit_id', 'status', 'attempts', 'next_attempt', 'created', 'sent', 'last_error')
+    list_filter = ('status', 'site')
     
 
 admin.site.register(SiteEmergencyContact, SiteEmergencyContactAdmin)
@@ -87,3 +222,6 @@ admin.site.register(Visitor, VisitorAdmin)
 admin.site.register(Visit, VisitAdmin)
 admin.site.register(GinginVisit, GinginVisitAdmin)
 admin.site.register(RidgefieldVisit, RidgefieldVisitAdmin)
+admin.site.register(QueuedNotification, QueuedNotificationAdmin)
+admin.site.register(ArchivedVisit, ArchivedVisitAdmin)
+admin.site.register(DailyOccupancy, DailyOccupancyAdmin)
@@ -0,0 +1,146 @@
+"""Seperate module paging through large admin lists (visits and visitors) without COUNT(*) and OFFSET"""
+import json
+
+from django.conf import settings
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+AFTER_VAR = "after" # next (older) page: the rows after this key
+BEFORE_VAR = "before" # previous (newer) page: the rows before this key
+
+def estimated_count(queryset):
+    """
+    The number of rows PostgreSQL's planner expects the queryset to return (from the table
+    statistics, without reading the rows), or None on other databases.
+    """
+    connection = connections[queryset.db]
+    if (connection.vendor != "postgresql"): return None
+    (sql, params) = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if (isinstance(plan, str)): plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator counting exactly up to settings.ADMIN_EXACT_COUNT_LIMIT rows; above it, the count
+    is PostgreSQL's estimate (estimated is then True), which costs the same for any table size.
+    """
+    estimated = False
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if (estimate != None and estimate > settings.ADMIN_EXACT_COUNT_LIMIT):
+            self.estimated = True
+            return estimate
+        return super().count
+
+def _seek(fields:list, values:list, older:bool):
+    """Q object for the rows after (older) or before (newer) a key, in descending key order."""
+    lookup = "lt" if (older) else "gt"
+    condition = Q()
+    for i in range(len(fields)):
+        # equal on the first i fields and past the key on the next one
+        equal = {field : value for (field, value) in zip(fields[:i], values[:i])}
+        condition |= Q(**equal, **{"{}__{}".format(fields[i], lookup) : values[i]})
+    return condition
+
+class KeysetChangeList(ChangeList):
+    """
+    Changelist showing the rows in descending order of the admin's keyset fields, with "Newer" and
+    "Older" links that seek to the key of the first or last row shown instead of counting rows
+    with OFFSET. Used unless the list is sorted by a column, which falls back to page numbers.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the links to filter or sort the list start from the newest rows again
+        for i in (AFTER_VAR, BEFORE_VAR):
+            self.params.pop(i, None)
+
+    def get_filters_params(self, params = None):
+        params = super().get_filters_params(params)
+        for i in (AFTER_VAR, BEFORE_VAR):
+            params.pop(i, None) # not a filter
+        return params
+
+    def keyfields(self):
+        return list(self.model_admin.keyset)
+
+    def key(self, obj):
+        values = [getattr(obj, field) for field in self.keyfields()]
+        return ",".join(i.isoformat() if (hasattr(i, "isoformat")) else str(i) for i in values)
+
+    def parsekey(self, value:str):
+        parts = value.split(",")
+        if (len(parts) != len(self.keyfields())): raise ValueError(value)
+        fields = [self.opts.pk if (i == "pk") else self.opts.get_field(i) for i in self.keyfields()]
+        return [field.to_python(part) for (field, part) in zip(fields, parts)]
+
+    def get_results(self, request):
+        self.keyset = None
+        if (ORDER_VAR in self.params or self.show_all):
+            return super().get_results(request)
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        fields = self.keyfields()
+        perpage = self.list_per_page
+        queryset = self.queryset
+        newer = False
+        try:
+            if (AFTER_VAR in request.GET):
+                queryset = queryset.filter(_seek(fields, self.parsekey(request.GET[AFTER_VAR]), older = True))
+                newer = True
+            elif (BEFORE_VAR in request.GET):
+                # the page ends just before the key and holds the `perpage` newer rows (or fewer at the start)
+                values = self.parsekey(request.GET[BEFORE_VAR])
+                top = list(
+                    self.queryset.filter(_seek(fields, values, older = False))
+                    .order_by(*fields).values_list(*fields)[perpage - 1:perpage + 1]
+                )
+                if (len(top) != 0):
+                    queryset = queryset.exclude(_seek(fields, list(top[0]), older = False))
+                    newer = len(top) > 1
+        except (ValueError, ValidationError):
+            queryset = self.queryset # a broken key starts from the newest rows
+            newer = False
+
+        results = list(queryset[:perpage + 1])
+        older = len(results) > perpage
+        results = results[:perpage]
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = results
+        self.can_show_all = False
+        self.multi_page = newer or older
+        self.paginator = paginator
+        remove = [AFTER_VAR, BEFORE_VAR, PAGE_VAR]
+        self.keyset = {
+            "newest" : self.get_query_string(remove = remove) if (newer) else None,
+            "newer" : self.get_query_string({BEFORE_VAR : self.key(results[0])}, remove) if (newer and results) else None,
+            "older" : self.get_query_string({AFTER_VAR : self.key(results[-1])}, remove) if (older) else None,
+        }
+
+class KeysetPaginationMixin:
+    """
+    ModelAdmin mixin for large lists: keyset pages (see KeysetChangeList) in descending order of
+    `keyset`, estimated counts on PostgreSQL, and no second count of the unfiltered table.
+    """
+    keyset = ("pk",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = "admin/keyset_change_list.html"
+
+    def get_ordering(self, request):
+        return ["-" + field for field in self.keyset]
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 from visitorsite.globals import SITES
 
 
@@ -43,6 +44,19 @@ class VisitorsiteConfig(AppConfig):
                 view_site_permission_codename = "view_{sitename}visit".format(sitename = site)
                 self.addpermissions(new_site_group, [view_site_permission_codename])
 
-    def ready(self):
+    def postmigrate(self, using = "default", **kwargs):
+        # the permissions of this app are normally created after this handler runs
+        # (django.contrib.auth is ready later), but the site manager groups need them
+        from django.contrib.auth.management import create_permissions
+        create_permissions(self, verbosity = 0, using = using)
         print("Performing site manager checks...")
         self.sitemanagerchecks()
+
+    def ready(self):
+        # run after migrations rather than on start-up, so that the tables exist
+        # (manage.py migrate on an empty database)
+        post_migrate.connect(self.postmigrate, sender = self)
+        # connect the signals that invalidate the cached site occupancy, recipient lists and pages,
+        # keep the daily occupancy, search index and identity keys up to date, drop the cached roles when
+        # one changes, and time the queries of new database connections
+        from visitorsite import occupancy, recipients, pagecache, instrumentation, rollups, search, identity, rolecache
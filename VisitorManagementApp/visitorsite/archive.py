@@ -0,0 +1,111 @@
+"""Seperate module moving old visits out of the visit tables into the archive (and reading them back for audits)"""
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from visitorsite import models, rollups
+from visitorsite.exportservice import visits_csv_rows
+from visitorsite.globals import SITES
+
+BATCHSIZE = 2000
+
+def cutoff(days:int):
+    """Visits that departed before this time are archived."""
+    return timezone.now() - timedelta(days = days)
+
+def _month(visit):
+    return timezone.localtime(visit.arrival).date().replace(day = 1)
+
+def _archived(site:str, visit):
+    return models.ArchivedVisit(
+        id = visit.pk, site = site, month = _month(visit), visitor_id = visit.visitor_id,
+        arrival = visit.arrival, departure = visit.departure, induction = visit.induction,
+        houserules = visit.houserules, overnight = visit.overnight, paddock = getattr(visit, "paddock", "")
+    )
+
+def _exportfile(directory:str, site:str, month):
+    return os.path.join(directory, "{}-{:%Y-%m}.csv.gz".format(site, month))
+
+def _export(directory:str, site:str, visits:list):
+    """
+    Writes the visits to a compressed temporary file per month (same columns as the visit export,
+    without the header) and returns [(temporary file, monthly file)] for _append. The monthly
+    files are only appended to once the visits are gone from the database, so a batch that
+    rolls back is not exported twice.
+    """
+    bymonth = {}
+    for visit in visits:
+        bymonth.setdefault(_month(visit), []).append(visit.pk)
+    exports = []
+    try:
+        for (month, ids) in bymonth.items():
+            (fd, temp) = tempfile.mkstemp(suffix = ".csv.gz.tmp", dir = directory)
+            os.close(fd)
+            exports.append((temp, _exportfile(directory, site, month)))
+            rows = visits_csv_rows(models.visitmodel(site).objects.filter(pk__in = ids))
+            header = next(rows)
+            with gzip.open(temp, "wt", newline = "") as f:
+                f.writelines(rows)
+    except BaseException:
+        _discard(exports)
+        raise
+    return (header, exports)
+
+def _append(header:str, exports:list):
+    # each file is a gzip member, and gzip readers read members appended to each other as one file
+    for (temp, path) in exports:
+        if (not os.path.exists(path)):
+            with gzip.open(path, "wt", newline = "") as f:
+                f.write(header)
+        with open(temp, "rb") as source, open(path, "ab") as target:
+            shutil.copyfileobj(source, target)
+    _discard(exports)
+
+def _discard(exports:list):
+    for (temp, path) in exports:
+        if (os.path.exists(temp)): os.remove(temp)
+
+def archive_visits(site:str, before, batch_size:int = BATCHSIZE, export_dir:str = None, keep:bool = True):
+    """
+    Moves the visits of a site that departed before the given time out of the site's visit table,
+    batch_size visits per transaction, and returns the number moved. They are copied to the
+    archive table (unless keep is False) and, with export_dir, appended to compressed monthly
+    CSV files (<site>-<YYYY-MM>.csv.gz) that can be kept in cold storage. Visits only kept in
+    the files (keep False, which needs export_dir) leave the daily occupancy, as rebuilding the
+    counts from the database would.
+    """
+    if (not keep and export_dir == None):
+        raise ValueError("Visits not kept in the archive table must be exported")
+    visitm = models.visitmodel(site)
+    moved = 0
+    while True:
+        exports = []
+        try:
+            with transaction.atomic():
+                visits = list(visitm.objects.filter(departure__lt = before).select_related("visitor").order_by("pk")[:batch_size])
+                if (len(visits) == 0): break
+                if (export_dir != None):
+                    (header, exports) = _export(export_dir, site, visits)
+                    transaction.on_commit(lambda header = header, exports = exports: _append(header, exports))
+                if (keep): models.ArchivedVisit.objects.bulk_create([_archived(site, i) for i in visits])
+                # deleting the site's visits deletes their rows in the visit table too. Archived
+                # visits are still part of the site's history, so the daily occupancy keeps them
+                with rollups.paused():
+                    visitm.objects.filter(pk__in = [i.pk for i in visits]).delete()
+                if (not keep): rollups.remove_visits(site, visits)
+        except BaseException:
+            _discard(exports)
+            raise
+        moved += len(visits)
+    return moved
+
+def archived_visits(site:str):
+    """The archived visits of a site, for audits. They can be exported with visits_csv_response."""
+    if (site not in SITES):
+        raise ValueError("{} is not a site".format(site))
+    return models.ArchivedVisit.objects.filter(site = site)
@@ -0,0 +1,72 @@
+"""Seperate module for checking new visits against existing ones (double bookings and overnight capacity)"""
+import zlib
+
+from django.db import connection
+
+from visitorsite import models
+from visitorsite.globals import SITES, OVERNIGHT_CAPACITY
+
+class BookingConflict(ValueError):
+    """Raised when new visits overlap a visitor's other visits or exceed a site's overnight capacity."""
+
+def _overlaps(a, b):
+    # a visit may start at the exact time another one ends
+    return a[0] < b[1] and b[0] < a[1]
+
+def _peak(intervals:list):
+    """Largest number of intervals that overlap at any one time (sweep over the start and end times)."""
+    events = sorted([(start, 1) for (start, end) in intervals] + [(end, -1) for (start, end) in intervals])
+    peak = current = 0
+    for (time, change) in events: # ends sort before starts at the same time
+        current += change
+        peak = max(peak, current)
+    return peak
+
+def _lock(site:str):
+    # two registrations checked at the same time could both fit in the last beds. On PostgreSQL,
+    # an advisory lock held until the end of the transaction makes them take turns. SQLite only
+    # allows one writing transaction at a time anyway.
+    if (connection.vendor == "postgresql"):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [zlib.crc32(site.encode())])
+
+def check_new_visits(site:str, visits:list):
+    """
+    Raises BookingConflict if any of the new (unsaved) visits overlaps another visit of the same
+    visitor at any site, or if the overnight visits would exceed the site's capacity. Only visits
+    that overlap the new ones are read, through the visit indexes (two queries in total), so the
+    cost does not depend on the size of the visit history. Must run in the saving transaction.
+    """
+    if (len(visits) == 0): return
+    _lock(site)
+    start = min(visit.arrival for visit in visits)
+    end = max(visit.departure for visit in visits)
+
+    # double bookings: the visit table holds the visits of every site
+    byvisitor = {}
+    for visit in visits:
+        byvisitor.setdefault(visit.visitor_id, []).append((visit.arrival, visit.departure))
+    existing = models.Visit.objects.filter(
+        visitor_id__in = byvisitor.keys(), arrival__lt = end, departure__gt = start
+    ).values_list("visitor_id", "arrival", "departure")
+    for (visitor, arrival, departure) in existing:
+        byvisitor[visitor].append((arrival, departure))
+    for (visitor, intervals) in byvisitor.items():
+        if (_peak(intervals) > 1):
+            name = next(visit.visitor for visit in visits if (visit.visitor_id == visitor))
+            raise BookingConflict("{} {} already has a visit at that time.".format(name.first_name, name.last_name))
+
+    # overnight capacity
+    capacity = OVERNIGHT_CAPACITY.get(site)
+    overnight = [(visit.arrival, visit.departure) for visit in visits if (visit.overnight)]
+    if (capacity == None or len(overnight) == 0): return
+    start = min(i[0] for i in overnight)
+    end = max(i[1] for i in overnight)
+    overnight += list(
+        models.visitmodel(site).objects
+        .filter(overnight = True, arrival__lt = end, departure__gt = start)
+        .values_list("arrival", "departure")
+    )
+    if (_peak(overnight) > capacity):
+        raise BookingConflict("{} can only host {} overnight visitors at a time and is full for these dates.".format(
+            SITES[site], capacity))
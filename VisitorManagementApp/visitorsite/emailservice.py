@@ -1,19 +1,23 @@
 """Seperate module for e-mail notifications"""
-from VisitorManagementApp import settings
-from django.core.mail import send_mail, EmailMultiAlternatives
+from django.conf import settings
+from django.core.mail import get_connection, EmailMultiAlternatives
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.html import strip_tags
+from django.db import transaction
+from django.db.models import Count, Min
 
-from visitorsite import models
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
-from django.contrib.auth.models import User
+from visitorsite import models, recipients
+from visitorsite.globals import NOTIFICATION_DIGESTS
 
 EMAILSTRING = "emailnotification.html"
+DIGESTSTRING = "emaildigest.html"
 
-def _send_notification(site:str, visit:models.RidgefieldVisit):
-    # Site name should be capitalized since all groups in this application start with a capital letter
-    managerstosend = [i.email for i in User.objects.filter(groups__name=site.capitalize())]
-    context = {
+def _notification_context(site:str, visit:models.RidgefieldVisit):
+    return {
         "site" : site.capitalize(),
         "visitorname" : "{} {}".format(visit.visitor.first_name, visit.visitor.last_name),
         "role" : visit.visitor.role.name,
@@ -25,15 +29,221 @@ def _send_notification(site:str, visit:models.RidgefieldVisit):
         "emphone" : visit.visitor.emphone,
         "emrelation" : visit.visitor.emrelation
     }
-    email_formatted = render_to_string(EMAILSTRING, context)
-    kwargs = {
-        "subject": "New visitor at {site}".format(site = site.capitalize()),
-        
-        "html_message" : email_formatted,
-        "message" : strip_tags(email_formatted),
-
-        "recipient_list" : managerstosend,
-        "fail_silently": False,
-        "from_email":settings.EMAIL_HOST_USER
+
+def _build_notification(site:str, visit:models.RidgefieldVisit, managerstosend:list, connection=None):
+    email_formatted = render_to_string(EMAILSTRING, _notification_context(site, visit))
+    message = EmailMultiAlternatives(
+        subject = "New visitor at {site}".format(site = site.capitalize()),
+        body = strip_tags(email_formatted),
+        from_email = settings.EMAIL_HOST_USER,
+        to = managerstosend,
+        connection = connection
+    )
+    message.attach_alternative(email_formatted, "text/html")
+    return message
+
+def _send_notification(site:str, visit:models.RidgefieldVisit):
+    """Renders and sends the notification for a visit straight away (blocks on the mail server)."""
+    _build_notification(site, visit, recipients.site_manager_emails(site)).send(fail_silently = False)
+
+def queue_notification(site:str, visit:models.RidgefieldVisit):
+    """
+    Adds the notification for a visit to the outbox. This only inserts one row; the
+    notification worker renders and sends the e-mail later.
+    """
+    return models.QueuedNotification.objects.create(site = site, visit_id = visit.pk)
+
+def queue_notifications(site:str, visits:list):
+    """Adds the notifications for many visits of one site to the outbox with a single query."""
+    return models.QueuedNotification.objects.bulk_create(
+        [models.QueuedNotification(site = site, visit_id = visit.pk) for visit in visits]
+    )
+
+# NOTIFICATION WORKER
+# ============================================================
+
+def _backoff(attempts:int):
+    # 1, 2, 4, 8... times the base delay, capped so a long outage is retried regularly
+    delay = settings.NOTIFICATION_RETRY_BASE_DELAY * (2 ** max(attempts - 1, 0))
+    return timedelta(seconds = min(delay, settings.NOTIFICATION_RETRY_MAX_DELAY))
+
+def _digest_sites_not_due(now):
+    """
+    Returns the digest sites whose pending notifications should keep waiting: fewer than the
+    site's threshold are due and the oldest of them has not waited for the whole window yet.
+    """
+    digestsites = {site: digest for (site, digest) in NOTIFICATION_DIGESTS.items() if (digest != None)}
+    if (len(digestsites) == 0): return []
+    pending = (
+        models.QueuedNotification.objects
+        .filter(status = models.QueuedNotification.PENDING, next_attempt__lte = now, site__in = digestsites.keys())
+        .values("site")
+        .annotate(count = Count("id"), oldest = Min("created"))
+    )
+    due = [
+        i["site"] for i in pending
+        if (i["count"] >= digestsites[i["site"]]["threshold"] or
+            i["oldest"] <= now - timedelta(seconds = digestsites[i["site"]]["window"]))
+    ]
+    return [site for site in digestsites.keys() if (site not in due)]
+
+def _claim_batch(batch_size:int):
+    """
+    Claims up to batch_size due notifications. Claimed rows are leased by pushing
+    next_attempt into the future, so a second worker skips them and a crashed worker's
+    rows become due again once the lease runs out.
+    """
+    now = timezone.now()
+    waiting = _digest_sites_not_due(now)
+    with transaction.atomic():
+        # skip_locked lets several workers drain the outbox at once on PostgreSQL
+        # (select_for_update is ignored on SQLite, which only allows one writer anyway)
+        claimed = list(
+            models.QueuedNotification.objects
+            .select_for_update(skip_locked = True)
+            .filter(status = models.QueuedNotification.PENDING, next_attempt__lte = now)
+            .exclude(site__in = waiting)
+            .order_by("next_attempt")[:batch_size]
+        )
+        for notification in claimed:
+            notification.attempts += 1
+            notification.next_attempt = now + timedelta(seconds = settings.NOTIFICATION_LEASE)
+            notification.save(update_fields = ["attempts", "next_attempt"])
+    return claimed
+
+def _build_digest(site:str, visits:list, managerstosend:list):
+    """
+    Renders a digest of visits once and returns one message per site manager, so that
+    managers do not see each other's addresses.
+    """
+    context = {
+        "site" : site.capitalize(),
+        "visits" : [_notification_context(site, visit) for visit in visits],
     }
-    send_mail(**kwargs)
\ No newline at end of file
+    email_formatted = render_to_string(DIGESTSTRING, context)
+    email_plain = strip_tags(email_formatted)
+    subject = "{n} new visitors at {site}".format(n = len(visits), site = site.capitalize())
+    messages = []
+    for manager in managerstosend:
+        message = EmailMultiAlternatives(subject, email_plain, settings.EMAIL_HOST_USER, [manager])
+        message.attach_alternative(email_formatted, "text/html")
+        messages.append(message)
+    return messages
+
+def _send_chunk(jobs:list):
+    """
+    Sends (notifications, manager, messages) jobs over a single connection. Runs on a pool
+    thread and does no database work; it returns the error (or None) for each job. A job is
+    either one visit notification (manager is None) or a digest for one site manager, so a
+    manager the mail server refuses does not fail the digest of the others.
+    """
+    results = []
+    connection = get_connection(backend = settings.NOTIFICATION_EMAIL_BACKEND, fail_silently = False)
+    try:
+        connection.open()
+        for (notifications, manager, messages) in jobs:
+            try:
+                for message in messages: message.connection = connection
+                connection.send_messages(messages)
+                results.append((notifications, manager, None))
+            except Exception as e:
+                results.append((notifications, manager, e))
+    except Exception as e: # could not connect to the mail server at all
+        results.extend((notifications, manager, e) for (notifications, manager, messages) in jobs[len(results):])
+    finally:
+        try: connection.close()
+        except Exception: pass
+    return results
+
+def _record_result(notification:models.QueuedNotification, error):
+    if (error == None):
+        notification.status = models.QueuedNotification.SENT
+        notification.sent = timezone.now()
+        notification.last_error = ""
+    elif (notification.attempts >= settings.NOTIFICATION_MAX_ATTEMPTS):
+        notification.status = models.QueuedNotification.FAILED
+        notification.last_error = str(error)
+    else:
+        notification.next_attempt = timezone.now() + _backoff(notification.attempts)
+        notification.last_error = str(error)
+    notification.save(update_fields = ["status", "sent", "last_error", "next_attempt", "delivered"])
+
+def _build_jobs(site:str, notifications:list):
+    """Renders the claimed notifications of one site into jobs for _send_chunk."""
+    try:
+        visits = models.visitmodel(site).objects.select_related(
+            "visitor__role", "visitor__emergencycontact"
+        ).in_bulk([i.visit_id for i in notifications])
+        managerstosend = recipients.site_manager_emails(site)
+    except ValueError as ve: # the site no longer exists, there is nothing to retry
+        for notification in notifications:
+            notification.attempts = settings.NOTIFICATION_MAX_ATTEMPTS
+            _record_result(notification, ve)
+        return []
+
+    found = []
+    for notification in notifications:
+        if (notification.visit_id in visits):
+            found.append(notification)
+        else: # the visit was deleted, there is nothing to retry
+            notification.attempts = settings.NOTIFICATION_MAX_ATTEMPTS
+            _record_result(notification, "Visit {} no longer exists".format(notification.visit_id))
+    if (len(found) == 0): return []
+
+    if (NOTIFICATION_DIGESTS.get(site) != None):
+        return _digest_jobs(site, found, visits, managerstosend)
+    return [([i], None, [_build_notification(site, visits[i.visit_id], managerstosend)]) for i in found]
+
+def _digest_jobs(site:str, notifications:list, visits:dict, managerstosend:list):
+    """
+    One job per site manager, with the visits of the notifications not yet delivered to them
+    (after a failed send, only the managers it failed for get the digest again). Managers
+    waiting for the same visits share one rendering.
+    """
+    groups = {}
+    for manager in managerstosend:
+        waiting = tuple(i for i in notifications if (manager not in i.delivered))
+        if (len(waiting) != 0): groups.setdefault(waiting, []).append(manager)
+    jobs = []
+    for (waiting, managers) in groups.items():
+        messages = _build_digest(site, [visits[i.visit_id] for i in waiting], managers)
+        jobs.extend((list(waiting), manager, [message]) for (manager, message) in zip(managers, messages))
+    # notifications every manager already has (or a site without managers) have nothing left to send
+    covered = set(i.pk for waiting in groups for i in waiting)
+    done = [i for i in notifications if (i.pk not in covered)]
+    if (len(done) != 0): jobs.append((done, None, []))
+    return jobs
+
+def send_queued_notifications(batch_size:int = 100, threads:int = 4):
+    """
+    Drains one batch of the outbox and returns the number of notifications that were sent.
+    Messages are rendered on the calling thread, then split into one chunk per pool thread
+    so every thread reuses a single mail server connection for its whole chunk. Sites with
+    a digest configured in globals.NOTIFICATION_DIGESTS get one combined e-mail per manager.
+    """
+    claimed = _claim_batch(batch_size)
+    if (len(claimed) == 0): return 0
+
+    bysite = {} # visits and recipient lists only need to be looked up once per site per batch
+    for notification in claimed:
+        bysite.setdefault(notification.site, []).append(notification)
+    jobs = []
+    for (site, notifications) in bysite.items():
+        jobs.extend(_build_jobs(site, notifications))
+
+    if (len(jobs) == 0): return 0
+    threads = max(1, min(threads, len(jobs)))
+    chunks = [jobs[i::threads] for i in range(threads)]
+    # a digest notification is in one job per manager, and is sent once all of them succeed
+    errors = {}
+    with ThreadPoolExecutor(max_workers = threads) as pool:
+        for results in pool.map(_send_chunk, chunks):
+            for (notifications, manager, error) in results:
+                for notification in notifications:
+                    if (error != None): errors[notification] = error
+                    elif (manager != None): notification.delivered.append(manager)
+                    errors.setdefault(notification, None)
+    for (notification, error) in errors.items():
+        _record_result(notification, error)
+    return len([i for i in errors.values() if (i == None)])
+# ============================================================
@@ -0,0 +1,61 @@
+"""Seperate module for exporting visits as CSV for audits"""
+import csv
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from visitorsite import models
+
+CHUNKSIZE = 2000
+
+HEADER = ["Visit ID", "Username", "First Name", "Last Name", "E-mail Address", "Phone Number", "Role",
+          "Arrival", "Departure", "Induction", "House Rules", "Overnight", "Paddock",
+          "Emergency Contact Name", "Emergency Contact Phone Number", "Emergency Contact Relationship to Visitor"]
+
+class _Echo:
+    """Pseudo-buffer for csv.writer, so every row is returned instead of being kept in memory."""
+    def write(self, value): return value
+
+def _row(visit:models.Visit):
+    visitor = visit.visitor
+    ec = visitor.emergencycontact
+    return [
+        visit.pk,
+        visitor.user.username if (visitor.user != None) else "",
+        visitor.first_name,
+        visitor.last_name,
+        visitor.email,
+        visitor.phone_number,
+        visitor.role.name,
+        timezone.localtime(visit.arrival).isoformat(),
+        timezone.localtime(visit.departure).isoformat(),
+        visit.induction,
+        visit.houserules,
+        visit.overnight,
+        getattr(visit, "paddock", ""), # only Ridgefield has paddocks
+        ec.name if (ec != None) else "",
+        ec.phone if (ec != None) else "",
+        ec.relationship if (ec != None) else ""
+    ]
+
+def visits_csv_rows(queryset):
+    """
+    Yields CSV lines for the visits in queryset. The related visitor, user, role and emergency
+    contact are joined in the same query, and rows are fetched chunk by chunk with a server-side
+    cursor where the database supports it, so memory use does not grow with the number of visits.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(HEADER)
+    visits = (
+        queryset
+        .select_related("visitor__user", "visitor__role", "visitor__emergencycontact")
+        .order_by("arrival", "pk")
+        .iterator(chunk_size = CHUNKSIZE)
+    )
+    for visit in visits:
+        yield writer.writerow(_row(visit))
+
+def visits_csv_response(queryset, filename:str):
+    response = StreamingHttpResponse(visits_csv_rows(queryset), content_type = "text/csv")
+    response["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+    return response
@@ -0,0 +1,39 @@
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponseBadRequest
+from django.utils.timezone import make_aware
+
+from .globals import *
+
+from . import models
+from . import forms
+from . import archive
+from .exportservice import visits_csv_response
+
+# ------------------------------------------------------------
+"""Site managers can download every visit to their site as a CSV file for audits,
+optionally limited to visits arriving between two dates (?start=YYYY-MM-DD&end=YYYY-MM-DD).
+Visits moved to the archive (see archive.py) are downloaded with ?archived=1."""
+@login_required
+def exportvisits(request, site):
+    if (site not in SITES):
+        raise Http404("{} is not a site".format(site))
+    # same permission that lets the site manager see the visits in the admin page
+    if (not request.user.has_perm("visitorsite.view_{sitename}visit".format(sitename = site))):
+        raise PermissionDenied
+
+    dates = forms.VisitExportForm(request.GET)
+    if (not dates.is_valid()):
+        return HttpResponseBadRequest("Dates must be written as YYYY-MM-DD")
+
+    archived = request.GET.get("archived") == "1"
+    visits = archive.archived_visits(site) if (archived) else models.visitmodel(site).objects.all()
+    # the bounds as times (midnight in the server's time zone) rather than arrival__date, which
+    # casts the column and cannot use the arrival indexes
+    if (dates.cleaned_data["start"]):
+        visits = visits.filter(arrival__gte = make_aware(datetime.combine(dates.cleaned_data["start"], time.min)))
+    if (dates.cleaned_data["end"]):
+        visits = visits.filter(arrival__lt = make_aware(datetime.combine(dates.cleaned_data["end"] + timedelta(days = 1), time.min)))
+    return visits_csv_response(visits, "{}-{}visits.csv".format(site, "archived-" if (archived) else ""))
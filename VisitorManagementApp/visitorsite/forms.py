@@ -3,13 +3,54 @@ from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator, MinValueValidator
 from django.contrib.auth import password_validation
 from django.contrib.auth.models import User
+from django.forms.models import ModelChoiceIterator
 from .models import Role
-from django.utils.html import mark_safe
+from . import rolecache
+from .globals import SITES
+from django.templatetags.static import static
+from django.utils.functional import lazy
+from django.utils.html import format_html
+from django.utils.safestring import SafeString
 # opted not to use modelForm because:
 # 1) arrival and departure fields are TextFields, not Date/TimePicker
 #    fields
 # 2) the client wants form fields to change over time
 
+# ROLE FIELD
+# =======================================================================
+class RoleChoiceIterator(ModelChoiceIterator):
+    # the choices come from the cached catalogue instead of a query per form
+    def __iter__(self):
+        if (self.field.empty_label != None):
+            yield ("", self.field.empty_label)
+        for role in rolecache.roles():
+            yield self.choice(role)
+
+    def __len__(self):
+        return len(rolecache.roles()) + (1 if (self.field.empty_label != None) else 0)
+
+    def __bool__(self):
+        return self.field.empty_label != None or len(rolecache.roles()) != 0
+
+class RoleChoiceField(forms.ModelChoiceField):
+    """
+    Choice of a Role, listed and validated from the cached role catalogue (see rolecache.py), so
+    a team formset with one role field per member renders and validates without role queries.
+    """
+    iterator = RoleChoiceIterator
+
+    def __init__(self, **kwargs):
+        super().__init__(queryset = Role.objects.all(), **kwargs)
+
+    def to_python(self, value):
+        if (value in self.empty_values): return None
+        if (isinstance(value, Role)): value = value.pk
+        role = rolecache.by_pk(value)
+        if (role == None):
+            raise ValidationError(self.error_messages["invalid_choice"], code = "invalid_choice", params = {"value" : value})
+        return role
+# =======================================================================
+
 # VISITOR FORMS
 # =======================================================================
 class VisitorProfileForm(forms.Form):
@@ -24,7 +65,7 @@ class VisitorProfileForm(forms.Form):
     # can be separated by dashes or by whitespace (\s)
     # US: +1-407-123-4567
     phone = forms.CharField(label="Phone Number", validators=[RegexValidator(r"[0-9\-\+\s]")])
-    role = forms.ModelChoiceField(queryset = Role.objects.all(), label="Role")
+    role = RoleChoiceField(label="Role")
     # Below are details for a visitor's emergency contacts
     emergencyname = forms.CharField(label="Emergency Contact Name", validators=[RegexValidator(r"[^0-9]")])
     emergencyphone = forms.CharField(label="Emergency Contact Phone Number", validators=[RegexValidator(r"[0-9\-\+\s]")])
@@ -49,7 +90,7 @@ class VisitorProfileFieldsChangeForm(forms.Form):
     email = forms.EmailField(label="E-mail address", required=False)
 
     phone = forms.CharField(label="Phone Number", validators=[RegexValidator(r"[0-9\-\+\s]")], required=False)
-    role = forms.ModelChoiceField(queryset = Role.objects.all(), label="Role", required=False)
+    role = RoleChoiceField(label="Role", required=False)
 
 class VisitorEmergencyContactForm(forms.Form):
     # Front-end does not show emergency contact details (new form after initial user registration)
@@ -80,6 +121,8 @@ class VisitForm(forms.Form):
     def clean(self):
         arrivaldate = self.cleaned_data.get("arrivaldate")
         departuredate = self.cleaned_data.get("departuredate")
+        if (None in (arrivaldate, departuredate, self.cleaned_data.get("arrivaltime"), self.cleaned_data.get("departuretime"))):
+            return # the missing or invalid date/time already has an error
 
         # arrival date cannot be after the departure date
         if (arrivaldate > departuredate):
@@ -108,10 +151,17 @@ class VisitForm(forms.Form):
             if (self.cleaned_data.get("induction")):
                 self.add_error("induction", ValidationError("You cannot check this field if you are not staying overnight."))
 
+def _pdflink(text:str, filename:str):
+    return format_html('I have read the<a href="{}" target="_blank">{}</a >', static("pdf/" + filename), text)
+
+# labels linking to the site PDFs. The URL is looked up when the form is shown, since the hashed
+# file names are only known once the static files are loaded
+pdflink = lazy(_pdflink, SafeString)
+
 class RidgefieldVisitForm(VisitForm):
     paddock = forms.CharField(label="Enter paddock (Ridgefield Farm only)", required=False) # only for Ridgefield farm
-    induction = forms.BooleanField(label=mark_safe('I have read the<a href="/static/pdf/UWA RidgeFieldFarm _Visitor and User Induction_2022_as at 10 May 2022.pdf" target="_blank">induction</a >'),required=False)
-    houserules = forms.BooleanField(label=mark_safe('I have read the<a href="/static/pdf/Terms and Conditions - Accommodation at the Old Farmhouse.pdf" target="_blank">houserules</a >'),required=False)
+    induction = forms.BooleanField(label=pdflink("induction", "UWA RidgeFieldFarm _Visitor and User Induction_2022_as at 10 May 2022.pdf"),required=False)
+    houserules = forms.BooleanField(label=pdflink("houserules", "Terms and Conditions - Accommodation at the Old Farmhouse.pdf"),required=False)
     def clean(self):
         super().clean()
         if (self.cleaned_data.get("overnight")):
@@ -123,8 +173,8 @@ class RidgefieldVisitForm(VisitForm):
 
 class GinginVisitForm(VisitForm):
     paddock = forms.CharField(label="Enter paddock (Ridgefield Farm only)", required=False)  # only for Ridgefield farm
-    induction = forms.BooleanField(label=mark_safe('I have read the<a href="/static/pdf/Induction sheet-5.pdf" target="_blank">induction</a >'),required=False)
-    houserules = forms.BooleanField(label=mark_safe('I have read the<a href="/static/pdf/GGP Gate locking procedure.pdf" target="_blank">houserules</a >'),required=False)
+    induction = forms.BooleanField(label=pdflink("induction", "Induction sheet-5.pdf"),required=False)
+    houserules = forms.BooleanField(label=pdflink("houserules", "GGP Gate locking procedure.pdf"),required=False)
     def clean(self):
         super().clean()
         if (self.cleaned_data.get("overnight")):
@@ -150,17 +200,20 @@ class TeamVisitorForm(forms.Form):
     team_last_name = forms.CharField(label="Last name", required = False)
     team_email = forms.EmailField(label="E-mail address", required = False)
     team_phone = forms.CharField(label="Phone Number", validators=[RegexValidator(r"[0-9\-\+\s]")], required = False)
-    team_role = forms.ModelChoiceField(queryset = Role.objects.all(), label="Role", required = False)
+    team_role = RoleChoiceField(label="Role", required = False)
 
     team_emergencyname = forms.CharField(label="Emergency Contact Name", validators=[RegexValidator(r"[^0-9]")], required = False)
     team_emergencyphone = forms.CharField(label="Emergency Contact Phone Number", validators=[RegexValidator(r"[0-9\-\+\s]")], required = False)
     team_relationship = forms.CharField(label="Emergency Contact Relationship (Friend, Family member, etc)", required = False)
 
+    def userexists(self, username:str):
+        return User.objects.filter(username = username).first() != None
+
     def clean(self):
         cd = self.cleaned_data
         # if the username is specified, check if this exists in the database
         if (cd.get("team_username") != ""):
-            if (User.objects.filter(username = cd.get("team_username")).first() == None):
+            if (not self.userexists(cd.get("team_username"))):
                 self.add_error("team_username", ValidationError("This user does not exist in the database!"))
             else: # check if all other values are blank
                 for (field, value) in cd.items():
@@ -173,6 +226,33 @@ class TeamVisitorForm(forms.Form):
                     self.add_error(field, ValidationError("This field must be specified when a username is not specified!"))
                     break # if we continue there will be a error in dictionary changes during iteration
 
-            
-        
+class ImportVisitorForm(TeamVisitorForm):
+    """
+    One row of a bulk visit import (see importservice.py). The same rules as TeamVisitorForm
+    apply, but usernames and roles are checked against the ones the importer loads once for
+    many rows, instead of querying the database for every row.
+    """
+    team_role = forms.CharField(label="Role", required = False)
+
+    def __init__(self, *args, usernames = (), roles = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.usernames = usernames
+        self.roles = roles or {}
+
+    def userexists(self, username:str):
+        return username in self.usernames
+
+    def clean_team_role(self):
+        role = self.cleaned_data.get("team_role")
+        if (not role): return None
+        if (role not in self.roles):
+            raise ValidationError("This role does not exist!")
+        return self.roles[role]
+
+class VisitImportForm(forms.Form):
+    site = forms.ChoiceField(label="Site", choices=SITES.items())
+    file = forms.FileField(label="Spreadsheet with one visit per row (.csv or .xlsx)")
 
+class VisitExportForm(forms.Form):
+    start = forms.DateField(label="Arriving on or after", required=False)
+    end = forms.DateField(label="Arriving on or before", required=False)
@@ -3,4 +3,19 @@ BASICFORMTEMPLATE = "basicforms.html"
 SITES = {
     "ridgefield" : "UWA Farm Ridgefield",
     "gingin" : "Gingin Gravity Precinct"
-}
\ No newline at end of file
+}
+
+# Site manager notifications are sent straight away (None) or collected into one digest
+# e-mail per manager. A digest is sent once "threshold" visits are waiting or the oldest
+# waiting visit has waited for "window" seconds, whichever comes first.
+NOTIFICATION_DIGESTS = {
+    "ridgefield" : None, # e.g. {"window" : 15 * 60, "threshold" : 10}
+    "gingin" : None
+}
+
+# Largest number of visitors that can stay overnight at a site at the same time
+# (None means there is no limit). New visits that would go over it are refused.
+OVERNIGHT_CAPACITY = {
+    "ridgefield" : None, # e.g. the number of beds at the Old Farmhouse
+    "gingin" : None
+}
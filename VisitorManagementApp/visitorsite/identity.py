@@ -0,0 +1,126 @@
+"""Seperate module recognising visitors registered again without an account (and merging the duplicates)"""
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, Max, Min, Value, When
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from visitorsite import models, occupancy, rollups, search
+
+BATCHSIZE = 500
+
+# Django converts the domain part of the email to lower case (base_user.py line 20, normalize_email)
+# for bulk-registration attempts that do not bind to a User object, normalise the e-mail address
+# as if it were part of the User object. This will make the site manager page more consistent
+def normaliseEmail(x:str):
+    # the first part should include @ because we cannot lower this (for safety)
+    return x[:x.rfind('@') + 1] + x[x.rfind('@') + 1:].lower()
+
+def canonical_phone(phone:str):
+    """
+    The phone number in E.164 form (+61412345678), or "" if it has no digits. Numbers without an
+    international prefix (+ or 00) are taken as national numbers of settings.PHONE_COUNTRY_CODE,
+    without their leading 0 (trunk prefix).
+    """
+    phone = (phone or "").strip()
+    digits = re.sub(r"\D", "", phone)
+    if (digits == ""): return ""
+    if (phone.startswith("+")): return "+" + digits
+    if (digits.startswith("00")): return "+" + digits[2:]
+    return "+" + settings.PHONE_COUNTRY_CODE + digits.lstrip("0")
+
+def _name(name:str):
+    # the same name whatever its case and spacing
+    return " ".join((name or "").split()).casefold()
+
+def identity_key(email:str, phone:str, first_name:str, last_name:str):
+    """
+    The key identifying a person: the normalised e-mail address, the E.164 phone number and the
+    name. The name is part of it because families and classes are often registered with one
+    parent's or teacher's e-mail address and phone number. It is "" (never matched) unless the
+    e-mail address and phone number are both given.
+    """
+    email = normaliseEmail((email or "").strip())
+    phone = canonical_phone(phone)
+    if (email == "" or phone == ""): return ""
+    return "|".join([email, phone, _name(first_name), _name(last_name)])
+
+# visitors saved one by one (registration, profile changes, the admin page). Visitors created in
+# bulk get their key from registerNewVisitors
+@receiver(pre_save, sender = models.Visitor)
+def _visitorsaving(sender, instance, raw = False, **kwargs):
+    if (not raw): instance.identity = identity_key(instance.email, instance.phone_number, instance.first_name, instance.last_name)
+
+def existing_visitors(keys):
+    """
+    {identity key: visitor} of the visitors without an account with one of the keys, with one
+    indexed query. Visitors with an account are never reused for someone registered by others.
+    """
+    keys = set(keys) - {""}
+    if (len(keys) == 0): return {}
+    visitors = {}
+    # the oldest visitor of a key, in case duplicates were registered before the key existed
+    for visitor in models.Visitor.objects.filter(identity__in = keys, user = None).select_related("emergencycontact").order_by("-pk"):
+        visitors[visitor.identity] = visitor
+    return visitors
+
+# MERGING DUPLICATES
+# ============================================================
+def duplicate_keys():
+    """The identity keys shared by more than one visitor without an account."""
+    return (
+        models.Visitor.objects.filter(user = None).exclude(identity = "")
+        .values("identity").annotate(n = Count("pk")).filter(n__gt = 1)
+        .order_by("identity").values_list("identity", flat = True)
+    )
+
+def _repoint(queryset, moves:dict):
+    # one UPDATE moving the rows of every duplicate to the visitor kept
+    if (len(moves) == 0): return 0
+    return queryset.filter(visitor_id__in = moves.keys()).update(visitor_id = Case(
+        *[When(visitor_id = old, then = Value(new)) for (old, new) in moves.items()]
+    ))
+
+def merge_duplicates(keys:list):
+    """
+    Merges the visitors without an account sharing each identity key into the oldest one, in one
+    transaction, and returns the number of visitors removed. Their visits and archived visits
+    move to that visitor, which takes the names, role and emergency contact of the most recently
+    registered duplicate (the latest details given).
+    """
+    groups = (
+        models.Visitor.objects.filter(user = None, identity__in = keys)
+        .values("identity").annotate(keep = Min("pk"), latest = Max("pk"))
+    )
+    with transaction.atomic():
+        groups = {i["identity"] : (i["keep"], i["latest"]) for i in groups}
+        visitors = list(models.Visitor.objects.filter(user = None, identity__in = groups.keys()))
+        byid = {i.pk : i for i in visitors}
+        moves = {i.pk : groups[i.identity][0] for i in visitors if (i.pk != groups[i.identity][0])}
+        if (len(moves) == 0): return 0
+
+        # every visit ends up under the role of the latest duplicate
+        rollups.change_roles({i.pk : (i.role_id, byid[groups[i.identity][1]].role_id) for i in visitors})
+        _repoint(models.Visit.objects, moves)
+        _repoint(models.ArchivedVisit.objects, moves)
+
+        kept = []
+        contacts = set(i.emergencycontact_id for i in visitors) - {None}
+        for (keep, latest) in groups.values():
+            visitor = byid[keep]
+            for field in ("first_name", "last_name", "email", "phone_number", "role_id", "emergencycontact_id"):
+                setattr(visitor, field, getattr(byid[latest], field))
+            kept.append(visitor)
+        contacts -= set(i.emergencycontact_id for i in kept)
+
+        # the duplicates go first, the visitor kept then takes over the latest emergency contact
+        models.Visitor.objects.filter(pk__in = moves.keys()).delete()
+        models.Visitor.objects.bulk_update(kept, ["first_name", "last_name", "email", "phone_number", "role", "emergencycontact"])
+        models.EmergencyContact.objects.filter(pk__in = contacts).delete()
+        # bulk updates send no signals
+        search.index_visitors(kept)
+        occupancy.invalidate()
+    return len(moves)
+# ============================================================
@@ -0,0 +1,171 @@
+"""Seperate module for bulk imports of visitors and visits from spreadsheets (CSV or Excel)"""
+import csv
+import io
+from itertools import islice
+
+from django.db import transaction
+
+from visitorsite import models, forms, rolecache
+from visitorsite.views import registerNewVisitors, newVisitObject, saveNewVisits
+from visitorsite.bookingchecks import BookingConflict
+
+try: # Excel files are only supported if openpyxl is installed
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Columns of the spreadsheet. Visitors with an account only need the username, all other
+# visitor columns must be blank for them (same rules as the team registration form)
+VISITORCOLUMNS = ["username", "first_name", "last_name", "email", "phone", "role",
+                  "emergencyname", "emergencyphone", "relationship"]
+VISITCOLUMNS = ["arrivaldate", "arrivaltime", "departuredate", "departuretime",
+                "overnight", "induction", "houserules", "paddock"]
+COLUMNS = VISITORCOLUMNS + VISITCOLUMNS
+
+VISITFORMS = {
+    "ridgefield" : forms.RidgefieldVisitForm,
+    "gingin" : forms.GinginVisitForm
+}
+
+CHUNKSIZE = 500
+
+# READING ROWS
+# ============================================================
+def _checkheader(header):
+    header = [str(i).strip().lower() if (i != None) else "" for i in header]
+    missing = [i for i in COLUMNS if (i not in header)]
+    if (len(missing) != 0):
+        raise ValueError("The spreadsheet is missing the following columns: {}".format(", ".join(missing)))
+    return header
+
+def read_csv(binaryfile):
+    """Yields (row number, row as a dictionary) for each row of a CSV file, one row at a time."""
+    # utf-8-sig removes the byte order mark Excel adds when saving as CSV
+    reader = csv.reader(io.TextIOWrapper(binaryfile, encoding = "utf-8-sig", newline = ""))
+    header = _checkheader(next(reader, []))
+    for (n, row) in enumerate(reader, start = 2): # row 1 is the header
+        if (not any(row)): continue # skip empty lines
+        yield (n, dict(zip(header, row)))
+
+def read_xlsx(binaryfile):
+    """Yields (row number, row as a dictionary) for each row of the first sheet of an Excel file."""
+    if (openpyxl == None):
+        raise ValueError("Excel files are not supported on this server, please upload a CSV file instead.")
+    # read_only loads the rows lazily instead of loading the whole workbook
+    workbook = openpyxl.load_workbook(binaryfile, read_only = True, data_only = True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only = True)
+        header = _checkheader(next(rows, []))
+        for (n, row) in enumerate(rows, start = 2): # row 1 is the header
+            if (all(i in (None, "") for i in row)): continue # skip empty lines
+            yield (n, dict(zip(header, ("" if (i == None) else i for i in row))))
+    finally:
+        workbook.close()
+
+def read_rows(binaryfile, filename:str):
+    if (filename.lower().endswith(".xlsx")): return read_xlsx(binaryfile)
+    if (filename.lower().endswith(".csv")): return read_csv(binaryfile)
+    raise ValueError("Only .csv and .xlsx files can be imported.")
+# ============================================================
+
+# VALIDATING AND SAVING ROWS
+# ============================================================
+def _parsebool(value):
+    # spreadsheets use all sorts of values for a ticked box
+    if (isinstance(value, bool)): return value
+    return str(value).strip().lower() in ("1", "y", "yes", "true", "x")
+
+def _validate(site:str, row:dict, usernames, roles:dict):
+    """Returns (visitor data, visit data, errors) for a row using the same forms as the website."""
+    visitorform = forms.ImportVisitorForm(
+        data = {"team_" + i : row.get(i, "") for i in VISITORCOLUMNS},
+        usernames = usernames,
+        roles = roles
+    )
+    visitdata = {i : row.get(i, "") for i in VISITCOLUMNS}
+    for i in ("overnight", "induction", "houserules"):
+        visitdata[i] = _parsebool(visitdata[i])
+    visitform = VISITFORMS[site](data = visitdata)
+
+    errors = {}
+    if (not visitorform.is_valid()):
+        errors.update({field.replace("team_", "", 1) : e for (field, e) in visitorform.errors.items()})
+    if (not visitform.is_valid()):
+        errors.update(visitform.errors)
+    if (len(errors) != 0): return (None, None, errors)
+    return (visitorform.cleaned_data, visitform.cleaned_data, None)
+
+def _newvisitor(t:dict):
+    return {
+        "first_name": t["team_first_name"],
+        "last_name": t["team_last_name"],
+        "email" : t["team_email"],
+        "phone": t["team_phone"],
+        "role" : t["team_role"],
+        "emergencyname" : t["team_emergencyname"],
+        "emergencyphone" : t["team_emergencyphone"],
+        "relationship" : t["team_relationship"]
+    }
+
+def _save(site:str, valid:list, existing:dict):
+    with transaction.atomic():
+        created = iter(registerNewVisitors([_newvisitor(t) for (n, t, v) in valid if (not t["team_username"])]))
+        saveNewVisits(site, [
+            newVisitObject(site, v, existing[t["team_username"]] if (t["team_username"]) else next(created))
+            for (n, t, v) in valid
+        ])
+
+def _import_chunk(site:str, rows:list, roles:dict, onerror):
+    # one query resolves every username in the chunk (site managers have no Visitor and are rejected)
+    usernames = set(str(row.get("username", "")).strip() for (n, row) in rows) - {""}
+    existing = {
+        i.user.username : i for i in
+        models.Visitor.objects.filter(user__username__in = usernames).select_related("user")
+    }
+
+    valid = []
+    for (n, row) in rows:
+        (visitor, visit, errors) = _validate(site, row, existing.keys(), roles)
+        if (errors != None):
+            if (onerror != None): onerror(n, errors)
+        else:
+            valid.append((n, visitor, visit))
+
+    try:
+        _save(site, valid, existing)
+        return len(valid)
+    except BookingConflict:
+        pass
+
+    # some rows are double bookings or do not fit on the site, so save the rows one by one to find them
+    imported = 0
+    for row in valid:
+        try:
+            _save(site, [row], existing)
+            imported += 1
+        except BookingConflict as bc:
+            if (onerror != None): onerror(row[0], {"__all__" : [str(bc)]})
+    return imported
+
+def import_visits(site:str, rows, chunk_size:int = CHUNKSIZE, onerror = None):
+    """
+    Imports visits to a site from (row number, row) pairs (see read_rows) and returns the number of
+    rows imported and the number of rows that failed. Rows are validated and written chunk_size
+    rows at a time, so only one chunk is ever held in memory. Invalid rows are skipped and
+    reported to onerror(row number, {column: [errors]}).
+    """
+    if (site not in VISITFORMS):
+        raise ValueError("{} could not be converted into a Visit-derived model (did you forget to make it)?".format(site))
+    # roles are read once for the whole import (from the cached role catalogue)
+    roles = {i.name : i for i in rolecache.roles()}
+
+    rows = iter(rows)
+    imported = 0
+    total = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if (len(chunk) == 0): break
+        total += len(chunk)
+        imported += _import_chunk(site, chunk, roles, onerror)
+    return (imported, total - imported)
+# ============================================================
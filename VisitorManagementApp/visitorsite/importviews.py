@@ -0,0 +1,56 @@
+from django.shortcuts import render, redirect
+
+from django.contrib import messages # flash messages
+from django.contrib.auth.decorators import login_required
+
+from django.urls import reverse_lazy
+
+from .globals import *
+
+from . import forms
+from . import importservice
+
+# only this many row errors are shown, the rest are counted
+IMPORTERRORLIMIT = 200
+
+# ------------------------------------------------------------
+"""Large groups (e.g. school field trips) can upload a spreadsheet with one
+visit per row instead of filling in the team registration form for every member."""
+@login_required
+def importvisits(request):
+    if (request.user.is_staff): # Site managers go to the admin page
+        return redirect(reverse_lazy("admin:index"))
+
+    errors = []
+    report = None
+    if (request.method == "POST"):
+        upload = forms.VisitImportForm(request.POST, request.FILES)
+        if (upload.is_valid()):
+            def onerror(n, rowerrors):
+                if (len(errors) < IMPORTERRORLIMIT):
+                    errors.extend((n, field, " ".join(e)) for (field, e) in rowerrors.items())
+            f = upload.cleaned_data["file"]
+            try:
+                (imported, failed) = importservice.import_visits(
+                    upload.cleaned_data["site"],
+                    importservice.read_rows(f.file, f.name),
+                    onerror = onerror
+                )
+                report = {"imported" : imported, "failed" : failed, "hidden" : len(errors) >= IMPORTERRORLIMIT}
+                if (imported): messages.success(request, f"Imported {imported} visits! Site manager will be notified.")
+                if (failed): messages.error(request, f"{failed} rows could not be imported, see below.")
+            except (ValueError, UnicodeDecodeError) as ve:
+                messages.error(request, "Could not read the spreadsheet: {}".format(str(ve)))
+        else:
+            messages.error(request, "Form is not valid!")
+    else:
+        upload = forms.VisitImportForm()
+
+    context = {
+        "logged_in" : True,
+        "form" : upload,
+        "columns" : importservice.COLUMNS,
+        "report" : report,
+        "errors" : errors
+    }
+    return render(request, "importvisits.html", context)
@@ -0,0 +1,244 @@
+"""Seperate module measuring where request time goes (SQL, templates, password hashing) and collecting metrics"""
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates
+from django.utils.functional import SimpleLazyObject, empty
+
+logger = logging.getLogger(__name__)
+
+# METRICS REGISTRY
+# In-process counters and histograms, rendered in the Prometheus text format by metricsviews.
+# Each server process has its own (scrape every process, or run a single process per host).
+# ============================================================
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_lock = threading.Lock()
+_metrics = {} # name: {"type", "help", "buckets", "values": {labels: value or [bucket counts, sum, count]}}
+
+def define(name:str, kind:str, help:str, buckets:tuple = None):
+    """Declares a counter or histogram, so it is listed (with its help text) even before it is used."""
+    with _lock:
+        _metrics.setdefault(name, {"type" : kind, "help" : help, "buckets" : buckets, "values" : {}})
+
+def inc(name:str, value:float = 1, **labels):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        values = _metrics[name]["values"]
+        values[key] = values.get(key, 0) + value
+
+def observe(name:str, value:float, **labels):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        metric = _metrics[name]
+        if (key not in metric["values"]):
+            metric["values"][key] = [[0] * len(metric["buckets"]), 0, 0]
+        histogram = metric["values"][key]
+        i = bisect_left(metric["buckets"], value)
+        if (i < len(metric["buckets"])): histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+def _labels(labels:tuple, extra:tuple = ()):
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    pairs = ["{}=\"{}\"".format(k, escape(v)) for (k, v) in labels + extra]
+    return "{" + ",".join(pairs) + "}" if (pairs) else ""
+
+def render():
+    """Returns every metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    with _lock:
+        for (name, metric) in sorted(_metrics.items()):
+            lines.append("# HELP {} {}".format(name, metric["help"]))
+            lines.append("# TYPE {} {}".format(name, metric["type"]))
+            for (labels, value) in sorted(metric["values"].items()):
+                if (metric["type"] == "counter"):
+                    lines.append("{}{} {}".format(name, _labels(labels), value))
+                    continue
+                (counts, total, count) = value
+                cumulative = 0
+                for (bound, n) in zip(metric["buckets"], counts): # buckets are cumulative
+                    cumulative += n
+                    lines.append("{}_bucket{} {}".format(name, _labels(labels, (("le", bound),)), cumulative))
+                lines.append("{}_bucket{} {}".format(name, _labels(labels, (("le", "+Inf"),)), count))
+                lines.append("{}_sum{} {}".format(name, _labels(labels), total))
+                lines.append("{}_count{} {}".format(name, _labels(labels), count))
+    return "\n".join(lines) + "\n"
+
+define("visitorsite_request_duration_seconds", "histogram", "Time to answer a request, per URL pattern.", SECONDS)
+define("visitorsite_request_phase_seconds", "histogram",
+       "Time spent in each phase (sql, template, password) of a request, per URL pattern.", SECONDS)
+define("visitorsite_request_queries", "histogram", "SQL queries run by a request, per URL pattern.", QUERIES)
+define("visitorsite_responses_total", "counter", "Responses sent, per URL pattern and status code.")
+define("visitorsite_slow_queries_total", "counter", "SQL queries slower than METRICS_SLOW_QUERY_MS, per URL pattern.")
+# ============================================================
+
+# REQUEST TIMINGS
+# ============================================================
+class RequestTimings:
+    def __init__(self):
+        self.phases = {} # phase: seconds
+        self.queries = 0
+        self.slowqueries = 0
+
+    def add(self, phase:str, seconds:float):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+# the timings of the request being answered. Context variables follow the request into the threads
+# that async views use for the database (sync_to_async copies the context)
+_current = ContextVar("requesttimings", default = None)
+# the last slow queries, for debugging (they are also logged)
+SLOWQUERIES = deque(maxlen = 50)
+
+@contextmanager
+def phase(name:str):
+    """Adds the time spent in the block to a phase of the current request (if any)."""
+    timings = _current.get()
+    if (timings == None):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+def _timequery(execute, sql, params, many, context):
+    timings = _current.get()
+    if (timings == None): return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        timings.add("sql", seconds)
+        timings.queries += 1
+        if (seconds * 1000 >= settings.METRICS_SLOW_QUERY_MS):
+            timings.slowqueries += 1
+            SLOWQUERIES.append({"sql" : sql[:1000], "ms" : round(seconds * 1000, 1), "time" : time.time()})
+            logger.warning("Slow query (%.1f ms): %s", seconds * 1000, sql[:1000])
+
+def _wrapconnection(connection):
+    if (_timequery not in connection.execute_wrappers):
+        connection.execute_wrappers.append(_timequery)
+
+# connections are per thread, so every new connection gets the query timer
+@receiver(connection_created)
+def _connectioncreated(sender, connection, **kwargs): _wrapconnection(connection)
+
+class InstrumentedTemplates(DjangoTemplates):
+    """The Django template backend, timing how long each template takes to render."""
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
+
+class _TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name): # origin, backend, ...
+        return getattr(self.template, name)
+
+    def render(self, context = None, request = None):
+        with phase("template"):
+            return self.template.render(context, request)
+
+class InstrumentedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    The default password hasher (same algorithm and hashes), timing each hash. Checking a password
+    (verify) hashes it with encode, so logins are timed too.
+    """
+    def encode(self, password, salt, iterations = None):
+        with phase("password"):
+            return super().encode(password, salt, iterations)
+# ============================================================
+
+# MIDDLEWARE
+# ============================================================
+def _route(request):
+    # the URL pattern (e.g. newvisit/<str:site>), so the number of label values stays small
+    match = getattr(request, "resolver_match", None)
+    return match.route if (match != None) else "unmatched"
+
+def _servertiming(timings:RequestTimings, total:float):
+    parts = ["{};dur={:.1f}".format(name, seconds * 1000) for (name, seconds) in sorted(timings.phases.items())]
+    parts.append("queries;desc=\"{} queries\"".format(timings.queries))
+    parts.append("total;dur={:.1f}".format(total * 1000))
+    return ", ".join(parts)
+
+def _isstaff(request):
+    # only a user the request already loaded: reading the session and the user here would add
+    # queries to every request (static files and anonymous pages too) outside the timings
+    user = request.__dict__.get("user")
+    if (isinstance(user, SimpleLazyObject) and user._wrapped is empty): return False
+    return user != None and user.is_staff
+
+class InstrumentationMiddleware:
+    """
+    Times every request and the SQL, template rendering and password hashing it does, and adds
+    them to the metrics (see metricsviews). Site managers also get the timings of their own
+    requests (the ones that read the user anyway, such as the admin pages) in a Server-Timing
+    header, which browsers show in their developer tools. Put it first
+    in MIDDLEWARE so the other middleware is timed too. It works under WSGI and ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # marks the instance as a coroutine function under ASGI, as Django's MiddlewareMixin does
+        # (asgiref's markcoroutinefunction needs asgiref 3.6)
+        if (asyncio.iscoroutinefunction(get_response)):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if (asyncio.iscoroutinefunction(self)): return self.__acall__(request)
+        for connection in connections.all():
+            _wrapconnection(connection)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, response, timings, time.perf_counter() - start, _isstaff(request))
+        return response
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, response, timings, time.perf_counter() - start, _isstaff(request))
+        return response
+
+    def record(self, request, response, timings:RequestTimings, total:float, staff:bool):
+        route = _route(request)
+        observe("visitorsite_request_duration_seconds", total, route = route, method = request.method)
+        for (name, seconds) in timings.phases.items():
+            observe("visitorsite_request_phase_seconds", seconds, route = route, phase = name)
+        observe("visitorsite_request_queries", timings.queries, route = route)
+        inc("visitorsite_responses_total", route = route, status = response.status_code)
+        if (timings.slowqueries):
+            inc("visitorsite_slow_queries_total", timings.slowqueries, route = route)
+        if (staff):
+            response["Server-Timing"] = _servertiming(timings, total)
+# ============================================================
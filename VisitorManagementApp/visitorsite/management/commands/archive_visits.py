@@ -0,0 +1,43 @@
+"""Moves old visits out of the visit tables into the archive (see archive.py)"""
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from visitorsite.globals import SITES
+from visitorsite import archive, models
+
+
+class Command(BaseCommand):
+    help = ("Moves visits that ended more than --days days ago from the visit tables into the archive table, "
+            "where they can still be read and exported for audits, and optionally into compressed monthly CSV files. "
+            "Run it regularly (e.g. nightly) so the visit tables only hold recent visits.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.VISIT_ARCHIVE_AFTER_DAYS,
+                            help="Visits that departed more than this many days ago are archived.")
+        parser.add_argument("--sites", nargs="+", choices=SITES.keys(), default=list(SITES.keys()))
+        parser.add_argument("--export-dir", default=None,
+                            help="Also append the archived visits to <site>-<YYYY-MM>.csv.gz files in this directory.")
+        parser.add_argument("--files-only", action="store_true",
+                            help="Only keep the archived visits in the --export-dir files, not in the archive table.")
+        parser.add_argument("--batch-size", type=int, default=archive.BATCHSIZE, help="Visits moved per transaction.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the visits that would be archived.")
+
+    def handle(self, *args, **options):
+        if (options["days"] < 0):
+            raise CommandError("--days cannot be negative")
+        if (options["files_only"] and options["export_dir"] == None):
+            raise CommandError("--files-only needs --export-dir")
+        if (options["export_dir"] != None and not os.path.isdir(options["export_dir"])):
+            raise CommandError("{} is not a directory".format(options["export_dir"]))
+
+        before = archive.cutoff(options["days"])
+        for site in options["sites"]:
+            if (options["dry_run"]):
+                n = models.visitmodel(site).objects.filter(departure__lt = before).count()
+                self.stdout.write("{}: {} visits would be archived".format(site, n))
+                continue
+            n = archive.archive_visits(site, before, batch_size = options["batch_size"],
+                                       export_dir = options["export_dir"], keep = not options["files_only"])
+            self.stdout.write("{}: archived {} visits that departed before {:%Y-%m-%d}".format(site, n, before))
@@ -0,0 +1,104 @@
+"""Compares the sync (WSGI) and async (ASGI) request paths under concurrent registrations"""
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.test import Client, AsyncClient, override_settings
+from django.test.utils import setup_test_environment
+
+from visitorsite import models, seeding
+
+PASSWORD = "benchmark-password"
+FORMDATA = "application/x-www-form-urlencoded"
+
+
+class Command(BaseCommand):
+    help = ("Sends the same concurrent requests through the sync request handler (as under WSGI, one "
+            "thread per request) and the async handler (as under ASGI, one event loop) in this process, "
+            "and reports the throughput and latency of each. Use it on a benchmark database only, it adds "
+            "benchmark accounts and visits.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--endpoint", choices=["login", "newvisit", "sitecontacts"], default="newvisit")
+        parser.add_argument("--requests", type=int, default=200, help="Number of requests sent to each handler.")
+        parser.add_argument("--concurrency", type=int, default=20,
+                            help="Number of requests in flight at once (threads for the sync handler).")
+
+    def request(self, endpoint:str, n:int):
+        """Returns (method, path, form data) of the n-th request."""
+        if (endpoint == "login"):
+            return ("post", "/login", {"username" : self.usernames[n % len(self.usernames)], "password" : PASSWORD})
+        if (endpoint == "newvisit"):
+            # a day visit on a different day for every request, so none of them is a double booking
+            day = (self.firstday + timedelta(days = n)).isoformat()
+            return ("post", "/newvisit/gingin", {"arrivaldate" : day, "arrivaltime" : "09:00",
+                                                 "departuredate" : day, "departuretime" : "17:00"})
+        return ("get", "/sitecontacts", None)
+
+    def clients(self, clientclass, endpoint:str):
+        """Returns a function giving the client that sends the n-th request."""
+        # failed requests are counted as errors instead of stopping the benchmark
+        if (endpoint == "login"): # logged in clients would skip the login
+            return lambda n: clientclass(raise_request_exception = False)
+        clients = [clientclass(raise_request_exception = False) for i in range(len(self.usernames))]
+        for (client, username) in zip(clients, self.usernames):
+            client.login(username = username, password = PASSWORD)
+        return lambda n: clients[n % len(clients)]
+
+    def send(self, client, endpoint:str, n:int):
+        (method, path, data) = self.request(endpoint, n)
+        if (method == "post"): return client.post(path, urlencode(data), content_type = FORMDATA)
+        return client.get(path)
+
+    def run_sync(self, endpoint:str, requests:int, concurrency:int):
+        client = self.clients(Client, endpoint)
+        def timed(n):
+            start = time.perf_counter()
+            response = self.send(client(n), endpoint, n)
+            return ((time.perf_counter() - start) * 1000, response.status_code)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            results = list(executor.map(timed, range(requests)))
+        return (time.perf_counter() - start, results)
+
+    def run_async(self, endpoint:str, requests:int, concurrency:int):
+        client = self.clients(AsyncClient, endpoint)
+        async def run():
+            semaphore = asyncio.Semaphore(concurrency)
+            async def timed(n):
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await self.send(client(n), endpoint, n)
+                    return ((time.perf_counter() - start) * 1000, response.status_code)
+            return await asyncio.gather(*[timed(n) for n in range(requests)])
+        start = time.perf_counter()
+        results = asyncio.run(run())
+        return (time.perf_counter() - start, results)
+
+    def report(self, name:str, elapsed:float, results:list):
+        latencies = sorted(i[0] for i in results)
+        failed = sum(1 for i in results if (i[1] >= 400))
+        self.stdout.write("{:<8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>8}".format(
+            name, len(results) / elapsed, statistics.median(latencies),
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], latencies[-1], failed))
+
+    def handle(self, *args, **options):
+        setup_test_environment() # lets the test clients through ALLOWED_HOSTS
+        # every request comes from the same address, so the login limits are lifted
+        override_settings(THROTTLE_RATES = {}).enable()
+        endpoint = options["endpoint"]
+        self.usernames = seeding.seed_accounts(options["concurrency"], PASSWORD)
+        # book days after every existing visit, so earlier runs do not cause double bookings
+        last = models.Visit.objects.aggregate(last = Max("departure"))["last"]
+        self.firstday = max(date.today(), last.date() if (last != None) else date.today()) + timedelta(days = 1)
+
+        self.stdout.write("{} {} requests, {} at a time".format(options["requests"], endpoint, options["concurrency"]))
+        self.stdout.write("{:<8}{:>10}{:>10}{:>10}{:>10}{:>8}".format("handler", "req/s", "p50 (ms)", "p95 (ms)", "max (ms)", "errors"))
+        self.report("sync", *self.run_sync(endpoint, options["requests"], options["concurrency"]))
+        self.firstday += timedelta(days = options["requests"]) # the async run books other days
+        self.report("async", *self.run_async(endpoint, options["requests"], options["concurrency"]))
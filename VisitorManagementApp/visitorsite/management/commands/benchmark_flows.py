@@ -0,0 +1,186 @@
+"""End-to-end latency, query and size benchmark of the visitor flows and admin pages"""
+import json
+import platform
+import statistics
+import time
+from datetime import date, timedelta
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_databases, setup_test_environment, teardown_databases
+from django.utils import timezone
+
+from visitorsite import models, seeding
+
+PASSWORD = "Benchmark-password-2022"
+SCENARIOS = ["register", "login", "newvisit", "teamnewvisit", "changedetails",
+             "admin_ridgefieldvisits", "admin_visits", "admin_visitors"]
+# a scenario is slower than the baseline if its median grows by more than this fraction (the median
+# is compared since the slowest requests of short runs are noisy)
+LATENCYTOLERANCE = 0.5
+
+
+class Command(BaseCommand):
+    help = ("Drives the registration, login, visit, team visit, change details and admin pages with the test "
+            "client on a fresh test database, for growing numbers of visits and team sizes, and writes the "
+            "p50/p95/p99 latency, queries and bytes of each scenario as JSON. With --baseline, exits with an "
+            "error if a scenario runs more queries, fails more requests or is much slower than in the baseline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[0, 10000],
+                            help="Numbers of visits in the database to benchmark with (seeded as needed).")
+        parser.add_argument("--team-sizes", type=int, nargs="+", default=[2, 8, 32])
+        parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+        parser.add_argument("--repeat", type=int, default=20, help="Requests timed per scenario.")
+        parser.add_argument("--output", default=None, help="File to write the results to (JSON).")
+        parser.add_argument("--baseline", default=None, help="Results of an earlier run to compare with (JSON).")
+        parser.add_argument("--keepdb", action="store_true", help="Keep the test database between runs.")
+
+    # SCENARIOS
+    # Each returns (client, method, path, data, expected status) for the n-th request
+    # ============================================================
+    def nextday(self):
+        # every visit is on a new day, so none of them is a double booking
+        self.day += timedelta(days = 1)
+        return self.day.isoformat()
+
+    def dayvisit(self):
+        day = self.nextday()
+        return {"arrivaldate" : day, "arrivaltime" : "09:00", "departuredate" : day, "departuretime" : "17:00"}
+
+    def register(self, n:int, team:int):
+        self.registered += 1
+        return (Client(), "post", "/register", {
+            "username" : "flowbenchmark{}".format(self.registered), "first_name" : "Flow", "last_name" : "Benchmark",
+            "email" : "flow@example.com", "phone" : "0400 000 000", "role" : self.role.pk,
+            "emergencyname" : "Contact", "emergencyphone" : "0400 111 111", "relationship" : "Family",
+            "password" : PASSWORD, "password_chk" : PASSWORD
+        }, 302)
+
+    def login(self, n:int, team:int):
+        return (Client(), "post", "/login", {"username" : self.visitor.username, "password" : PASSWORD}, 302)
+
+    def newvisit(self, n:int, team:int):
+        return (self.visitorclient, "post", "/newvisit/gingin", self.dayvisit(), 302)
+
+    def teamnewvisit(self, n:int, team:int):
+        data = {"form-TOTAL_FORMS" : str(team), "form-INITIAL_FORMS" : "0"}
+        for i in range(team):
+            data.update({"form-{}-team_{}".format(i, field) : value for (field, value) in {
+                "first_name" : "Member", "last_name" : str(i), "email" : "member@example.com", "phone" : "0400 000 000",
+                "role" : self.role.pk, "emergencyname" : "Contact", "emergencyphone" : "0400 111 111",
+                "relationship" : "Family"}.items()})
+        data.update(self.dayvisit())
+        return (self.visitorclient, "post", "/teamtransitionpage/{}/gingin".format(team), data, 302)
+
+    def changedetails(self, n:int, team:int):
+        return (self.visitorclient, "post", "/changedetails", {"phone" : "0400 {:06d}".format(n)}, 302)
+
+    def admin_ridgefieldvisits(self, n:int, team:int):
+        return (self.adminclient, "get", "/admin/visitorsite/ridgefieldvisit/", None, 200)
+
+    def admin_visits(self, n:int, team:int):
+        return (self.adminclient, "get", "/admin/visitorsite/visit/", None, 200)
+
+    def admin_visitors(self, n:int, team:int):
+        return (self.adminclient, "get", "/admin/visitorsite/visitor/", None, 200)
+    # ============================================================
+
+    def setup_users(self):
+        self.role = seeding.seed_roles([name for (name, weight) in seeding.DEMOROLES])[0]
+        seeding.seed_accounts(1, PASSWORD, prefix = "flowvisitor")
+        self.visitor = User.objects.get(username = "flowvisitor0")
+        self.visitorclient = Client()
+        self.visitorclient.force_login(self.visitor)
+        admin = User.objects.create_superuser("flowadmin", "admin@example.com", PASSWORD)
+        self.adminclient = Client()
+        self.adminclient.force_login(admin)
+        self.registered = 0
+        self.day = timezone.localdate() + timedelta(days = 3650)
+
+    def seed(self, visits:int):
+        """Adds visits (and visitors) until the database holds the given number of visits."""
+        missing = visits - models.Visit.objects.count()
+        if (missing <= 0): return
+        visitorids = seeding.seed_visitors(max(1, missing // 10))
+        seeding.seed_visits("ridgefield", missing - missing // 2, visitorids)
+        seeding.seed_visits("gingin", missing // 2, visitorids)
+
+    def run(self, scenario:str, dataset:int, team:int, repeat:int):
+        build = getattr(self, scenario)
+        build(0, team) # warm up (template loading, first connection)
+        latencies, queries, sizes, errors = [], [], [], 0
+        for n in range(repeat):
+            (client, method, path, data, expected) = build(n + 1, team)
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = getattr(client, method)(path, data)
+                content = b"".join(response.streaming_content) if (response.streaming) else response.content
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+            sizes.append(len(content))
+            if (response.status_code != expected): errors += 1
+        percentiles = statistics.quantiles(latencies, n = 100, method = "inclusive") if (len(latencies) > 1) else latencies * 99
+        return {
+            "scenario" : scenario, "dataset" : dataset, "team" : team,
+            "p50_ms" : round(percentiles[49], 2), "p95_ms" : round(percentiles[94], 2), "p99_ms" : round(percentiles[98], 2),
+            "queries" : max(queries), "bytes" : round(statistics.mean(sizes)), "errors" : errors
+        }
+
+    def compare(self, results:list, baseline:dict):
+        """Returns the regressions of the results compared to a baseline run."""
+        previous = {(i["scenario"], i["dataset"], i["team"]) : i for i in baseline["results"]}
+        regressions = []
+        for result in results:
+            before = previous.get((result["scenario"], result["dataset"], result["team"]))
+            if (before == None): continue
+            name = "{} ({} visits{})".format(result["scenario"], result["dataset"],
+                                             ", team of {}".format(result["team"]) if (result["team"]) else "")
+            if (result["queries"] > before["queries"]):
+                regressions.append("{}: {} queries instead of {}".format(name, result["queries"], before["queries"]))
+            if (result["p50_ms"] > before["p50_ms"] * (1 + LATENCYTOLERANCE)):
+                regressions.append("{}: p50 {} ms instead of {} ms".format(name, result["p50_ms"], before["p50_ms"]))
+            if (result["errors"] > before["errors"]):
+                regressions.append("{}: {} failed requests".format(name, result["errors"]))
+        return regressions
+
+    def handle(self, *args, **options):
+        setup_test_environment() # lets the test client through ALLOWED_HOSTS and keeps e-mails in memory
+        # every request comes from the same address, so the login and registration limits are lifted
+        override_settings(THROTTLE_RATES = {}).enable()
+        olddatabases = setup_databases(verbosity = 0, interactive = False, keepdb = options["keepdb"])
+        try:
+            self.setup_users()
+            results = []
+            self.stdout.write("{:<24}{:>9}{:>6}{:>10}{:>10}{:>10}{:>9}{:>9}{:>7}".format(
+                "scenario", "visits", "team", "p50 (ms)", "p95 (ms)", "p99 (ms)", "queries", "bytes", "errors"))
+            for dataset in sorted(options["sizes"]):
+                self.seed(dataset)
+                for scenario in options["scenarios"]:
+                    for team in (options["team_sizes"] if (scenario == "teamnewvisit") else [None]):
+                        result = self.run(scenario, dataset, team, options["repeat"])
+                        results.append(result)
+                        self.stdout.write("{scenario:<24}{dataset:>9}{team:>6}{p50_ms:>10}{p95_ms:>10}{p99_ms:>10}"
+                                          "{queries:>9}{bytes:>9}{errors:>7}".format(**dict(result, team = team or "")))
+        finally:
+            teardown_databases(olddatabases, verbosity = 0, keepdb = options["keepdb"])
+
+        report = {
+            "meta" : {"database" : connection.vendor, "django" : django.get_version(),
+                      "python" : platform.python_version(), "date" : date.today().isoformat(),
+                      "repeat" : options["repeat"]},
+            "results" : results
+        }
+        if (options["output"]):
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent = 2)
+        if (options["baseline"]):
+            with open(options["baseline"]) as f:
+                regressions = self.compare(results, json.load(f))
+            for regression in regressions:
+                self.stderr.write(regression)
+            if (regressions):
+                raise CommandError("{} regression(s) compared to {}".format(len(regressions), options["baseline"]))
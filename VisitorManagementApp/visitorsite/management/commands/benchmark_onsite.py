@@ -0,0 +1,73 @@
+"""Compares the "currently on site" queries of the admin page with and without the visit indexes"""
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from visitorsite import models, seeding
+from visitorsite.globals import SITES
+
+
+class Command(BaseCommand):
+    help = ("Times the visit queries of the admin page with the indexes of migration 0002 and without "
+            "them (dropped inside a transaction that is rolled back). Use --seed on a benchmark database "
+            "only, it adds synthetic visits.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--site", choices=SITES.keys(), default="ridgefield")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Number of synthetic visits to add before running the benchmark (e.g. 1000000).")
+        parser.add_argument("--repeat", type=int, default=5,
+                            help="Number of times each query is timed (the median is reported).")
+
+    def queries(self, site:str):
+        visitorm = models.visitmodel(site)
+        now = timezone.now()
+        onsite = visitorm.objects.filter(arrival__lte = now, departure__gte = now) # admin.VisitFilter
+        visitor = models.Visit.objects.order_by("-pk").values_list("visitor_id", flat = True).first()
+        return {
+            "on site count" : lambda: onsite.count(),
+            "on site page" : lambda: list(onsite.order_by("-pk")[:100]),
+            "arrivals this week" : lambda: visitorm.objects.filter(
+                arrival__gte = now - timedelta(days = 7)).count(),
+            "visitor history" : lambda: list(
+                models.Visit.objects.filter(visitor_id = visitor).order_by("-arrival")[:20]),
+        }
+
+    def time(self, query, repeat:int):
+        query() # warm the cache
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            query()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def handle(self, *args, **options):
+        site = options["site"]
+        if (options["seed"]):
+            self.stdout.write("Seeding {} visits...".format(options["seed"]))
+            visitorids = seeding.seed_visitors(max(1, options["seed"] // 10))
+            seeding.seed_visits(site, options["seed"], visitorids)
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE") # refresh the planner statistics for the new rows
+
+        self.stdout.write("{} visits to {} ({})".format(
+            models.visitmodel(site).objects.count(), SITES[site], connection.vendor))
+
+        queries = self.queries(site)
+        indexed = {name : self.time(query, options["repeat"]) for (name, query) in queries.items()}
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for index in models.Visit._meta.indexes:
+                    cursor.execute("DROP INDEX {}".format(connection.ops.quote_name(index.name)))
+            unindexed = {name : self.time(query, options["repeat"]) for (name, query) in queries.items()}
+            transaction.set_rollback(True) # put the indexes back
+
+        self.stdout.write("{:<22}{:>14}{:>14}".format("query", "no index (ms)", "indexed (ms)"))
+        for name in queries.keys():
+            self.stdout.write("{:<22}{:>14.2f}{:>14.2f}".format(name, unindexed[name], indexed[name]))
@@ -0,0 +1,32 @@
+"""Imports visits for large groups from a spreadsheet (see importservice.py)"""
+from django.core.management.base import BaseCommand, CommandError
+
+from visitorsite.globals import SITES
+from visitorsite import importservice
+
+
+class Command(BaseCommand):
+    help = "Imports visits to a site from a CSV or Excel (.xlsx) file with one visit per row."
+
+    def add_arguments(self, parser):
+        parser.add_argument("site", choices=SITES.keys())
+        parser.add_argument("file", help="Spreadsheet with the columns: {}".format(", ".join(importservice.COLUMNS)))
+        parser.add_argument("--chunk-size", type=int, default=importservice.CHUNKSIZE,
+                            help="Number of rows validated and saved at a time.")
+
+    def onerror(self, n, errors):
+        for (field, e) in errors.items():
+            self.stderr.write("Row {}: {}: {}".format(n, field, " ".join(e)))
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["file"], "rb") as f:
+                (imported, failed) = importservice.import_visits(
+                    options["site"],
+                    importservice.read_rows(f, options["file"]),
+                    chunk_size = options["chunk_size"],
+                    onerror = self.onerror
+                )
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            raise CommandError(str(e))
+        self.stdout.write("Imported {} visits, {} rows could not be imported.".format(imported, failed))
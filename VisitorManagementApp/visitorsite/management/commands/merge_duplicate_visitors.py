@@ -0,0 +1,29 @@
+"""Merges visitors without an account registered more than once (see identity.py)"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from visitorsite import identity
+
+
+class Command(BaseCommand):
+    help = ("Merges the visitors without an account that share a name, e-mail address and phone number (team "
+            "members registered again before visitors were recognised). Each person keeps their oldest visitor, "
+            "with all their visits and their latest details. Visitors with an account are never merged.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=identity.BATCHSIZE,
+                            help="People merged per transaction.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the duplicates.")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        keys = list(identity.duplicate_keys())
+        if (options["dry_run"]):
+            self.stdout.write("{} people have duplicate visitors".format(len(keys)))
+            return
+        removed = 0
+        for i in range(0, len(keys), options["batch_size"]):
+            removed += identity.merge_duplicates(keys[i:i + options["batch_size"]])
+        self.stdout.write("Merged {} duplicate visitors of {} people in {:.1f}s".format(
+            removed, len(keys), time.perf_counter() - start))
@@ -0,0 +1,22 @@
+"""Recomputes the daily occupancy of each site from its visits (see rollups.py)"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from visitorsite.globals import SITES
+from visitorsite import rollups
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the daily occupancy shown in the occupancy dashboard from every visit, including archived "
+            "visits. Run it once after upgrading, after importing visits directly into the database, or if the "
+            "counts look wrong. Registering, editing and deleting visits keep the counts up to date otherwise.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sites", nargs="+", choices=SITES.keys(), default=list(SITES.keys()))
+        parser.add_argument("--batch-size", type=int, default=rollups.BATCHSIZE, help="Visits read at a time.")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        written = rollups.rebuild(options["sites"], options["batch_size"])
+        self.stdout.write("Wrote {} daily occupancy rows in {:.1f}s".format(written, time.perf_counter() - start))
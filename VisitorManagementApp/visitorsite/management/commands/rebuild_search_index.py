@@ -0,0 +1,24 @@
+"""Indexes every visitor again for the admin search (databases without pg_trgm only, see search.py)"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from visitorsite import search
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the search index of the visitor and visit admin lists from every visitor. Only needed on "
+            "databases other than PostgreSQL (e.g. SQLite), after changing visitors directly in the database. "
+            "PostgreSQL keeps its trigram indexes up to date itself.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=search.BATCHSIZE, help="Visitors indexed at a time.")
+
+    def handle(self, *args, **options):
+        if (connection.vendor == "postgresql"):
+            self.stdout.write("PostgreSQL searches with its pg_trgm indexes, there is nothing to rebuild.")
+            return
+        start = time.perf_counter()
+        indexed = search.rebuild_index(options["batch_size"])
+        self.stdout.write("Indexed {} visitors in {:.1f}s".format(indexed, time.perf_counter() - start))
@@ -0,0 +1,36 @@
+"""Drains the site manager notification outbox (see emailservice.queue_notification)"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from visitorsite.emailservice import send_queued_notifications
+
+
+class Command(BaseCommand):
+    help = "Sends queued site manager notifications, retrying failed e-mails with backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Number of notifications claimed from the outbox at a time.")
+        parser.add_argument("--threads", type=int, default=4,
+                            help="Number of threads sending e-mail, each with its own mail server connection.")
+        parser.add_argument("--interval", type=float, default=5,
+                            help="Seconds to wait before polling again when the outbox is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Drain everything that is currently due and exit.")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Notification worker started.")
+        try:
+            while True:
+                close_old_connections() # the worker is long lived, do not hold on to broken connections
+                sent = send_queued_notifications(options["batch_size"], options["threads"])
+                if (sent):
+                    self.stdout.write("Sent {} notification(s).".format(sent))
+                    continue # there may be more due, do not sleep
+                if (options["once"]): break
+                time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write("Notification worker stopped.")
@@ -0,0 +1,58 @@
+"""Fills a database with realistic synthetic visitors and visits for load testing"""
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from visitorsite import seeding, rollups
+from visitorsite.globals import SITES
+
+
+class Command(BaseCommand):
+    help = ("Generates roles, visitors (some with user accounts), emergency contacts and visits to every "
+            "site with realistic dates. Use it on a benchmark database only, never on real data.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--visitors", type=int, default=10000, help="Number of visitors to create.")
+        parser.add_argument("--accounts", type=int, default=None,
+                            help="Number of visitors with a user account (default: one in ten).")
+        parser.add_argument("--password", default="demo-password", help="Password of the demo accounts.")
+        parser.add_argument("--visits", type=int, default=100000,
+                            help="Number of visits to create, split evenly between the sites.")
+        parser.add_argument("--sites", nargs="+", choices=SITES.keys(), default=list(SITES.keys()))
+        parser.add_argument("--days", type=int, default=3 * 365, help="Days of visit history to generate.")
+        parser.add_argument("--processes", type=int, default=1,
+                            help="Number of processes generating visits (PostgreSQL only, SQLite allows one writer).")
+        parser.add_argument("--batch-size", type=int, default=seeding.BATCHSIZE, help="Rows per INSERT.")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed, to generate the same data again.")
+
+    def handle(self, *args, **options):
+        if (options["processes"] > 1 and connection.vendor == "sqlite"):
+            raise CommandError("SQLite only allows one writer at a time, use --processes 1.")
+        rng = random.Random(options["seed"])
+        accounts = options["visitors"] // 10 if (options["accounts"] == None) else options["accounts"]
+        start = time.perf_counter()
+
+        roles = seeding.seed_roles([name for (name, weight) in seeding.DEMOROLES])
+        # weighted choice: repeat each role by its weight
+        weights = dict(seeding.DEMOROLES)
+        roles = [role for role in roles for i in range(weights[role.name])]
+        visitorids = seeding.seed_visitors(options["visitors"], rng, options["batch_size"], roles = roles,
+                                           accounts = accounts, password = options["password"])
+        self.stdout.write("Created {} visitors ({} with an account) in {:.1f}s".format(
+            len(visitorids), min(accounts, len(visitorids)), time.perf_counter() - start))
+
+        sites = options["sites"]
+        for (i, site) in enumerate(sites):
+            n = options["visits"] // len(sites) + (1 if (i < options["visits"] % len(sites)) else 0)
+            sitestart = time.perf_counter()
+            seeding.seed_visits_parallel(site, n, visitorids, options["days"], options["processes"],
+                                         rng.randrange(2 ** 32), options["batch_size"])
+            self.stdout.write("Created {} visits to {} in {:.1f}s".format(n, SITES[site], time.perf_counter() - sitestart))
+
+        # the visits were inserted in bulk, without updating the daily occupancy
+        rollups.rebuild(sites)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE") # refresh the planner statistics for the new rows
+        self.stdout.write("Done in {:.1f}s".format(time.perf_counter() - start))
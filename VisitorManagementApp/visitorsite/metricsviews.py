@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_safe
+
+from . import instrumentation
+
+# ------------------------------------------------------------
+"""Request timings, query counts and response codes per URL pattern (see instrumentation.py) in the
+Prometheus text format. Readable by site managers and by the addresses in METRICS_ALLOWED_IPS
+(the monitoring server scraping it)."""
+@require_safe
+@never_cache
+def metrics(request):
+    allowed = request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+    if (not allowed and not request.user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(instrumentation.render(), content_type = "text/plain; version=0.0.4; charset=utf-8")
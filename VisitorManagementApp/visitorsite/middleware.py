@@ -0,0 +1,22 @@
+"""Seperate module giving every request the Visitor profile of its user (request.visitor)"""
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+
+from visitorsite import models
+
+def get_visitor(request):
+    """
+    Loads the Visitor of the logged in user with its role and emergency contact (one query).
+    Raises Visitor.DoesNotExist for anonymous users and site managers, like Visitor.objects.get.
+    """
+    if (not request.user.is_authenticated): raise models.Visitor.DoesNotExist
+    return models.Visitor.objects.select_related("role", "emergencycontact").get(user = request.user)
+
+class VisitorMiddleware(MiddlewareMixin):
+    """
+    Sets request.visitor, loaded on first use and then shared by every view and function handling
+    the request, so a request never looks up its visitor more than once. Must come after
+    AuthenticationMiddleware. Async views load it with views.loadVisitor.
+    """
+    def process_request(self, request):
+        request.visitor = SimpleLazyObject(lambda: get_visitor(request))
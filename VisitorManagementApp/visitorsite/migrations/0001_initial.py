@@ -0,0 +1,106 @@
+# Generated by Django 4.1 on 2026-10-18 14:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmergencyContact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('phone', models.TextField()),
+                ('relationship', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QueuedNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site', models.TextField()),
+                ('visit_id', models.BigIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Role',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SiteEmergencyContact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('phone', models.TextField()),
+                ('site', models.TextField()),
+                ('position', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Visit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('arrival', models.DateTimeField()),
+                ('departure', models.DateTimeField()),
+                ('induction', models.BooleanField()),
+                ('houserules', models.BooleanField()),
+                ('overnight', models.BooleanField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GinginVisit',
+            fields=[
+                ('visit_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='visitorsite.visit')),
+            ],
+            bases=('visitorsite.visit',),
+        ),
+        migrations.CreateModel(
+            name='RidgefieldVisit',
+            fields=[
+                ('visit_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='visitorsite.visit')),
+                ('paddock', models.TextField()),
+            ],
+            bases=('visitorsite.visit',),
+        ),
+        migrations.CreateModel(
+            name='Visitor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_name', models.CharField(blank=True, max_length=150, verbose_name='first name')),
+                ('last_name', models.CharField(blank=True, max_length=150, verbose_name='last name')),
+                ('email', models.EmailField(blank=True, max_length=254, verbose_name='email address')),
+                ('phone_number', models.TextField()),
+                ('emergencycontact', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, to='visitorsite.emergencycontact')),
+                ('role', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visitorsite.role')),
+                ('user', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='visitor',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visitorsite.visitor'),
+        ),
+        migrations.AddIndex(
+            model_name='queuednotification',
+            index=models.Index(fields=['status', 'next_attempt'], name='visitorsite_status_a58c2a_idx'),
+        ),
+    ]
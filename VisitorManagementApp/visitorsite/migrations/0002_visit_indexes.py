@@ -0,0 +1,30 @@
+# Generated by Django 4.1 on 2026-10-18 14:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='role',
+            name='name',
+            field=models.TextField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['arrival', 'departure'], name='visit_arrival_departure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['departure', 'arrival'], name='visit_departure_arrival_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['visitor', 'arrival'], name='visit_visitor_arrival_idx'),
+        ),
+    ]
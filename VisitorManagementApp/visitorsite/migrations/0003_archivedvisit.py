@@ -0,0 +1,42 @@
+# Generated by Django 4.1 on 2026-10-18 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0002_visit_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedVisit',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('site', models.TextField()),
+                ('month', models.DateField()),
+                ('arrival', models.DateTimeField()),
+                ('departure', models.DateTimeField()),
+                ('induction', models.BooleanField()),
+                ('houserules', models.BooleanField()),
+                ('overnight', models.BooleanField()),
+                ('paddock', models.TextField(blank=True)),
+                ('archived', models.DateTimeField(auto_now_add=True)),
+                ('visitor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visitorsite.visitor')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedvisit',
+            index=models.Index(fields=['site', 'month'], name='archivedvisit_site_month_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedvisit',
+            index=models.Index(fields=['site', 'arrival'], name='archivedvisit_site_arrival_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedvisit',
+            index=models.Index(fields=['visitor', 'arrival'], name='archivedvisit_visitor_idx'),
+        ),
+    ]
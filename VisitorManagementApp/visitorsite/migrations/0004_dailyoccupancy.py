@@ -0,0 +1,32 @@
+# Generated by Django 4.1 on 2026-10-18 15:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0003_archivedvisit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyOccupancy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site', models.TextField()),
+                ('day', models.DateField()),
+                ('visitors', models.IntegerField(default=0)),
+                ('overnight', models.IntegerField(default=0)),
+                ('role', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visitorsite.role')),
+            ],
+            options={
+                'verbose_name_plural': 'daily occupancy',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailyoccupancy',
+            constraint=models.UniqueConstraint(fields=('site', 'day', 'role'), name='dailyoccupancy_site_day_role_uniq'),
+        ),
+    ]
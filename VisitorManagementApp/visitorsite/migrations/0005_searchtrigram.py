@@ -0,0 +1,82 @@
+# Generated by Django 4.1 on 2026-10-18 15:30
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# frozen copies of visitorsite/search.py as it was when this migration was written, so later
+# changes to the search do not change what this migration does
+VISITORFIELDS = ("first_name", "last_name", "email", "phone_number")
+CONTACTFIELDS = ("name", "phone")
+
+def _words(text:str):
+    return re.findall(r"[^\W_]+", text.lower())
+
+def trigrams(text:str):
+    pieces = set()
+    for word in _words(text):
+        word = "  " + word + " "
+        pieces.update(word[i:i + 3] for i in range(len(word) - 2))
+    return pieces
+
+TRIGRAMINDEXES = (("visitor", VISITORFIELDS), ("emergencycontact", CONTACTFIELDS))
+
+def _indexes(apps, schema_editor):
+    for (model, fields) in TRIGRAMINDEXES:
+        table = apps.get_model("visitorsite", model)._meta.db_table
+        for field in fields:
+            yield (table, field, "{}_{}_trgm".format(table, field))
+
+def create_search_indexes(apps, schema_editor):
+    """
+    Trigram indexes for the admin search on PostgreSQL (pg_trgm is a trusted extension from
+    PostgreSQL 13, older servers need a superuser to create it). Other databases index the
+    visitors in SearchTrigram instead.
+    """
+    if (schema_editor.connection.vendor == "postgresql"):
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for (table, field, name) in _indexes(apps, schema_editor):
+            schema_editor.execute("CREATE INDEX IF NOT EXISTS {} ON {} USING gin ({} gin_trgm_ops)".format(
+                schema_editor.quote_name(name), schema_editor.quote_name(table), schema_editor.quote_name(field)))
+        return
+    Visitor = apps.get_model("visitorsite", "Visitor")
+    SearchTrigram = apps.get_model("visitorsite", "SearchTrigram")
+    db = schema_editor.connection.alias
+    rows = []
+    for visitor in Visitor.objects.using(db).select_related("emergencycontact").iterator(chunk_size = 2000):
+        values = [getattr(visitor, i) for i in VISITORFIELDS]
+        if (visitor.emergencycontact != None): values += [getattr(visitor.emergencycontact, i) for i in CONTACTFIELDS]
+        rows += [SearchTrigram(visitor_id = visitor.pk, trigram = i) for i in sorted(trigrams(" ".join(j for j in values if (j))))]
+        if (len(rows) >= 2000):
+            SearchTrigram.objects.using(db).bulk_create(rows)
+            rows = []
+    SearchTrigram.objects.using(db).bulk_create(rows)
+
+def drop_search_indexes(apps, schema_editor):
+    if (schema_editor.connection.vendor != "postgresql"): return
+    for (table, field, name) in _indexes(apps, schema_editor):
+        schema_editor.execute("DROP INDEX IF EXISTS {}".format(schema_editor.quote_name(name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0004_dailyoccupancy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('visitor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='visitorsite.visitor')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchtrigram',
+            index=models.Index(fields=['trigram', 'visitor'], name='searchtrigram_trigram_idx'),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
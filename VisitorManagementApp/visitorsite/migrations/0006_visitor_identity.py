@@ -0,0 +1,54 @@
+# Generated by Django 4.1 on 2026-10-18 15:34
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+# frozen copies of visitorsite/identity.py as it was when this migration was written, so later
+# changes to the key do not change what this migration does (0007 moves to the current key)
+def normaliseEmail(x:str):
+    return x[:x.rfind('@') + 1] + x[x.rfind('@') + 1:].lower()
+
+def canonical_phone(phone:str):
+    phone = (phone or "").strip()
+    digits = re.sub(r"\D", "", phone)
+    if (digits == ""): return ""
+    if (phone.startswith("+")): return "+" + digits
+    if (digits.startswith("00")): return "+" + digits[2:]
+    return "+" + settings.PHONE_COUNTRY_CODE + digits.lstrip("0")
+
+def identity_key(email:str, phone:str):
+    email = normaliseEmail((email or "").strip())
+    phone = canonical_phone(phone)
+    if (email == "" or phone == ""): return ""
+    return "{} {}".format(email, phone)
+
+def fill_identity(apps, schema_editor):
+    # existing duplicates keep their rows, manage.py merge_duplicate_visitors merges them
+    Visitor = apps.get_model("visitorsite", "Visitor")
+    db = schema_editor.connection.alias
+    batch = []
+    for visitor in Visitor.objects.using(db).only("email", "phone_number").iterator(chunk_size = 2000):
+        visitor.identity = identity_key(visitor.email, visitor.phone_number)
+        batch.append(visitor)
+        if (len(batch) == 2000):
+            Visitor.objects.using(db).bulk_update(batch, ["identity"])
+            batch = []
+    Visitor.objects.using(db).bulk_update(batch, ["identity"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0005_searchtrigram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitor',
+            name='identity',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=300),
+        ),
+        migrations.RunPython(fill_identity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.1 on 2026-10-18 15:47
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+# frozen copies of visitorsite/identity.py as it was when this migration was written: the key
+# now includes the names, so siblings sharing a parent's contact details are told apart
+def normaliseEmail(x:str):
+    return x[:x.rfind('@') + 1] + x[x.rfind('@') + 1:].lower()
+
+def canonical_phone(phone:str):
+    phone = (phone or "").strip()
+    digits = re.sub(r"\D", "", phone)
+    if (digits == ""): return ""
+    if (phone.startswith("+")): return "+" + digits
+    if (digits.startswith("00")): return "+" + digits[2:]
+    return "+" + settings.PHONE_COUNTRY_CODE + digits.lstrip("0")
+
+def _name(name:str):
+    return " ".join((name or "").split()).casefold()
+
+def identity_key(email:str, phone:str, first_name:str, last_name:str):
+    email = normaliseEmail((email or "").strip())
+    phone = canonical_phone(phone)
+    if (email == "" or phone == ""): return ""
+    return "|".join([email, phone, _name(first_name), _name(last_name)])
+
+def fill_identity(apps, schema_editor):
+    Visitor = apps.get_model("visitorsite", "Visitor")
+    db = schema_editor.connection.alias
+    batch = []
+    for visitor in Visitor.objects.using(db).only("first_name", "last_name", "email", "phone_number").iterator(chunk_size = 2000):
+        visitor.identity = identity_key(visitor.email, visitor.phone_number, visitor.first_name, visitor.last_name)
+        batch.append(visitor)
+        if (len(batch) == 2000):
+            Visitor.objects.using(db).bulk_update(batch, ["identity"])
+            batch = []
+    Visitor.objects.using(db).bulk_update(batch, ["identity"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0006_visitor_identity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='visitor',
+            name='identity',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=600),
+        ),
+        migrations.RunPython(fill_identity, migrations.RunPython.noop),
+    ]
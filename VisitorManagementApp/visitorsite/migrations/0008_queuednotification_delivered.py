@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 15:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0007_identity_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuednotification',
+            name='delivered',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0008_queuednotification_delivered'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['arrival', 'id'], name='visit_arrival_id_idx'),
+        ),
+    ]
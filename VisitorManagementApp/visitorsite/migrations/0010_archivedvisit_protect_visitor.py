@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-18 16:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visitorsite', '0009_visit_arrival_id_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedvisit',
+            name='visitor',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='visitorsite.visitor'),
+        ),
+    ]
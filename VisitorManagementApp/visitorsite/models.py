@@ -1,12 +1,13 @@
 from django.db import models
 from django.contrib.auth.models import User # bind to Django user for ease of maintenace
 from django.contrib import admin
+from django.utils import timezone
 
 # Note: verbose_name will be the label of the form if modelForm is used
 # ids are created by Django
 
 class Role(models.Model):
-    name = models.TextField()
+    name = models.TextField(db_index=True) # looked up by name on every registration
     def __str__(self): return self.name
 
 class EmergencyContact(models.Model):
@@ -27,6 +28,9 @@ class Visitor(models.Model):
     phone_number = models.TextField()
     role = models.ForeignKey(Role, on_delete=models.CASCADE)
     emergencycontact = models.OneToOneField(EmergencyContact, on_delete=models.CASCADE, null=True)
+    # normalised e-mail address, E.164 phone number and names, so a team member registered again
+    # without an account reuses their visitor (see visitorsite/identity.py)
+    identity = models.CharField(max_length=600, blank=True, default="", db_index=True)
     def __str__(self): return self.user.username if (self.user != None) else "<Unregistered>"
 
     def visitor(self):
@@ -83,6 +87,20 @@ class Visit(models.Model):
     induction = models.BooleanField()
     houserules = models.BooleanField()
     overnight = models.BooleanField()
+
+    class Meta:
+        indexes = [
+            # arrival/departure filters and ordering of the admin page
+            models.Index(fields=["arrival", "departure"], name="visit_arrival_departure_idx"),
+            # "currently on site" (arrival <= now <= departure): few visits depart in the future,
+            # so departure is the selective column and comes first
+            models.Index(fields=["departure", "arrival"], name="visit_departure_arrival_idx"),
+            # visit history of a visitor
+            models.Index(fields=["visitor", "arrival"], name="visit_visitor_arrival_idx"),
+            # keyset pages of the admin lists (newest arrivals first, see adminpagination.py); the
+            # site lists order by visit_ptr, which is this id
+            models.Index(fields=["arrival", "id"], name="visit_arrival_id_idx"),
+        ]
     
     # the first two fields are just stubs for now
     def name(self):
@@ -111,9 +129,117 @@ class RidgefieldVisit(Visit):
 
 class GinginVisit(Visit): pass # adds no fields
 
+def visitmodel(site:str):
+    """Returns the Visit-derived model that stores the visits of a site in globals.SITES"""
+    if (site == "ridgefield"): return RidgefieldVisit
+    if (site == "gingin"): return GinginVisit
+    # back-end developer hired by the client might not have done their job
+    raise ValueError("{} could not be converted into a Visit-derived model (did you forget to make it)?".format(site))
+
+class ArchivedVisit(models.Model):
+    """
+        ArchivedVisit holds the visits of every site that ended before the retention window
+        (manage.py archive_visits moves them here), so the visit tables only hold recent visits.
+        Archived visits keep their visit id and are read-only; they are read for audits
+        through the archived visits admin page and the export (see visitorsite/archive.py).
+    """
+    id = models.BigIntegerField(primary_key=True) # id of the visit before it was archived
+    site = models.TextField()
+    # first day of the month of arrival: archived visits are read and exported month by month
+    month = models.DateField()
+    # a visitor with archived visits cannot be deleted, so the audit trail stays complete
+    visitor = models.ForeignKey(Visitor, on_delete=models.PROTECT)
+    arrival = models.DateTimeField()
+    departure = models.DateTimeField()
+
+    induction = models.BooleanField()
+    houserules = models.BooleanField()
+    overnight = models.BooleanField()
+    paddock = models.TextField(blank=True) # only Ridgefield has paddocks
+
+    archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["site", "month"], name="archivedvisit_site_month_idx"),
+            models.Index(fields=["site", "arrival"], name="archivedvisit_site_arrival_idx"),
+            models.Index(fields=["visitor", "arrival"], name="archivedvisit_visitor_idx"),
+        ]
+
+    def __str__(self): return "{} visit {} (archived)".format(self.site, self.pk)
+
+class DailyOccupancy(models.Model):
+    """
+        DailyOccupancy counts, for each site, day and role, the visits on site that day and the
+        overnight visits staying that night. The rows are kept up to date as visits are
+        registered, edited and deleted (see visitorsite/rollups.py), so the occupancy dashboard
+        never reads the visit tables. manage.py rebuild_rollups recomputes them from the visits.
+    """
+    site = models.TextField()
+    day = models.DateField()
+    role = models.ForeignKey(Role, on_delete=models.CASCADE)
+    visitors = models.IntegerField(default=0)
+    overnight = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["site", "day", "role"], name="dailyoccupancy_site_day_role_uniq"),
+        ]
+        verbose_name_plural = "daily occupancy"
+
+    def __str__(self): return "{} {} {}".format(self.site, self.day, self.role)
+
+class SearchTrigram(models.Model):
+    """
+        SearchTrigram is one three-letter piece (trigram) of a visitor's name, e-mail, phone
+        number or emergency contact. It is the search index of the admin lists on databases
+        without pg_trgm (e.g. SQLite); on PostgreSQL the columns have trigram indexes instead
+        and this table stays empty (see visitorsite/search.py).
+    """
+    visitor = models.ForeignKey(Visitor, on_delete=models.CASCADE)
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["trigram", "visitor"], name="searchtrigram_trigram_idx"),
+        ]
+
 class SiteEmergencyContact(models.Model):
     name = models.TextField()
     phone = models.TextField()
     site = models.TextField()
     position = models.TextField()
-    def __str__(self): return self.name
\ No newline at end of file
+    def __str__(self): return self.name
+
+class QueuedNotification(models.Model):
+    """
+        QueuedNotification is a row in the outbox of site manager e-mail notifications.
+        Registering a visit only inserts one of these; the e-mail itself is rendered and
+        sent by the notification worker (manage.py run_notification_worker) so that the
+        request thread never waits on the SMTP server.
+    """
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed")]
+
+    # visits are stored in a different table for each site, so the site name is used
+    # to resolve which Visit-derived model visit_id refers to
+    site = models.TextField()
+    visit_id = models.BigIntegerField()
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # the site managers a digest including this visit was already sent to, so a retry
+    # only goes to the ones it failed for
+    delivered = models.JSONField(default=list, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt"])]
+
+    def __str__(self): return "{} visit {} ({})".format(self.site, self.visit_id, self.status)
@@ -0,0 +1,103 @@
+"""Seperate module for the live list of visitors currently on each site (for emergency wardens)"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Min
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from visitorsite import models
+from visitorsite.globals import SITES
+
+CACHEKEY = "occupancy:{site}"
+
+def _cache():
+    return caches[settings.OCCUPANCY_CACHE]
+
+def _occupant(visit:models.Visit):
+    visitor = visit.visitor
+    ec = visitor.emergencycontact
+    return {
+        "name" : "{} {}".format(visitor.first_name, visitor.last_name),
+        "phone" : visitor.phone_number,
+        "role" : visitor.role.name,
+        "arrival" : visit.arrival.isoformat(),
+        "departure" : visit.departure.isoformat(),
+        "overnight" : visit.overnight,
+        "paddock" : getattr(visit, "paddock", None), # only Ridgefield has paddocks
+        "emergencycontact" : None if (ec == None) else {
+            "name" : ec.name,
+            "phone" : ec.phone,
+            "relationship" : ec.relationship
+        }
+    }
+
+def _compute(site:str, now):
+    """Returns the occupancy of a site and the time at which it changes without any visit being edited."""
+    visitorm = models.visitmodel(site)
+    visits = list(
+        visitorm.objects
+        .filter(arrival__lte = now, departure__gte = now)
+        .select_related("visitor__role", "visitor__emergencycontact")
+        .order_by("arrival", "pk")
+    )
+    # the list changes when the next visitor arrives or the first current visitor leaves
+    nextarrival = visitorm.objects.filter(arrival__gt = now).aggregate(next = Min("arrival"))["next"]
+    changes = [i for i in [nextarrival] + [visit.departure for visit in visits] if (i != None)]
+    occupancy = {
+        "site" : site,
+        "name" : SITES[site],
+        "generated" : now.isoformat(),
+        "count" : len(visits),
+        "occupants" : [_occupant(visit) for visit in visits]
+    }
+    return (occupancy, min(changes) if (len(changes) != 0) else None)
+
+def current_occupants(site:str):
+    """
+    Returns everyone currently on a site. The result is cached until a visit, visitor or emergency
+    contact changes, or until the next arrival or departure, so polling costs no database work.
+    """
+    if (site not in SITES):
+        raise ValueError("{} is not a site".format(site))
+    key = CACHEKEY.format(site = site)
+    occupancy = _cache().get(key)
+    if (occupancy == None):
+        now = timezone.now()
+        (occupancy, changes) = _compute(site, now)
+        timeout = settings.OCCUPANCY_MAX_AGE
+        if (changes != None):
+            # departures are inclusive (departure >= now), so expire just after the change
+            timeout = min(timeout, max(1, (changes - now + timedelta(seconds = 1)).total_seconds()))
+        _cache().set(key, occupancy, timeout)
+    return occupancy
+
+def invalidate(site:str = None):
+    """Drops the cached occupancy of a site (or every site) once the current transaction commits."""
+    keys = [CACHEKEY.format(site = i) for i in (SITES.keys() if (site == None) else [site])]
+    # invalidating before the commit would let a concurrent request cache the old rows again
+    transaction.on_commit(lambda: _cache().delete_many(keys))
+
+# visits saved or deleted one by one (e.g. in the admin page), including the details shown for
+# each occupant. Visits created in bulk by registerNewVisit do not send signals and call
+# invalidate themselves.
+@receiver(post_save, sender = models.RidgefieldVisit)
+@receiver(post_delete, sender = models.RidgefieldVisit)
+def _ridgefieldvisitchanged(sender, **kwargs): invalidate("ridgefield")
+
+@receiver(post_save, sender = models.GinginVisit)
+@receiver(post_delete, sender = models.GinginVisit)
+def _ginginvisitchanged(sender, **kwargs): invalidate("gingin")
+
+@receiver(post_save, sender = models.Visit)
+@receiver(post_delete, sender = models.Visit)
+@receiver(post_save, sender = models.Visitor)
+@receiver(post_delete, sender = models.Visitor)
+@receiver(post_save, sender = models.EmergencyContact)
+@receiver(post_delete, sender = models.EmergencyContact)
+@receiver(post_save, sender = models.Role)
+@receiver(post_delete, sender = models.Role)
+def _occupantchanged(sender, **kwargs): invalidate()
@@ -0,0 +1,101 @@
+"""Seperate module for caching whole public pages (e.g. the site contacts linked from the gate QR codes)"""
+import asyncio
+import time
+from functools import wraps
+from hashlib import md5
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
+from django.utils.http import http_date
+
+from visitorsite import models
+
+CACHEKEY = "page:{page}:{state}"
+# pages look different when logged in (navigation links) or redirect site managers elsewhere
+STATES = ("anonymous", "visitor", "staff")
+
+def _cache():
+    return caches[settings.PAGE_CACHE]
+
+def _state(request):
+    if (not request.user.is_authenticated): return "anonymous"
+    return "staff" if (request.user.is_staff) else "visitor"
+
+def _cachekey(request, page:str):
+    """Returns the cache key of a request, or None if the page must be rendered."""
+    if (request.method not in ("GET", "HEAD") or len(messages.get_messages(request)) != 0): return None
+    return CACHEKEY.format(page = page, state = _state(request))
+
+def _newentry(key:str, response):
+    """Caches a rendered page and returns the cache entry, or None if it cannot be cached."""
+    if (response.status_code != 200 or response.streaming): return None
+    entry = {
+        "content" : response.content,
+        "content_type" : response["Content-Type"],
+        "etag" : quote_etag(md5(response.content).hexdigest()),
+        "last_modified" : int(time.time())
+    }
+    _cache().set(key, entry, settings.PAGE_CACHE_MAX_AGE)
+    return entry
+
+def _respond(request, entry:dict, response = None):
+    conditional = get_conditional_response(request, etag = entry["etag"], last_modified = entry["last_modified"])
+    if (conditional != None):
+        response = conditional
+    elif (response == None):
+        response = HttpResponse(entry["content"], content_type = entry["content_type"])
+    response["ETag"] = entry["etag"]
+    response["Last-Modified"] = http_date(entry["last_modified"])
+    # browsers keep the page but check the ETag every time, which is cheap
+    patch_cache_control(response, private = True, no_cache = True)
+    return response
+
+def cached_page(page:str):
+    """
+    Decorator caching the rendered page of a view (sync or async), separately for anonymous users,
+    visitors and site managers, until invalidate(page) is called. Browsers that already have the
+    page get a 304 Not Modified, so a repeat anonymous request renders no template and runs no
+    query. Only plain GET responses are cached, and pages with flash messages to show are always
+    rendered.
+    """
+    def decorator(view):
+        if (asyncio.iscoroutinefunction(view)):
+            @wraps(view)
+            async def asyncwrapper(request, *args, **kwargs):
+                # the user and flash messages may be loaded from the database
+                key = await sync_to_async(_cachekey)(request, page)
+                if (key == None): return await view(request, *args, **kwargs)
+                entry = await _cache().aget(key)
+                if (entry != None): return _respond(request, entry)
+                response = await view(request, *args, **kwargs)
+                entry = await sync_to_async(_newentry)(key, response)
+                return response if (entry == None) else _respond(request, entry, response)
+            return asyncwrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = _cachekey(request, page)
+            if (key == None): return view(request, *args, **kwargs)
+            entry = _cache().get(key)
+            if (entry != None): return _respond(request, entry)
+            response = view(request, *args, **kwargs)
+            entry = _newentry(key, response)
+            return response if (entry == None) else _respond(request, entry, response)
+        return wrapper
+    return decorator
+
+def invalidate(page:str):
+    """Drops the cached versions of a page once the current transaction commits."""
+    keys = [CACHEKEY.format(page = page, state = i) for i in STATES]
+    transaction.on_commit(lambda: _cache().delete_many(keys))
+
+@receiver(post_save, sender = models.SiteEmergencyContact)
+@receiver(post_delete, sender = models.SiteEmergencyContact)
+def _sitecontactchanged(sender, **kwargs): invalidate("sitecontacts")
@@ -0,0 +1,63 @@
+"""Seperate module changing a visitor's details (names, e-mail address, phone number and role)"""
+from django.db import transaction
+
+# field of VisitorProfileFieldsChangeForm: (User attribute, Visitor attribute), None if not on that model
+FIELDS = {
+    "first_name" : ("first_name", "first_name"),
+    "last_name" : ("last_name", "last_name"),
+    "email" : ("email", "email"),
+    "phone" : (None, "phone_number"),
+    "role" : (None, "role"),
+}
+
+def profile(user, visitor):
+    """The visitor's details, as JSON for the profile API."""
+    return {
+        "username" : user.username,
+        "first_name" : visitor.first_name,
+        "last_name" : visitor.last_name,
+        "email" : visitor.email,
+        "phone" : visitor.phone_number,
+        "role" : visitor.role_id,
+    }
+
+def changed_fields(user, visitor, data:dict):
+    """
+    Returns ({User attribute: value}, {Visitor attribute: value}) for the fields of the cleaned
+    data that are given (blank fields are left unchanged) and differ from the current details.
+    """
+    userchanges = {}
+    visitorchanges = {}
+    for (field, value) in data.items():
+        if (field not in FIELDS or value == "" or value == None): continue
+        (userattr, visitorattr) = FIELDS[field]
+        if (userattr != None and getattr(user, userattr) != value):
+            userchanges[userattr] = value
+        if (visitorattr == "role"):
+            if (visitor.role_id != value.pk): visitorchanges["role"] = value
+        elif (getattr(visitor, visitorattr) != value):
+            visitorchanges[visitorattr] = value
+    return (userchanges, visitorchanges)
+
+def update_profile(user, visitor, data:dict):
+    """
+    Changes the given details of a visitor (the cleaned data of VisitorProfileFieldsChangeForm) and
+    returns the names of the fields that changed. The user and the visitor are written in one
+    transaction, each with one UPDATE of the changed columns only (no query at all if nothing
+    changed). The search index and daily occupancy follow after the commit (see search.py and
+    rollups.py).
+    """
+    (userchanges, visitorchanges) = changed_fields(user, visitor, data)
+    if (not userchanges and not visitorchanges): return []
+    for (attr, value) in userchanges.items():
+        setattr(user, attr, value)
+    for (attr, value) in visitorchanges.items():
+        setattr(visitor, attr, value)
+    with transaction.atomic():
+        if (userchanges): user.save(update_fields = list(userchanges))
+        if (visitorchanges):
+            # the identity key (see identity.py) follows the names, e-mail address and phone number
+            keyfields = ["identity"] if (set(visitorchanges) & {"first_name", "last_name", "email", "phone_number"}) else []
+            visitor.save(update_fields = list(visitorchanges) + keyfields)
+    return [field for (field, (userattr, visitorattr)) in FIELDS.items()
+            if (userattr in userchanges or visitorattr in visitorchanges)]
@@ -0,0 +1,55 @@
+"""Seperate module keeping the e-mail addresses of each group of users (e.g. site managers) in the cache"""
+from django.conf import settings
+from django.contrib.auth.models import User, Group
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+CACHEKEY = "recipients:{group}"
+# bumped to drop every cached group at once, without knowing which groups are cached
+VERSIONKEY = "recipients:version"
+
+def _cache():
+    return caches[settings.RECIPIENTS_CACHE]
+
+def group_emails(group:str):
+    """
+    Returns the e-mail addresses of the users in a group. The list is cached until the group's
+    members or their e-mail addresses change, so sending a notification usually does not query
+    the user tables at all. Any kind of notification can use this.
+    """
+    version = _cache().get_or_set(VERSIONKEY, 1, None)
+    key = CACHEKEY.format(group = group)
+    emails = _cache().get(key, version = version)
+    if (emails == None):
+        emails = [i for i in User.objects.filter(groups__name = group).values_list("email", flat = True) if (i)]
+        # the timeout bounds how long another process may keep an old list when the cache is not
+        # shared between processes (see CACHES in settings.py)
+        _cache().set(key, emails, settings.RECIPIENTS_MAX_AGE, version = version)
+    return emails
+
+def site_manager_emails(site:str):
+    # Site name should be capitalized since all groups in this application start with a capital letter
+    return group_emails(site.capitalize())
+
+def invalidate():
+    """Drops every cached group once the current transaction commits."""
+    def bump():
+        try: _cache().incr(VERSIONKEY)
+        except ValueError: pass # nothing was cached yet
+    transaction.on_commit(bump)
+
+@receiver(m2m_changed, sender = User.groups.through)
+def _membershipchanged(sender, action, **kwargs):
+    if (action in ("post_add", "post_remove", "post_clear")): invalidate()
+
+@receiver(post_save, sender = User)
+def _userchanged(sender, update_fields = None, **kwargs):
+    # logging in saves last_login only, which does not change any address
+    if (update_fields == None or "email" in update_fields): invalidate()
+
+@receiver(post_delete, sender = User)
+@receiver(post_save, sender = Group)
+@receiver(post_delete, sender = Group)
+def _groupchanged(sender, **kwargs): invalidate()
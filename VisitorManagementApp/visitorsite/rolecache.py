@@ -0,0 +1,49 @@
+"""Seperate module keeping the role catalogue (every Role) in the cache for the forms and registration"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from visitorsite import models
+
+CACHEKEY = "roles"
+
+def _cache():
+    return caches[settings.ROLES_CACHE]
+
+def roles():
+    """
+    Every role, in the order of Role.objects.all() (by id). The list is cached until a role is
+    added, renamed or deleted, so the role fields of the forms (one per team member) and
+    registration read it without querying the database.
+    """
+    catalogue = _cache().get(CACHEKEY)
+    if (catalogue == None):
+        catalogue = list(models.Role.objects.order_by("pk"))
+        _cache().set(CACHEKEY, catalogue, settings.ROLES_MAX_AGE)
+    return catalogue
+
+def by_pk(pk):
+    """The role with this id (as given in a form, so possibly a string), or None."""
+    for role in roles():
+        if (str(role.pk) == str(pk)): return role
+    return None
+
+def by_name(name:str):
+    """The first role with this name, or None (like Role.objects.filter(name = name).first())."""
+    for role in roles():
+        if (role.name == name): return role
+    return None
+
+def invalidate():
+    """
+    Drops the cached roles now and again once the current transaction commits (a concurrent
+    request may cache the old rows in between).
+    """
+    _cache().delete(CACHEKEY)
+    transaction.on_commit(lambda: _cache().delete(CACHEKEY))
+
+@receiver(post_save, sender = models.Role)
+@receiver(post_delete, sender = models.Role)
+def _rolechanged(sender, **kwargs): invalidate()
@@ -0,0 +1,219 @@
+"""Seperate module keeping the daily occupancy of each site (DailyOccupancy) up to date as visits change"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Sum, Value, When
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from visitorsite import models
+from visitorsite.globals import SITES
+
+BATCHSIZE = 5000
+PERIODS = {
+    "day" : None,
+    "week" : TruncWeek,
+    "month" : TruncMonth,
+}
+
+# set while visits are removed without leaving the site's history (see archive.py)
+_paused = ContextVar("rollupspaused", default = False)
+
+@contextmanager
+def paused():
+    """Visits saved or deleted in this block do not change the daily occupancy."""
+    token = _paused.set(True)
+    try:
+        yield
+    finally:
+        _paused.reset(token)
+
+# COUNTING
+# ============================================================
+def visit_days(arrival, departure, overnight:bool):
+    """
+    Yields (day, staying the night) for each day a visit is on site, in the server's time zone.
+    An overnight visit stays every night from its arrival day to the night before it departs.
+    """
+    return _days(timezone.localtime(arrival).date(), timezone.localtime(departure).date(), overnight)
+
+def _days(first, last, overnight:bool):
+    day = first
+    while (day <= last):
+        yield (day, overnight and (day < last or day == first))
+        day += timedelta(days = 1)
+
+def _count(rows):
+    """Returns {(day, role id): [visitors, overnight]} for (arrival, departure, overnight, role id) rows."""
+    counts = {}
+    for (arrival, departure, overnight, role) in rows:
+        for (day, night) in visit_days(arrival, departure, overnight):
+            count = counts.setdefault((day, role), [0, 0])
+            count[0] += 1
+            count[1] += 1 if (night) else 0
+    return counts
+
+def _apply(site:str, counts:dict, sign:int = 1):
+    """Adds (or with sign -1 removes) counts to the daily occupancy of a site with two queries."""
+    if (len(counts) == 0): return
+    with transaction.atomic():
+        # rows for new (day, role) pairs, then one UPDATE adding to every pair
+        models.DailyOccupancy.objects.bulk_create([
+            models.DailyOccupancy(site = site, day = day, role_id = role) for (day, role) in counts
+        ], ignore_conflicts = True)
+        change = lambda i: Case(*[
+            When(day = day, role_id = role, then = Value(sign * count[i])) for ((day, role), count) in counts.items()
+        ], default = Value(0), output_field = IntegerField())
+        models.DailyOccupancy.objects.filter(
+            site = site, day__in = set(day for (day, role) in counts), role_id__in = set(role for (day, role) in counts)
+        ).update(visitors = F("visitors") + change(0), overnight = F("overnight") + change(1))
+
+def add_visits(site:str, visits:list, sign:int = 1):
+    """Counts new visits (saved in bulk, so without signals) in the daily occupancy of their site."""
+    if (_paused.get()): return
+    _apply(site, _count((visit.arrival, visit.departure, visit.overnight, visit.visitor.role_id) for visit in visits), sign)
+
+def remove_visits(site:str, visits:list):
+    """Removes visits deleted in bulk (in a paused() block, so without signals) from the daily occupancy."""
+    add_visits(site, visits, -1)
+
+def _moves(counts:dict, rows, changes:dict):
+    # (first day, last day, overnight, visitor, visits) rows: the visits leave the old role for the new one
+    for (first, last, overnight, visitor, n) in rows:
+        for (day, night) in _days(first, last, overnight):
+            for (role, sign) in zip(changes[visitor], (-1, 1)):
+                count = counts.setdefault((day, role), [0, 0])
+                count[0] += sign * n
+                count[1] += sign * n if (night) else 0
+
+def change_roles(changes:dict):
+    """
+    Moves the visits of visitors whose role changed, {visitor id: (old role id, new role id)},
+    from their old role to the new one. Archived visits move too, as rebuild counts every visit
+    under the visitor's current role. Visitors updated in bulk (without signals) must be passed
+    to this before their visits move to another visitor. The database counts the visits per
+    arrival and departure day, so the number of queries (one for the archive, then three per
+    site) stays the same however long the visitors' history is.
+    """
+    changes = {visitor : roles for (visitor, roles) in changes.items() if (roles[0] != roles[1])}
+    if (_paused.get() or len(changes) == 0): return
+    # the days in the server's time zone, as visit_days counts them
+    fields = ("arrival__date", "departure__date", "overnight", "visitor_id")
+    group = lambda visits, *by: (
+        visits.filter(visitor_id__in = changes.keys()).values_list(*by, *fields).annotate(n = Count("pk")).order_by())
+    counts = {site : {} for site in SITES}
+    for (site, *row) in group(models.ArchivedVisit.objects.filter(site__in = SITES.keys()), "site"):
+        _moves(counts[site], [row], changes)
+    for site in SITES:
+        _moves(counts[site], group(models.visitmodel(site).objects), changes)
+        _apply(site, {key : count for (key, count) in counts[site].items() if (count != [0, 0])})
+# ============================================================
+
+# VISITS AND VISITORS SAVED OR DELETED ONE BY ONE (e.g. in the admin page)
+# ============================================================
+def _site(visit):
+    for site in SITES:
+        visitorm = models.visitmodel(site)
+        if (isinstance(visit, visitorm)): return site
+        # a visit edited through the Visit admin page: find the site table it belongs to
+        if (type(visit) == models.Visit and visitorm.objects.filter(pk = visit.pk).exists()): return site
+    return None
+
+def _row(visit):
+    return (visit.arrival, visit.departure, visit.overnight,
+            models.Visitor.objects.filter(pk = visit.visitor_id).values_list("role_id", flat = True).first())
+
+@receiver(pre_save, sender = models.Visit)
+@receiver(pre_save, sender = models.RidgefieldVisit)
+@receiver(pre_save, sender = models.GinginVisit)
+def _visitsaving(sender, instance, raw = False, **kwargs):
+    if (raw or _paused.get() or instance._state.adding): return
+    # the counts of the visit before the edit
+    instance._rollupbefore = models.Visit.objects.filter(pk = instance.pk).values_list(
+        "arrival", "departure", "overnight", "visitor__role_id").first()
+
+@receiver(post_save, sender = models.Visit)
+@receiver(post_save, sender = models.RidgefieldVisit)
+@receiver(post_save, sender = models.GinginVisit)
+def _visitsaved(sender, instance, created, raw = False, **kwargs):
+    if (raw or _paused.get()): return
+    site = _site(instance)
+    if (site == None): return # a Visit without a site
+    before = getattr(instance, "_rollupbefore", None)
+    after = _row(instance)
+    if (before == after): return
+    if (before != None and not created): _apply(site, _count([before]), -1)
+    _apply(site, _count([after]))
+
+# deleting a site's visit deletes its Visit row too, so only the site models are counted here
+@receiver(pre_delete, sender = models.RidgefieldVisit)
+@receiver(pre_delete, sender = models.GinginVisit)
+def _visitdeleted(sender, instance, **kwargs):
+    if (_paused.get()): return
+    _apply(_site(instance), _count([_row(instance)]), -1)
+
+# the role a visitor was loaded (or last saved) with, so a role change is seen without reading
+# the visitor again (unless the role column was deferred)
+@receiver(post_init, sender = models.Visitor)
+def _visitorloaded(sender, instance, **kwargs):
+    instance._rolluprole = instance.__dict__.get("role_id")
+
+@receiver(post_save, sender = models.Visitor)
+def _visitorsaved(sender, instance, created, raw = False, update_fields = None, **kwargs):
+    (before, after) = (instance.__dict__.get("_rolluprole"), instance.__dict__.get("role_id"))
+    instance._rolluprole = after
+    if (raw or created or _paused.get() or before == None or before == after): return
+    if (update_fields != None and not (set(update_fields) & {"role", "role_id"})): return
+    # moved once the save is committed, so saving a visitor only writes the visitor
+    transaction.on_commit(lambda: change_roles({instance.pk : (before, after)}))
+# ============================================================
+
+def rebuild(sites:list = None, batch_size:int = BATCHSIZE):
+    """
+    Recomputes the daily occupancy of the sites from their visits, including archived visits, in
+    one transaction. Returns the number of rows written.
+    """
+    written = 0
+    fields = ("arrival", "departure", "overnight", "visitor__role_id")
+    with transaction.atomic():
+        for site in (sites or SITES.keys()):
+            counts = {}
+            for visits in (models.visitmodel(site).objects, models.ArchivedVisit.objects.filter(site = site)):
+                # the visits are streamed, only the counts are kept in memory
+                for (key, (visitors, overnight)) in _count(visits.values_list(*fields).iterator(chunk_size = batch_size)).items():
+                    count = counts.setdefault(key, [0, 0])
+                    count[0] += visitors
+                    count[1] += overnight
+            models.DailyOccupancy.objects.filter(site = site).delete()
+            models.DailyOccupancy.objects.bulk_create([
+                models.DailyOccupancy(site = site, day = day, role_id = role, visitors = visitors, overnight = overnight)
+                for ((day, role), (visitors, overnight)) in counts.items()
+            ], batch_size = batch_size)
+            written += len(counts)
+    return written
+
+def series(sites:list, start, end, period:str = "day"):
+    """
+    The occupancy of the sites from start to end (dates, inclusive) per day, week or month, as
+    a list of {"period", "visitors", "overnight", "roles" : {role name : visitors}}. Weeks and
+    months add up the daily counts (visitor days and nights).
+    """
+    rows = models.DailyOccupancy.objects.filter(site__in = sites, day__gte = start, day__lte = end)
+    key = PERIODS[period]("day") if (PERIODS[period] != None) else F("day")
+    rows = (
+        rows.annotate(period = key)
+        .values("period", "role__name")
+        .annotate(visitors = Sum("visitors"), overnight = Sum("overnight"))
+        .order_by("period", "role__name")
+    )
+    periods = {}
+    for row in rows:
+        entry = periods.setdefault(row["period"], {"period" : row["period"], "visitors" : 0, "overnight" : 0, "roles" : {}})
+        entry["visitors"] += row["visitors"]
+        entry["overnight"] += row["overnight"]
+        entry["roles"][row["role__name"]] = row["visitors"]
+    return list(periods.values())
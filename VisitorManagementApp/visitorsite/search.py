@@ -0,0 +1,193 @@
+"""Seperate module searching visitors (and their visits) by name, e-mail, phone number and emergency contact"""
+import json
+import math
+import re
+
+from django.db import connections, transaction
+from django.db.models import Count, F, Lookup, Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.text import smart_split, unescape_string_literal
+
+from visitorsite import models
+
+BATCHSIZE = 2000
+VISITORFIELDS = ("first_name", "last_name", "email", "phone_number")
+CONTACTFIELDS = ("name", "phone")
+# the columns searched, from the visitor (search_fields of the admin lists)
+FIELDS = VISITORFIELDS + tuple("emergencycontact__" + i for i in CONTACTFIELDS)
+# the visitor columns (names and attnames) whose change needs the visitor indexed again
+SEARCHED = set(VISITORFIELDS) | {"emergencycontact", "emergencycontact_id"}
+# share of a word's trigrams a visitor must have to match it when it is misspelt
+# (pg_trgm.word_similarity_threshold's default)
+WORD_SIMILARITY = 0.6
+
+def _words(text:str):
+    # pg_trgm splits text into words of letters and digits
+    return re.findall(r"[^\W_]+", text.lower())
+
+def trigrams(text:str, padded:bool = True):
+    """
+    The trigrams of a text, as pg_trgm makes them: each lower-cased word, padded with two spaces
+    in front and one behind, cut into every three-letter piece. Without padding, only the pieces
+    inside the words (the trigrams any text containing the word has).
+    """
+    pieces = set()
+    for word in _words(text):
+        if (padded): word = "  " + word + " "
+        pieces.update(word[i:i + 3] for i in range(len(word) - 2))
+    return pieces
+
+def _postgresql(using:str):
+    return connections[using].vendor == "postgresql"
+
+# POSTGRESQL (pg_trgm GIN indexes, see migrations/0005_searchtrigram.py)
+# ============================================================
+class _ILike(Lookup):
+    # column ILIKE '%word%', which the trigram indexes serve (Django's icontains uses UPPER() and does not)
+    lookup_name = "trigram_icontains"
+
+    def as_sql(self, compiler, connection):
+        (lhs, lhs_params) = self.process_lhs(compiler, connection)
+        (rhs, rhs_params) = self.process_rhs(compiler, connection)
+        rhs_params = ["%{}%".format(connection.ops.prep_for_like_query(i)) for i in rhs_params]
+        return ("{} ILIKE {}".format(lhs, rhs), lhs_params + rhs_params)
+
+class _WordSimilar(Lookup):
+    # column %> 'word': the word is close to a part of the column (pg_trgm's word similarity)
+    lookup_name = "trigram_word_similar"
+
+    def as_sql(self, compiler, connection):
+        (lhs, lhs_params) = self.process_lhs(compiler, connection)
+        (rhs, rhs_params) = self.process_rhs(compiler, connection)
+        return ("{} %%> {}".format(lhs, rhs), lhs_params + rhs_params)
+
+def _pgword(word:str, fields:tuple):
+    condition = Q()
+    for field in fields:
+        condition |= Q(_ILike(F(field), word))
+        if (len(word) >= 3): condition |= Q(_WordSimilar(F(field), word))
+    return condition
+
+def _pgmatch(word:str, using:str):
+    # the matching contacts are looked up first: a join or subquery in the OR would stop
+    # PostgreSQL from combining the indexes of the visitor columns
+    contacts = list(models.EmergencyContact.objects.using(using).filter(_pgword(word, CONTACTFIELDS))
+                    .values_list("pk", flat = True))
+    return _pgword(word, VISITORFIELDS) | Q(emergencycontact_id__in = contacts)
+# ============================================================
+
+# OTHER DATABASES (the SearchTrigram table)
+# ============================================================
+def _icontains(word:str):
+    condition = Q()
+    for field in FIELDS:
+        condition |= Q(**{field + "__icontains" : word})
+    return condition
+
+def _indexmatch(word:str, using:str):
+    inner = trigrams(word, padded = False)
+    if (len(inner) == 0): return _icontains(word) # too short for trigrams, not indexed
+    padded = trigrams(word)
+    rows = models.SearchTrigram.objects.using(using).filter(trigram__in = inner | padded).values("visitor")
+    # visitors with every trigram of the word may contain it (checked with icontains), and
+    # visitors with most of the padded trigrams have a close spelling
+    contains = rows.annotate(n = Count("pk", filter = Q(trigram__in = inner))).filter(n = len(inner)).values("visitor")
+    similar = (rows.annotate(n = Count("pk", filter = Q(trigram__in = padded)))
+               .filter(n__gte = math.ceil(WORD_SIMILARITY * len(padded))).values("visitor"))
+    return Q(pk__in = similar) | (Q(pk__in = contains) & _icontains(word))
+
+def _text(visitor):
+    contact = visitor.emergencycontact
+    values = [getattr(visitor, i) for i in VISITORFIELDS]
+    if (contact != None): values += [getattr(contact, i) for i in CONTACTFIELDS]
+    return " ".join(i for i in values if (i))
+
+def index_visitors(visitors:list, using:str = "default"):
+    """
+    Replaces the search index rows of the visitors. Visitors created in bulk (without post_save)
+    must be indexed with this. Does nothing on PostgreSQL, whose indexes update themselves.
+    """
+    if (_postgresql(using) or len(visitors) == 0): return
+    rows = [(visitor.pk, trigram) for visitor in visitors for trigram in sorted(trigrams(_text(visitor)))]
+    with transaction.atomic(using = using):
+        models.SearchTrigram.objects.using(using).filter(visitor_id__in = [i.pk for i in visitors]).delete()
+        _insert(rows, using)
+
+def _insert(rows:list, using:str):
+    connection = connections[using]
+    if (connection.vendor != "sqlite"):
+        models.SearchTrigram.objects.using(using).bulk_create([
+            models.SearchTrigram(visitor_id = visitor, trigram = trigram) for (visitor, trigram) in rows
+        ], batch_size = BATCHSIZE)
+        return
+    # one INSERT whatever the number of rows (bulk_create needs one per 999 parameters on SQLite),
+    # so registering a team costs the same number of queries at any size
+    table = connection.ops.quote_name(models.SearchTrigram._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {} (visitor_id, trigram) SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') "
+            "FROM json_each(%s)".format(table), [json.dumps(rows)])
+
+def rebuild_index(batch_size:int = BATCHSIZE, using:str = "default"):
+    """Indexes every visitor again and returns the number indexed (0 on PostgreSQL)."""
+    if (_postgresql(using)): return 0
+    visitors = models.Visitor.objects.using(using).select_related("emergencycontact").order_by("pk")
+    indexed = 0
+    with transaction.atomic(using = using):
+        models.SearchTrigram.objects.using(using).all().delete()
+        batch = []
+        for visitor in visitors.iterator(chunk_size = batch_size):
+            batch.append(visitor)
+            if (len(batch) == batch_size):
+                index_visitors(batch, using)
+                indexed += len(batch)
+                batch = []
+        index_visitors(batch, using)
+    return indexed + len(batch)
+
+@receiver(post_save, sender = models.Visitor)
+def _visitorsaved(sender, instance, created, raw = False, update_fields = None, using = "default", **kwargs):
+    if (raw or _postgresql(using)): return
+    # saves of other columns only (e.g. the role) leave the index as it is
+    if (update_fields != None and len(set(update_fields) & SEARCHED) == 0): return
+    if (created):
+        index_visitors([instance], using)
+        return
+    # changed visitors are indexed again once the save is committed, so a profile change only
+    # writes the visitor
+    transaction.on_commit(lambda: index_visitors([instance], using), using = using)
+
+@receiver(post_save, sender = models.EmergencyContact)
+def _contactsaved(sender, instance, created, raw = False, using = "default", **kwargs):
+    # a new contact has no visitor yet, the visitor is indexed when it is saved
+    if (raw or created or _postgresql(using)): return
+    index_visitors(list(models.Visitor.objects.using(using).filter(emergencycontact = instance)), using)
+# ============================================================
+
+def matching_visitors(term:str, using:str = "default"):
+    """
+    The ids of the visitors matching every word of a search term (as a subquery). A word matches
+    a visitor whose name, e-mail, phone number or emergency contact contains it, or has a close
+    spelling of it. Quoted phrases are searched as one word, like the admin's own search.
+    """
+    visitors = models.Visitor.objects.using(using)
+    match = _pgmatch if (_postgresql(using)) else _indexmatch
+    for word in smart_split(term):
+        if (word.startswith(("\"", "'")) and word[0] == word[-1]):
+            word = unescape_string_literal(word)
+        visitors = visitors.filter(match(word, using))
+    return visitors.values("pk")
+
+class VisitorSearchMixin:
+    """
+    ModelAdmin mixin searching with matching_visitors instead of icontains on every column,
+    which reads the whole table. search_visitor is the path from the model to the visitor.
+    """
+    search_visitor = "pk"
+    search_help_text = "Name, e-mail, phone number or emergency contact. Close spellings match too."
+
+    def get_search_results(self, request, queryset, search_term):
+        if (search_term.strip() == ""): return (queryset, False)
+        visitors = matching_visitors(search_term, queryset.db)
+        return (queryset.filter(**{self.search_visitor + "__in" : visitors}), False)
@@ -0,0 +1,181 @@
+"""Generates synthetic visitors and visits for benchmarks (never run this against real data)"""
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.utils import timezone
+
+from visitorsite import models, search, identity, rolecache
+from visitorsite.views import bulkCreateVisits
+
+BATCHSIZE = 5000
+
+# (role, weight) of the demo visitors
+DEMOROLES = [("Researcher", 30), ("Student", 30), ("Staff", 15), ("Contractor", 10), ("Volunteer", 10), ("Visitor", 5)]
+FIRSTNAMES = ["Olivia", "Jack", "Charlotte", "Noah", "Amelia", "William", "Mia", "Oliver", "Ava", "Thomas",
+              "Chloe", "James", "Grace", "Lachlan", "Ruby", "Ethan", "Isla", "Lucas", "Zoe", "Mason"]
+LASTNAMES = ["Smith", "Jones", "Williams", "Brown", "Wilson", "Taylor", "Nguyen", "Johnson", "Martin", "White",
+             "Anderson", "Walker", "Thompson", "Thomas", "Lee", "Ryan", "Harris", "King", "Kelly", "Clarke"]
+RELATIONSHIPS = ["Partner", "Parent", "Sibling", "Friend", "Family"]
+
+def _batches(n:int, size:int):
+    for start in range(0, n, size):
+        yield min(size, n - start)
+
+def seed_roles(names:list):
+    """Creates the roles that do not exist yet and returns all of them."""
+    existing = set(models.Role.objects.filter(name__in = names).values_list("name", flat = True))
+    models.Role.objects.bulk_create([models.Role(name = i) for i in names if (i not in existing)])
+    rolecache.invalidate() # bulk inserts send no post_save
+    return list(models.Role.objects.filter(name__in = names))
+
+def seed_visitors(n:int, rng:random.Random = random, batch_size:int = BATCHSIZE, roles:list = None,
+                  accounts:int = 0, password:str = None, prefix:str = "demo"):
+    """
+    Creates n visitors (with emergency contacts) and returns their ids. Visitors get random names
+    and roles (the Benchmark role if roles is not given). The first `accounts` of them get a user
+    profile named prefix<number> that can log in with the given password.
+    """
+    if (roles == None): roles = [models.Role.objects.get_or_create(name = "Benchmark")[0]]
+    if (accounts):
+        # hashing is slow (on purpose), so every account shares one hash
+        hashed = make_password(password)
+        # numbering continues after the accounts of earlier runs
+        first = User.objects.filter(username__startswith = prefix).count()
+    ids = []
+    created = 0
+    for size in _batches(n, batch_size):
+        names = [(rng.choice(FIRSTNAMES), rng.choice(LASTNAMES)) for i in range(size)]
+        withaccount = max(0, min(size, accounts - created))
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username = "{}{}".format(prefix, first + created + i), password = hashed,
+                     first_name = firstname, last_name = lastname,
+                     email = "{}.{}{}@example.com".format(firstname, lastname, first + created + i).lower())
+                for (i, (firstname, lastname)) in enumerate(names[:withaccount])
+            ])
+            contacts = models.EmergencyContact.objects.bulk_create([
+                models.EmergencyContact(name = "{} {}".format(rng.choice(FIRSTNAMES), lastname),
+                                        phone = "04{:08d}".format(rng.randrange(10 ** 8)),
+                                        relationship = rng.choice(RELATIONSHIPS))
+                for (firstname, lastname) in names
+            ])
+            visitors = [
+                models.Visitor(user = users[i] if (i < len(users)) else None, first_name = firstname, last_name = lastname,
+                               email = users[i].email if (i < len(users)) else "{}.{}@example.com".format(firstname, lastname).lower(),
+                               phone_number = "04{:08d}".format(rng.randrange(10 ** 8)),
+                               role = rng.choice(roles), emergencycontact = contact)
+                for (i, ((firstname, lastname), contact)) in enumerate(zip(names, contacts))
+            ]
+            for visitor in visitors: # bulk inserts skip the pre_save that sets the key
+                visitor.identity = identity.identity_key(visitor.email, visitor.phone_number, visitor.first_name, visitor.last_name)
+            visitors = models.Visitor.objects.bulk_create(visitors)
+            search.index_visitors(visitors)
+            ids.extend(i.pk for i in visitors)
+        created += withaccount
+    return ids
+
+def seed_accounts(n:int, password:str, prefix:str = "benchmark"):
+    """
+    Creates n visitors with a user profile (prefix0, prefix1, ...) that can log in with the given
+    password, or reuses the ones created by an earlier run, and returns their usernames.
+    """
+    role = models.Role.objects.get_or_create(name = "Benchmark")[0]
+    usernames = ["{}{}".format(prefix, i) for i in range(n)]
+    existing = set(User.objects.filter(username__in = usernames).values_list("username", flat = True))
+    hashed = make_password(password) # hashing is slow, so every account shares one hash
+    with transaction.atomic():
+        users = User.objects.bulk_create([
+            User(username = i, password = hashed, first_name = "Visitor", last_name = i, email = "visitor@example.com")
+            for i in usernames if (i not in existing)
+        ])
+        contacts = models.EmergencyContact.objects.bulk_create([
+            models.EmergencyContact(name = "Contact", phone = "0400 000 000", relationship = "Family")
+            for i in users
+        ])
+        search.index_visitors(models.Visitor.objects.bulk_create([
+            models.Visitor(user = user, first_name = user.first_name, last_name = user.last_name, email = user.email,
+                           phone_number = "0400 111 111", role = role, emergencycontact = contact,
+                           identity = identity.identity_key(user.email, "0400 111 111", user.first_name, user.last_name))
+            for (user, contact) in zip(users, contacts)
+        ]))
+    return usernames
+
+def _arrivalday(rng:random.Random, today, days:int):
+    """
+    A random day from `days` days ago to a week ahead. Weekdays are busier than weekends, the
+    Christmas holidays are quiet, and recent days are a little busier (the sites grow).
+    """
+    while True:
+        day = today - timedelta(days = rng.randint(-7, days))
+        weight = (1.0, 1.0, 1.0, 1.0, 0.9, 0.4, 0.2)[day.weekday()]
+        if ((day.month == 12 and day.day > 20) or (day.month == 1 and day.day < 10)): weight *= 0.3
+        weight *= 1 - 0.3 * (today - day).days / max(1, days)
+        if (rng.random() < weight): return day
+
+def _visit(rng:random.Random, today, days:int, tz):
+    """Returns (arrival, departure, overnight) of a random visit."""
+    day = _arrivalday(rng, today, days)
+    # most people arrive in the morning
+    hours = min(14.5, max(6, rng.gauss(8.5, 1.25)))
+    arrival = timezone.make_aware(datetime.combine(day, time()) + timedelta(hours = round(hours * 4) / 4), tz)
+    if (rng.random() < 0.2): # overnight stays end in the morning, one to five nights later
+        departure = timezone.make_aware(datetime.combine(day + timedelta(days = rng.randint(1, 5)), time(10)), tz)
+        return (arrival, departure, True)
+    length = timedelta(hours = round(min(10, max(1, rng.gauss(5, 2))) * 4) / 4)
+    return (arrival, arrival + length, False)
+
+def seed_visits(site:str, n:int, visitorids:list, days:int = 3 * 365, rng:random.Random = random,
+                batch_size:int = BATCHSIZE):
+    """
+    Creates n visits to a site for random visitors. Arrivals are spread over the last `days` days
+    (and a week ahead), mostly on weekday mornings, and about one in five visits is an overnight
+    stay of one to five nights. Visits are not checked for double bookings.
+    """
+    visitorm = models.visitmodel(site)
+    today = timezone.localdate()
+    tz = timezone.get_current_timezone()
+    for size in _batches(n, batch_size):
+        visits = []
+        for i in range(size):
+            (arrival, departure, overnight) = _visit(rng, today, days, tz)
+            kwargs = {
+                "visitor_id" : rng.choice(visitorids),
+                "arrival" : arrival,
+                "departure" : departure,
+                "induction" : overnight,
+                "houserules" : overnight,
+                "overnight" : overnight,
+            }
+            if (site == "ridgefield"): kwargs.update({"paddock": "Paddock {}".format(rng.randint(1, 20)) if (overnight) else ""})
+            visits.append(visitorm(**kwargs))
+        with transaction.atomic():
+            bulkCreateVisits(visitorm, visits, batch_size = batch_size)
+
+def _seed_visits_part(args):
+    (site, n, visitorids, days, seed, batch_size) = args
+    try:
+        seed_visits(site, n, visitorids, days, random.Random(seed), batch_size)
+    finally:
+        connections.close_all()
+    return n
+
+def seed_visits_parallel(site:str, n:int, visitorids:list, days:int = 3 * 365, processes:int = 1,
+                         seed:int = None, batch_size:int = BATCHSIZE):
+    """
+    seed_visits split across a pool of processes, each with its own database connection. Only
+    useful with a database that accepts concurrent writes (PostgreSQL, not SQLite).
+    """
+    rng = random.Random(seed)
+    if (processes <= 1):
+        return seed_visits(site, n, visitorids, days, rng, batch_size)
+    parts = [n // processes + (1 if (i < n % processes) else 0) for i in range(processes)]
+    connections.close_all() # connections must not be shared with the new processes
+    with ProcessPoolExecutor(max_workers = processes, initializer = django.setup) as pool:
+        list(pool.map(_seed_visits_part, [
+            (site, part, visitorids, days, rng.randrange(2 ** 32), batch_size) for part in parts if (part)
+        ]))
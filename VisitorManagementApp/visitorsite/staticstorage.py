@@ -0,0 +1,58 @@
+"""Seperate module for the storage used by collectstatic (hashed file names and compressed copies)"""
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try: # brotli copies are only made if the brotli package is installed
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files that are worth compressing. PDFs are compressed internally already, and are always sent as
+# they are so interrupted downloads can resume (see staticviews)
+COMPRESSIBLE = (".css", ".js", ".html", ".txt", ".svg", ".json", ".xml")
+
+def _gzip(data:bytes):
+    return gzip.compress(data, compresslevel = 9, mtime = 0)
+
+def _brotli(data:bytes):
+    return brotli.compress(data, quality = 11)
+
+# (file extension, Content-Encoding, compressor), in order of preference
+ENCODINGS = [(".br", "br", _brotli)] if (brotli != None) else []
+ENCODINGS += [(".gz", "gzip", _gzip)]
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Adds a hash of the contents to the file names (so they can be cached forever) and writes
+    .gz (and .br if brotli is installed) copies of each file next to it, so visitors on slow
+    connections download compressed files without the server compressing them on every request.
+    """
+    # files that were not collected (e.g. when running the tests without collectstatic) keep their
+    # plain URL instead of raising an error on every page
+    manifest_strict = False
+
+    def url(self, name, force = False):
+        try:
+            return super().url(name, force)
+        except ValueError:
+            return self._url(lambda name: name, name, force)
+
+    def post_process(self, paths, dry_run = False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if (dry_run): return
+        # both the plain and the hashed copy are served (see staticviews)
+        for name in set(self.hashed_files.keys()) | set(self.hashed_files.values()):
+            if (name.lower().endswith(COMPRESSIBLE)):
+                self.compress(name)
+
+    def compress(self, name:str):
+        with self.open(name) as f:
+            data = f.read()
+        for (extension, encoding, compressor) in ENCODINGS:
+            compressed = compressor(data)
+            if (self.exists(name + extension)): self.delete(name + extension)
+            # small files barely shrink, so only keep copies that are clearly smaller
+            if (len(compressed) < len(data) * 0.95):
+                with open(self.path(name + extension), "wb") as f:
+                    f.write(compressed)
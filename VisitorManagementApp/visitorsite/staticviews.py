@@ -0,0 +1,117 @@
+"""Seperate module serving the collected static files (stylesheets, scripts and site PDFs)"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponse, Http404, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from visitorsite.staticstorage import ENCODINGS
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNKSIZE = 64 * 1024
+
+def _acceptedencodings(request):
+    accepted = set()
+    for i in request.headers.get("Accept-Encoding", "").split(","):
+        (encoding, _, params) = i.partition(";")
+        if (re.fullmatch(r"q=0(\.0*)?", params.replace(" ", "")) == None): # q=0 means "not this one"
+            accepted.add(encoding.strip().lower())
+    return accepted
+
+def _compressed(request, fullpath:str):
+    """Returns (path of the file to send, Content-Encoding) for the best copy the browser accepts."""
+    accepted = _acceptedencodings(request)
+    for (extension, encoding, compressor) in ENCODINGS:
+        if (encoding in accepted and os.path.isfile(fullpath + extension)):
+            return (fullpath + extension, encoding)
+    return (fullpath, None)
+
+def _byterange(header:str, size:int):
+    """
+    Returns the (first, last) byte of a Range header, or None to send the whole file (no header or
+    a kind of range that is not supported, e.g. several ranges). Raises ValueError if the range is
+    outside of the file.
+    """
+    match = RANGE.match(header.strip())
+    if (match == None): return None
+    (first, last) = match.groups()
+    if (first == ""):
+        if (last == ""): return None
+        if (int(last) == 0): raise ValueError("empty range")
+        return (max(0, size - int(last)), size - 1) # the last n bytes
+    (first, last) = (int(first), size - 1 if (last == "") else min(size - 1, int(last)))
+    if (first >= size): raise ValueError("range starts after the end of the file")
+    if (first > last): return None
+    return (first, last)
+
+def _readrange(path:str, first:int, last:int):
+    # yields the bytes first to last of the file a chunk at a time, so a large range is not read
+    # into memory at once (the file is closed when the response is)
+    with open(path, "rb") as f:
+        f.seek(first)
+        left = last - first + 1
+        while (left > 0):
+            chunk = f.read(min(CHUNKSIZE, left))
+            if (not chunk): return
+            left -= len(chunk)
+            yield chunk
+
+@require_safe
+def serve(request, path:str):
+    """
+    Serves a file collected by manage.py collectstatic. Files with a hash in their name are cached
+    by browsers forever, compressed copies are sent to browsers that accept them, and Range
+    requests let interrupted PDF downloads resume instead of starting again.
+    """
+    if (settings.STATIC_ROOT == None): raise Http404()
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404()
+    if (not os.path.isfile(fullpath)): raise Http404()
+
+    # byte ranges refer to the file itself, so ranges are always sent uncompressed
+    rangeheader = request.headers.get("Range")
+    (sendpath, encoding) = (fullpath, None) if (rangeheader) else _compressed(request, fullpath)
+    stat = os.stat(sendpath)
+    etag = '"{:x}-{:x}{}"'.format(int(stat.st_mtime), stat.st_size, "-" + encoding if (encoding) else "")
+    contenttype = mimetypes.guess_type(fullpath)[0] or "application/octet-stream"
+
+    response = get_conditional_response(request, etag = etag, last_modified = int(stat.st_mtime))
+    if (response == None):
+        # If-Range: only send part of the file if the browser has the rest of this version
+        ifrange = request.headers.get("If-Range")
+        if (ifrange != None and ifrange not in (etag, http_date(stat.st_mtime))): rangeheader = None
+        try:
+            byterange = None if (rangeheader == None) else _byterange(rangeheader, stat.st_size)
+        except ValueError:
+            response = HttpResponse(status = 416)
+            response["Content-Range"] = "bytes */{}".format(stat.st_size)
+            return response
+
+        if (byterange == None):
+            response = FileResponse(open(sendpath, "rb"), content_type = contenttype, filename = os.path.basename(fullpath))
+        else:
+            (first, last) = byterange
+            response = StreamingHttpResponse(_readrange(sendpath, first, last), status = 206, content_type = contenttype)
+            response["Content-Length"] = last - first + 1
+            response["Content-Range"] = "bytes {}-{}/{}".format(first, last, stat.st_size)
+
+    if (encoding): response["Content-Encoding"] = encoding
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    response["Accept-Ranges"] = "bytes"
+    patch_vary_headers(response, ["Accept-Encoding"])
+    # hashed file names change whenever the contents change, so they never need to be checked again
+    if (path in getattr(staticfiles_storage, "hashed_files", {}).values()):
+        patch_cache_control(response, public = True, max_age = settings.STATIC_MAX_AGE, immutable = True)
+    else:
+        patch_cache_control(response, public = True, max_age = settings.STATIC_UNHASHED_MAX_AGE)
+    return response
@@ -6,6 +6,8 @@ from django.contrib.auth.decorators import login_required
 
 from django.forms import formset_factory
 
+from django.db import transaction
+
 from django.urls import reverse_lazy
 
 from .globals import *
@@ -13,7 +15,9 @@ from .globals import *
 from . import models
 from . import forms
 
-from visitorsite.views import account, registerNewVisitor, registerNewVisit
+from asgiref.sync import sync_to_async
+
+from visitorsite.views import account, registerNewVisitors, registerNewVisit, asyncLoginRequired
 
 # ------------------------------------------------------------
 """First users will be presented with a single numeric field
@@ -48,8 +52,8 @@ def teamtransitionpage(request, n):
     
     return render(request, "transitionpage_team.html", context)    
 
-@login_required
-def teamnewvisit(request, n, site):
+@asyncLoginRequired
+async def teamnewvisit(request, n, site):
     visit = None
     if (site == "ridgefield"):
         visit = forms.RidgefieldVisitForm(request.POST if (request.method == "POST") else None)
@@ -67,7 +71,8 @@ def teamnewvisit(request, n, site):
     if (request.method == "POST"):
         if (not visit.is_valid()): 
             messages.error(request, "Visit form is not valid!")
-        if (not team.is_valid()):
+        # the team forms look up usernames and roles in the database
+        if (not await sync_to_async(team.is_valid)()):
             messages.error(request, "Team personal details form is not valid!")
         if (visit.is_valid() and team.is_valid()):
             
@@ -83,7 +88,7 @@ def teamnewvisit(request, n, site):
                     break
             if (formOK):
                 goOK = True
-                try: _teamnewvisit_internal(request, site, visit, team)
+                try: await sync_to_async(_teamnewvisit_internal)(request, site, visit, team)
                 except ValueError as ve:
                     messages.error(request, "Could not register users: {}".format(str(ve)))
                     goOK = False
@@ -99,48 +104,57 @@ def teamnewvisit(request, n, site):
         "visit_form" : visit,
         "team_form" : team
     }
-    return render(request, "registervisit_team.html", context)
+    # rendering can still read the database (the role catalogue when it is not cached, see
+    # rolecache.py, and the user for the templates), so it runs in a thread
+    return await sync_to_async(render)(request, "registervisit_team.html", context)
 
 def _teamnewvisit_internal(request, site:str, visit:forms, team:list):
+    """
+    Registers the visit for the whole team in one transaction. The team leader is request.visitor,
+    members with an account are resolved with one query, members without one are created with
+    registerNewVisitors, and all the visits (including the team leader's) are inserted and
+    notified with registerNewVisit. The number of queries does not depend on the size of the team.
+    """
     v = visit.cleaned_data
-    visitors = []
-    
-    for i in team:
-        # register the visitors
-        # visitor personal details
-        t = i.cleaned_data
-        # clean function should have verified the users
-
-        user = None
-        if (t["team_username"]):
-            user = User.objects.get(username = t["team_username"])
-            if (not models.Visitor.objects.filter(user = user).first()):
-                # The only time when this is raised is when a site manager is specified as the username
-                # For security reasons, this is not reported to the user.
-                raise ValueError("Could not find a visitor with the name {}!".format(t["team_username"]))
-        # user will be not none if there is a user in the database
-        # create a new visitor if user is none (since users will already have user profiles)
-        if (user == None):
-            visitorFormDict = {
-                "first_name": t["team_first_name"],
-                "last_name": t["team_last_name"],
-                "email" : t["team_email"],
-                "phone": t["team_phone"],
-                "role" : t["team_role"],
-
-                # no passwords
-
-                "emergencyname" : t["team_emergencyname"],
-                "emergencyphone" : t["team_emergencyphone"],
-                "relationship" : t["team_relationship"]
-            }
-            visitors.append(registerNewVisitor(visitorFormDict, userprofile = False))
-        else:
-            member = models.Visitor.objects.get(user = user)
-            visitors.append(member)
-
-        # finally, add the team leader
-        visitors.append(models.Visitor.objects.get(user = request.user))
-        
+    members = [i.cleaned_data for i in team]
+
+    # clean function should have verified the users
+    leader = request.visitor
+    try: leader.pk # loaded on first use
+    except models.Visitor.DoesNotExist: # a site manager
+        raise ValueError("Could not find a visitor with the name {}!".format(request.user.username))
+    usernames = set(t["team_username"] for t in members if (t["team_username"]))
+    existing = {
+        i.user.username : i for i in
+        models.Visitor.objects.filter(user__username__in = usernames).select_related("user")
+    }
+    for username in usernames:
+        if (username not in existing):
+            # The only time when this is raised is when a site manager is specified as the username
+            # For security reasons, this is not reported to the user.
+            raise ValueError("Could not find a visitor with the name {}!".format(username))
+
+    # create new visitors for members without a user profile
+    newMembers = [
+        {
+            "first_name": t["team_first_name"],
+            "last_name": t["team_last_name"],
+            "email" : t["team_email"],
+            "phone": t["team_phone"],
+            "role" : t["team_role"],
+
+            # no passwords
+
+            "emergencyname" : t["team_emergencyname"],
+            "emergencyphone" : t["team_emergencyphone"],
+            "relationship" : t["team_relationship"]
+        }
+        for t in members if (not t["team_username"])
+    ]
+
+    with transaction.atomic():
+        visitors = [leader] + [existing[username] for username in usernames] # the team leader first
+        visitors += registerNewVisitors(newMembers)
+
         # then register the visits
-        registerNewVisit(site, v, visitors)
\ No newline at end of file
+        registerNewVisit(site, v, visitors)
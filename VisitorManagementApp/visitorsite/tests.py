@@ -5,6 +5,8 @@ from visitorsite import models, forms
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password, check_password
 
+import gzip
+import io
 import random
 import string
 
@@ -352,4 +354,1577 @@ class VisitFormTestCaseBasic(TestCase):
         print("Running basic visit test case")
 
     def test_visit_form(self):
-        testVisitForms(self, self.visitForms)
\ No newline at end of file
+        testVisitForms(self, self.visitForms)
+
+# NOTIFICATION OUTBOX TEST CASES
+# =======================================================================
+from datetime import datetime, timedelta
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core import mail
+from django.test import override_settings
+from django.utils import timezone
+from visitorsite import emailservice
+from visitorsite.globals import NOTIFICATION_DIGESTS
+from visitorsite.views import registerNewVisit, registerNewVisitors
+from unittest import skipUnless
+from unittest.mock import patch
+
+def setUpSiteManager(site:str, username:str, email:str):
+    # test transactions never commit, so recipient lists cached by earlier tests are never invalidated
+    cache.clear()
+    group = Group.objects.get_or_create(name = site.capitalize())[0]
+    manager = User.objects.create_user(username = username, email = email, password = "managerpassword")
+    manager.groups.add(group)
+    return manager
+
+def setUpVisitCleanedData(visit:dict):
+    # cleaned_data equivalent of a visit in BASICVISITS
+    return {
+        "arrivaldate" : datetime.strptime(visit["arrivaldate"], "%Y-%m-%d").date(),
+        "arrivaltime" : datetime.strptime(visit["arrivaltime"], "%H:%M").time(),
+        "departuredate" : datetime.strptime(visit["departuredate"], "%Y-%m-%d").date(),
+        "departuretime" : datetime.strptime(visit["departuretime"], "%H:%M").time(),
+        "overnight" : visit["overnight"],
+        "induction" : visit["induction"],
+        "houserules" : visit["houserules"],
+        "paddock" : visit["paddock"] or "",
+    }
+
+class NotificationOutboxTestCase(TestCase):
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        setUpSiteManager("ridgefield", "ridgefieldmanager", "manager@ridgefield.com")
+        self.visitor = models.Visitor.objects.get(user__username = ARI)
+
+    def test_register_only_queues(self):
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[1]), [self.visitor])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(models.QueuedNotification.objects.filter(status = models.QueuedNotification.PENDING).count(), 1)
+
+    def test_worker_sends_queued(self):
+        for visit in BASICVISITS:
+            registerNewVisit("ridgefield", setUpVisitCleanedData(visit), [self.visitor])
+        self.assertEqual(emailservice.send_queued_notifications(batch_size = 10, threads = 2), len(BASICVISITS))
+        self.assertEqual(len(mail.outbox), len(BASICVISITS))
+        self.assertEqual(mail.outbox[0].to, ["manager@ridgefield.com"])
+        self.assertEqual(models.QueuedNotification.objects.filter(status = models.QueuedNotification.SENT).count(), len(BASICVISITS))
+        # nothing left to send
+        self.assertEqual(emailservice.send_queued_notifications(), 0)
+
+    @override_settings(NOTIFICATION_EMAIL_BACKEND = "visitorsite.tests.FailingEmailBackend", NOTIFICATION_MAX_ATTEMPTS = 2)
+    def test_worker_retries_with_backoff(self):
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[0]), [self.visitor])
+        self.assertEqual(emailservice.send_queued_notifications(), 0)
+        notification = models.QueuedNotification.objects.get()
+        self.assertEqual(notification.status, models.QueuedNotification.PENDING)
+        self.assertEqual(notification.attempts, 1)
+        self.assertGreater(notification.next_attempt, timezone.now())
+        self.assertIn("mail server unavailable", notification.last_error)
+
+        # the retry is not due yet
+        self.assertEqual(emailservice.send_queued_notifications(), 0)
+        self.assertEqual(models.QueuedNotification.objects.get().attempts, 1)
+
+        # second failure uses up all attempts
+        models.QueuedNotification.objects.update(next_attempt = timezone.now() - timedelta(seconds = 1))
+        emailservice.send_queued_notifications()
+        self.assertEqual(models.QueuedNotification.objects.get().status, models.QueuedNotification.FAILED)
+
+class NotificationDigestTestCase(TestCase):
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        setUpSiteManager("ridgefield", "ridgefieldmanager", "manager@ridgefield.com")
+        setUpSiteManager("ridgefield", "ridgefieldmanager2", "manager2@ridgefield.com")
+        self.visitors = list(models.Visitor.objects.all())
+
+    @patch.dict(NOTIFICATION_DIGESTS, {"ridgefield" : {"window" : 60 * 60, "threshold" : 3}})
+    def test_digest_threshold(self):
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[0]), self.visitors[:2])
+        # below the threshold and inside the window, so the visits keep waiting
+        self.assertEqual(emailservice.send_queued_notifications(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[0]), self.visitors[2:3])
+        self.assertEqual(emailservice.send_queued_notifications(), 3)
+        # one e-mail per manager, each listing every visitor
+        self.assertEqual(sorted(i.to[0] for i in mail.outbox), ["manager2@ridgefield.com", "manager@ridgefield.com"])
+        for visitor in self.visitors:
+            self.assertIn(visitor.last_name, mail.outbox[0].alternatives[0][0])
+
+    @patch.dict(NOTIFICATION_DIGESTS, {"ridgefield" : {"window" : 60, "threshold" : 100}})
+    def test_digest_window(self):
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[0]), self.visitors[:1])
+        self.assertEqual(emailservice.send_queued_notifications(), 0)
+        models.QueuedNotification.objects.update(created = timezone.now() - timedelta(minutes = 2))
+        self.assertEqual(emailservice.send_queued_notifications(), 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @patch.dict(NOTIFICATION_DIGESTS, {"ridgefield" : {"window" : 60, "threshold" : 2}})
+    def test_digest_retry_only_failed_manager(self):
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[0]), self.visitors[:2])
+        with override_settings(NOTIFICATION_EMAIL_BACKEND = "visitorsite.tests.RefusingEmailBackend"):
+            self.assertEqual(emailservice.send_queued_notifications(), 0)
+        self.assertEqual([i.to for i in mail.outbox], [["manager@ridgefield.com"]])
+        for notification in models.QueuedNotification.objects.all():
+            self.assertEqual(notification.status, models.QueuedNotification.PENDING)
+            self.assertEqual(notification.delivered, ["manager@ridgefield.com"])
+
+        # the retry only goes to the manager it failed for
+        models.QueuedNotification.objects.update(next_attempt = timezone.now() - timedelta(seconds = 1))
+        self.assertEqual(emailservice.send_queued_notifications(), 2)
+        self.assertEqual([i.to for i in mail.outbox], [["manager@ridgefield.com"], ["manager2@ridgefield.com"]])
+        self.assertEqual(models.QueuedNotification.objects.filter(status = models.QueuedNotification.SENT).count(), 2)
+
+# TEAM REGISTRATION TEST CASES
+# =======================================================================
+from types import SimpleNamespace
+from django.db import connection
+from django.forms import formset_factory
+from django.test.utils import CaptureQueriesContext
+from visitorsite.teamviews import _teamnewvisit_internal
+from visitorsite.middleware import VisitorMiddleware
+
+def setUpTeamForm(members:int, usernames:list, team:str = "TEAM"):
+    # the first members are existing users, the rest are new visitors without an account
+    # (the same people again for the same team, see identity.py)
+    data = {"form-TOTAL_FORMS": str(members), "form-INITIAL_FORMS": "0"}
+    for i in range(members):
+        prefix = "form-{}-".format(i)
+        if (i < len(usernames)):
+            data[prefix + "team_username"] = usernames[i]
+            continue
+        data.update({
+            prefix + "team_username" : "",
+            prefix + "team_first_name" : "Member{}".format(i),
+            prefix + "team_last_name" : "Team",
+            prefix + "team_email" : "member{}@{}.com".format(i, team),
+            prefix + "team_phone" : "0400 000 {:03}".format(i),
+            prefix + "team_role" : models.Role.objects.get(name = "UWA Student").pk,
+            prefix + "team_emergencyname" : "Guardian",
+            prefix + "team_emergencyphone" : "0400 111 222",
+            prefix + "team_relationship" : "Parent",
+        })
+    team = formset_factory(forms.TeamVisitorForm, extra = members)(data)
+    assert team.is_valid(), team.errors
+    return team
+
+class TeamRegistrationTestCase(TestCase):
+    # prints the number of queries for each team size as a simple benchmark
+    # (kept below the size where SQLite has to split an INSERT into several batches)
+    TEAMSIZES = [4, 16, 64]
+
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        self.request = SimpleNamespace(user = User.objects.get(username = ARI))
+        VisitorMiddleware(lambda request: None).process_request(self.request) # request.visitor
+        self.visit = forms.RidgefieldVisitForm(data = setUpVisitForms(BASICVISITS[1:2])[0].data)
+        self.assertTrue(self.visit.is_valid())
+
+    def test_team_visits(self):
+        team = setUpTeamForm(4, [JOHND, JOHNA])
+        _teamnewvisit_internal(self.request, "ridgefield", self.visit, team)
+        # one visit for each member and the team leader
+        self.assertEqual(models.RidgefieldVisit.objects.count(), 5)
+        self.assertEqual(models.QueuedNotification.objects.count(), 5)
+        self.assertEqual(models.RidgefieldVisit.objects.filter(visitor__user__username = ARI).count(), 1)
+        self.assertEqual(models.Visitor.objects.filter(user = None, email = "member2@team.com").count(), 1)
+        self.assertEqual(models.Visitor.objects.filter(user = None).count(), 2)
+
+    def test_unknown_member(self):
+        manager = User.objects.create_user(username = "manager", password = "managerpassword")
+        team = setUpTeamForm(2, ["manager"])
+        self.assertRaises(ValueError, _teamnewvisit_internal, self.request, "ridgefield", self.visit, team)
+        # nothing is written when one member cannot be registered
+        self.assertEqual(models.RidgefieldVisit.objects.count(), 0)
+        self.assertEqual(models.Visitor.objects.filter(user = None).count(), 0)
+
+    def test_query_count_constant(self):
+        counts = []
+        for (day, n) in enumerate(self.TEAMSIZES, start = 1):
+            # other people each time, so no member is registered again
+            team = setUpTeamForm(n, [JOHND, JOHNA], "TEAM{}".format(day))
+            # a different day each time, so the visits of the existing users do not overlap
+            visit = forms.RidgefieldVisitForm(data = dict(self.visit.data, arrivaldate = "2023-01-{:02}".format(day),
+                                                          departuredate = "2023-01-{:02}".format(day + 1)))
+            self.assertTrue(visit.is_valid())
+            VisitorMiddleware(lambda request: None).process_request(self.request) # a new request
+            with CaptureQueriesContext(connection) as queries:
+                _teamnewvisit_internal(self.request, "ridgefield", visit, team)
+            print("Team of {} registered with {} queries".format(n, len(queries)))
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1)
+        self.assertEqual(models.RidgefieldVisit.objects.count(), sum(self.TEAMSIZES) + len(self.TEAMSIZES))
+# =======================================================================
+
+# BULK IMPORT TEST CASES
+# =======================================================================
+import io
+from django.core.files.uploadedfile import SimpleUploadedFile
+from visitorsite import importservice, exportservice, rolecache
+
+def setUpImportCSV(members:int, usernames:list, extrarows:list = [], day:int = 27, team:str = "TEAM"):
+    # like setUpTeamForm, the first members are existing users and the rest are new visitors
+    lines = [",".join(importservice.COLUMNS)]
+    visit = "2022-12-{},06:00,2022-12-{},07:00,,,,".format(day, day)
+    for i in range(members):
+        if (i < len(usernames)):
+            lines.append("{},,,,,,,,,{}".format(usernames[i], visit))
+        else:
+            lines.append("{},Member{},Team,member{}@{}.com,0400 000 {:03},UWA Student,Guardian,0400 111 222,Parent,{}".format(
+                "", i, i, team, i, visit))
+    return ("\n".join(lines + extrarows) + "\n").encode("utf-8")
+
+class ImportVisitsTestCase(TestCase):
+    BADROWS = [
+        "nobody,,,,,,,,,2022-12-27,06:00,2022-12-27,07:00,,,,", # user does not exist
+        ",A,B,a@b.com,123,Astronaut,C,456,Friend,2022-12-27,06:00,2022-12-27,07:00,,,,", # role does not exist
+        ",A,B,a@b.com,123,Other,C,456,Friend,2022-12-27,06:00,2022-12-26,07:00,,,,", # departs before arriving
+        ",A,,a@b.com,123,Other,C,456,Friend,not a date,06:00,2022-12-27,07:00,,,,", # missing name, bad date
+    ]
+
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+
+    def test_import(self):
+        errors = {}
+        data = setUpImportCSV(6, [JOHND, ARI], self.BADROWS)
+        (imported, failed) = importservice.import_visits(
+            "ridgefield", importservice.read_csv(io.BytesIO(data)), chunk_size = 4,
+            onerror = lambda n, e: errors.update({n : e})
+        )
+        self.assertEqual((imported, failed), (6, 4))
+        self.assertEqual(models.RidgefieldVisit.objects.count(), 6)
+        self.assertEqual(models.QueuedNotification.objects.count(), 6)
+        self.assertEqual(models.RidgefieldVisit.objects.filter(visitor__user__username = ARI).count(), 1)
+        self.assertEqual(models.Visitor.objects.filter(user = None).count(), 4)
+        # rows are numbered as in the spreadsheet (row 1 is the header)
+        self.assertEqual(sorted(errors.keys()), [8, 9, 10, 11])
+        self.assertIn("username", errors[8])
+        self.assertIn("role", errors[9])
+        self.assertIn("departuredate", errors[10])
+        self.assertIn("arrivaldate", errors[11])
+
+    def test_import_missing_columns(self):
+        rows = importservice.read_csv(io.BytesIO(b"username,first_name\njohnd,\n"))
+        self.assertRaises(ValueError, importservice.import_visits, "ridgefield", rows)
+
+    def test_query_count_constant(self):
+        counts = []
+        rolecache.roles() # the role catalogue is read once and then cached, whatever the size
+        for (day, n) in enumerate(TeamRegistrationTestCase.TEAMSIZES, start = 1):
+            # a different day each time, so the visits of johnd and johna do not overlap
+            rows = importservice.read_csv(io.BytesIO(setUpImportCSV(n, [JOHND, JOHNA], day = day, team = "TEAM{}".format(day))))
+            with CaptureQueriesContext(connection) as queries:
+                importservice.import_visits("gingin", rows, chunk_size = 100)
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1)
+
+    def test_upload(self):
+        self.client.force_login(User.objects.get(username = ARI))
+        upload = SimpleUploadedFile("trip.csv", setUpImportCSV(3, [JOHND], self.BADROWS[:1]), content_type = "text/csv")
+        response = self.client.post("/importvisits", {"site" : "gingin", "file" : upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["report"]["imported"], 3)
+        self.assertEqual(response.context["report"]["failed"], 1)
+        self.assertEqual(models.GinginVisit.objects.count(), 3)
+# =======================================================================
+
+# CSV EXPORT TEST CASES
+# =======================================================================
+import csv
+from django.contrib.auth.models import Permission
+
+class ExportVisitsTestCase(TestCase):
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        visitors = list(models.Visitor.objects.all())
+        for visit in BASICVISITS:
+            registerNewVisit("ridgefield", setUpVisitCleanedData(visit), visitors)
+        self.manager = setUpSiteManager("ridgefield", "ridgefieldmanager", "manager@ridgefield.com")
+        self.manager.is_staff = True
+        self.manager.save()
+        self.manager.groups.get().permissions.add(Permission.objects.get(codename = "view_ridgefieldvisit"))
+
+    def export(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return list(csv.reader(line.decode("utf-8") for line in response.streaming_content))
+
+    def test_export(self):
+        self.client.force_login(self.manager)
+        rows = self.export("/exportvisits/ridgefield")
+        self.assertEqual(rows[0], exportservice.HEADER)
+        self.assertEqual(len(rows) - 1, models.RidgefieldVisit.objects.count())
+        with CaptureQueriesContext(connection) as queries:
+            rows = self.export("/exportvisits/ridgefield?start=2022-12-27&end=2022-12-27")
+        self.assertEqual(len(rows) - 1, len(BASICVISITORS))
+        # the arrival column is compared as it is, so its indexes can be used
+        self.assertFalse(any("cast_date" in i["sql"] or "::date" in i["sql"] for i in queries))
+
+    def test_export_query_count(self):
+        self.client.force_login(self.manager)
+        self.client.get("/exportvisits/ridgefield") # log in and load permissions
+        with CaptureQueriesContext(connection) as queries:
+            self.export("/exportvisits/ridgefield")
+        # session, user, permissions and the visits themselves, whatever the number of visits
+        self.assertLessEqual(len(queries), 5)
+
+    def test_export_permissions(self):
+        self.client.force_login(self.manager)
+        self.assertEqual(self.client.get("/exportvisits/gingin").status_code, 403)
+        self.client.force_login(User.objects.get(username = ARI))
+        self.assertEqual(self.client.get("/exportvisits/ridgefield").status_code, 403)
+
+    def test_admin_action(self):
+        self.client.force_login(self.manager)
+        response = self.client.post("/admin/visitorsite/ridgefieldvisit/", {
+            "action" : "export_visits_csv",
+            "_selected_action" : list(models.RidgefieldVisit.objects.values_list("pk", flat = True)[:2])
+        })
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(line.decode("utf-8") for line in response.streaming_content))
+        self.assertEqual(len(rows), 3)
+# =======================================================================
+
+# ADMIN CHANGELIST TEST CASES
+# =======================================================================
+class AdminChangelistTestCase(TestCase):
+    CHANGELISTS = ["/admin/visitorsite/ridgefieldvisit/", "/admin/visitorsite/visit/", "/admin/visitorsite/visitor/"]
+
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        self.visitors = list(models.Visitor.objects.all())
+        self.client.force_login(User.objects.create_superuser("admin", "admin@uwa.edu.au", "adminpassword"))
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_constant(self):
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[0]), self.visitors)
+        small = [self.changelist_queries(url) for url in self.CHANGELISTS]
+
+        # a full page of visits and visitors
+        registerNewVisitors([{
+            "first_name" : "Member{}".format(i), "last_name" : "Team", "email" : "member{}@team.com".format(i), "phone" : "123",
+            "role" : self.visitors[0].role, "emergencyname" : "Guardian", "emergencyphone" : "456", "relationship" : "Parent"
+        } for i in range(100)])
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[2]), list(models.Visitor.objects.all()))
+        large = [self.changelist_queries(url) for url in self.CHANGELISTS]
+        self.assertEqual(small, large)
+# =======================================================================
+
+# SITE OCCUPANCY TEST CASES
+# =======================================================================
+from visitorsite import occupancy
+
+class OccupancyTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        self.visitors = list(models.Visitor.objects.all())
+        now = timezone.localtime()
+        self.onsite = {
+            "arrivaldate" : now.date(), "arrivaltime" : (now - timedelta(hours = 1)).time(),
+            "departuredate" : (now + timedelta(days = 1)).date(), "departuretime" : now.time(),
+            "overnight" : True, "induction" : True, "houserules" : True, "paddock" : "Mating Pots 0.71"
+        }
+
+    def test_occupancy_cached(self):
+        with self.captureOnCommitCallbacks(execute = True):
+            registerNewVisit("ridgefield", self.onsite, self.visitors[:2])
+            registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[0]), self.visitors) # in the past
+        self.assertEqual(occupancy.current_occupants("ridgefield")["count"], 2)
+        # polling again does not touch the database
+        with self.assertNumQueries(0):
+            self.assertEqual(occupancy.current_occupants("ridgefield")["count"], 2)
+
+        # new visits invalidate the cache
+        with self.captureOnCommitCallbacks(execute = True):
+            registerNewVisit("ridgefield", self.onsite, self.visitors[2:])
+        self.assertEqual(occupancy.current_occupants("ridgefield")["count"], 3)
+
+        # so do edits and deletes
+        with self.captureOnCommitCallbacks(execute = True):
+            models.RidgefieldVisit.objects.filter(visitor = self.visitors[0]).first().delete()
+        self.assertEqual(occupancy.current_occupants("ridgefield")["count"], 2)
+        with self.captureOnCommitCallbacks(execute = True):
+            contact = self.visitors[1].emergencycontact
+            contact.phone = "999"
+            contact.save()
+        phones = [i["emergencycontact"]["phone"] for i in occupancy.current_occupants("ridgefield")["occupants"]]
+        self.assertIn("999", phones)
+
+    def test_occupancy_permissions(self):
+        manager = setUpSiteManager("ridgefield", "ridgefieldmanager", "manager@ridgefield.com")
+        manager.groups.get().permissions.add(Permission.objects.get(codename = "view_ridgefieldvisit"))
+        self.client.force_login(manager)
+        response = self.client.get("/occupancy/ridgefield")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 0)
+        self.assertEqual(self.client.get("/occupancy/gingin").status_code, 403)
+        self.assertEqual(self.client.get("/occupancy/nowhere").status_code, 404)
+# =======================================================================
+
+# BOOKING CHECK TEST CASES
+# =======================================================================
+from visitorsite.bookingchecks import BookingConflict
+from visitorsite.globals import OVERNIGHT_CAPACITY
+
+class BookingChecksTestCase(TestCase):
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        self.visitors = list(models.Visitor.objects.all())
+        self.overnight = setUpVisitCleanedData(BASICVISITS[1]) # 27th 06:00 to 28th 06:00
+
+    def test_double_booking(self):
+        registerNewVisit("ridgefield", self.overnight, self.visitors[:1])
+        # the same visitor cannot be at another site at the same time
+        daytrip = dict(setUpVisitCleanedData(BASICVISITS[0]), arrivaldate = self.overnight["departuredate"],
+                       departuredate = self.overnight["departuredate"])
+        daytrip["arrivaltime"] = datetime.strptime("05:00", "%H:%M").time()
+        self.assertRaises(BookingConflict, registerNewVisit, "gingin", daytrip, self.visitors)
+        # nothing is saved for the rest of the team either
+        self.assertEqual(models.Visit.objects.count(), 1)
+        # but they can arrive as they leave
+        daytrip["arrivaltime"] = datetime.strptime("06:00", "%H:%M").time()
+        registerNewVisit("gingin", daytrip, self.visitors)
+        self.assertEqual(models.Visit.objects.count(), 1 + len(self.visitors))
+
+    def test_double_booking_page(self):
+        registerNewVisit("ridgefield", self.overnight, self.visitors[:1])
+        self.client.force_login(self.visitors[0].user)
+        response = self.client.post("/newvisit/ridgefield", setUpVisitForms(BASICVISITS[1:2])[0].data, follow = True)
+        self.assertContains(response, "already has a visit at that time")
+        self.assertEqual(models.Visit.objects.count(), 1)
+
+    @patch.dict(OVERNIGHT_CAPACITY, {"ridgefield" : 2})
+    def test_overnight_capacity(self):
+        registerNewVisit("ridgefield", self.overnight, self.visitors[:2])
+        self.assertRaises(BookingConflict, registerNewVisit, "ridgefield", self.overnight, self.visitors[2:])
+        # day visits and other sites do not count
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[2]), self.visitors[2:])
+        registerNewVisit("gingin", self.overnight, self.visitors[2:])
+        # the beds are free again the next night
+        nextnight = dict(self.overnight, arrivaldate = self.overnight["departuredate"],
+                         departuredate = self.overnight["departuredate"] + timedelta(days = 1))
+        registerNewVisit("ridgefield", nextnight, self.visitors[:2])
+
+    def test_import_conflicts(self):
+        registerNewVisit("gingin", dict(self.overnight, paddock = ""), self.visitors[:1])
+        errors = {}
+        data = setUpImportCSV(3, [JOHND, JOHNA], day = 27)
+        (imported, failed) = importservice.import_visits(
+            "gingin", importservice.read_csv(io.BytesIO(data)), onerror = lambda n, e: errors.update({n : e})
+        )
+        self.assertEqual((imported, failed), (2, 1))
+        self.assertEqual(list(errors.keys()), [2])
+# =======================================================================
+
+from visitorsite import recipients
+
+class RecipientListTestCase(TestCase):
+    def setUp(self):
+        self.manager = setUpSiteManager("ridgefield", "ridgefieldmanager", "ridgefield@manager.com")
+        setUpSiteManager("gingin", "ginginmanager", "gingin@manager.com")
+
+    def test_recipients_cached(self):
+        self.assertEqual(recipients.site_manager_emails("ridgefield"), ["ridgefield@manager.com"])
+        # sending more notifications does not query the user tables
+        with self.assertNumQueries(0):
+            self.assertEqual(recipients.site_manager_emails("ridgefield"), ["ridgefield@manager.com"])
+        self.assertEqual(recipients.site_manager_emails("gingin"), ["gingin@manager.com"])
+
+    def test_recipients_invalidated(self):
+        recipients.site_manager_emails("ridgefield")
+        with self.captureOnCommitCallbacks(execute = True):
+            newmanager = setUpSiteManager("ridgefield", "newmanager", "new@manager.com")
+        self.assertEqual(sorted(recipients.site_manager_emails("ridgefield")), ["new@manager.com", "ridgefield@manager.com"])
+
+        with self.captureOnCommitCallbacks(execute = True):
+            self.manager.email = "changed@manager.com"
+            self.manager.save()
+        self.assertEqual(sorted(recipients.site_manager_emails("ridgefield")), ["changed@manager.com", "new@manager.com"])
+
+        with self.captureOnCommitCallbacks(execute = True):
+            Group.objects.get(name = "Ridgefield").user_set.remove(newmanager)
+        self.assertEqual(recipients.site_manager_emails("ridgefield"), ["changed@manager.com"])
+
+        # logging in only saves last_login and keeps the cached list
+        with self.captureOnCommitCallbacks(execute = True) as callbacks:
+            self.client.login(username = "ridgefieldmanager", password = "managerpassword")
+        self.assertEqual(len(callbacks), 0)
+        with self.assertNumQueries(0):
+            recipients.site_manager_emails("ridgefield")
+
+import shutil
+import tempfile
+from django.core.management import call_command
+from django.templatetags.static import static
+from django.test import override_settings
+from visitorsite import staticviews
+
+STATICROOT = tempfile.mkdtemp()
+
+@override_settings(STATIC_ROOT = STATICROOT)
+class StaticFilesTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        call_command("collectstatic", interactive = False, verbosity = 0)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(STATICROOT, ignore_errors = True)
+        super().tearDownClass()
+
+    def test_pdf_links_hashed(self):
+        url = static("pdf/Induction sheet-5.pdf")
+        self.assertNotEqual(url, "/static/pdf/Induction sheet-5.pdf")
+        self.assertIn(url, str(forms.GinginVisitForm()["induction"].label))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+
+    def test_pdf_range(self):
+        url = static("pdf/Induction sheet-5.pdf")
+        full = b"".join(self.client.get(url).streaming_content)
+        response = self.client.get(url, HTTP_RANGE = "bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), full[100:200])
+        self.assertEqual(response["Content-Range"], "bytes 100-199/{}".format(len(full)))
+        self.assertEqual(response["Content-Length"], "100")
+        response = self.client.get(url, HTTP_RANGE = "bytes=-10")
+        self.assertEqual(b"".join(response.streaming_content), full[-10:])
+        # an open range is streamed a chunk at a time, not read at once
+        with patch.object(staticviews, "CHUNKSIZE", 1000):
+            chunks = list(self.client.get(url, HTTP_RANGE = "bytes=10-").streaming_content)
+        self.assertEqual(b"".join(chunks), full[10:])
+        self.assertEqual(max(len(i) for i in chunks), 1000)
+        # resuming a download of another version of the file sends the whole file
+        response = self.client.get(url, HTTP_RANGE = "bytes=100-", HTTP_IF_RANGE = '"old"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, HTTP_RANGE = "bytes={}-".format(len(full)))
+        self.assertEqual(response.status_code, 416)
+
+    def test_etag(self):
+        url = static("pdf/Induction sheet-5.pdf")
+        etag = self.client.get(url)["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_compressed(self):
+        url = static("basicforms.css")
+        plain = b"".join(self.client.get(url).streaming_content)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING = "gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), plain)
+        self.assertIn("Accept-Encoding", response["Vary"])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING = "gzip;q=0")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        # files without a hash in their name are checked again after a while
+        response = self.client.get("/static/basicforms.css")
+        self.assertNotIn("immutable", response["Cache-Control"])
+
+    def test_outside_static_root(self):
+        self.assertEqual(self.client.get("/static/../manage.py").status_code, 404)
+        self.assertEqual(self.client.get("/static/missing.css").status_code, 404)
+
+class PageCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.contact = models.SiteEmergencyContact.objects.create(
+            name = "Fire warden", phone = "0400000000", site = "Gingin", position = "Warden")
+
+    def test_sitecontacts_cached(self):
+        response = self.client.get("/sitecontacts")
+        self.assertContains(response, "Fire warden")
+        # scanning the QR code again renders nothing and does not touch the database
+        with self.assertNumQueries(0):
+            response = self.client.get("/sitecontacts")
+        self.assertTemplateNotUsed(response, "site_emergency_contact.html")
+        self.assertContains(response, "Fire warden")
+        with self.assertNumQueries(0):
+            response = self.client.get("/sitecontacts", HTTP_IF_NONE_MATCH = response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_sitecontacts_invalidated(self):
+        etag = self.client.get("/sitecontacts")["ETag"]
+        with self.captureOnCommitCallbacks(execute = True):
+            self.contact.phone = "0411111111"
+            self.contact.save()
+        response = self.client.get("/sitecontacts", HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "0411111111")
+        with self.captureOnCommitCallbacks(execute = True):
+            self.contact.delete()
+        self.assertNotContains(self.client.get("/sitecontacts"), "Fire warden")
+
+    def test_auth_states(self):
+        self.assertContains(self.client.get("/sitecontacts"), "/register")
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS[:1])
+        self.client.login(username = BASICVISITORS[0]["username"], password = BASICVISITORS[0]["password"])
+        response = self.client.get("/sitecontacts")
+        self.assertContains(response, "/logout")
+        self.assertRedirects(self.client.get("/"), "/account", fetch_redirect_response = False)
+        self.client.logout()
+        manager = setUpSiteManager("gingin", "ginginmanager", "manager@gingin.com")
+        manager.is_staff = True
+        manager.save()
+        self.client.login(username = "ginginmanager", password = "managerpassword")
+        self.assertEqual(self.client.get("/sitecontacts").status_code, 302)
+
+from urllib.parse import urlencode
+from asgiref.sync import sync_to_async
+
+def asyncPost(client, path:str, data:dict):
+    # the async test client of Django 4.1 cannot read multipart bodies, so post the form url-encoded
+    return client.post(path, urlencode(data), content_type = "application/x-www-form-urlencoded")
+
+class AsyncViewsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS[:1])
+        self.user = User.objects.get(username = BASICVISITORS[0]["username"])
+        self.visit = {
+            "arrivaldate" : "2022-11-02", "arrivaltime" : "09:00",
+            "departuredate" : "2022-11-02", "departuretime" : "17:00"
+        }
+
+    async def test_login(self):
+        response = await asyncPost(self.async_client, "/login", {"username" : "johnd", "password" : "wrongpassword"})
+        self.assertContains(response, "Username or password is wrong!")
+        response = await asyncPost(self.async_client, "/login", {"username" : "johnd", "password" : BASICVISITORS[0]["password"]})
+        self.assertRedirects(response, "/account", fetch_redirect_response = False)
+        # logged in users are sent to their account page
+        self.assertRedirects(await self.async_client.get("/login"), "/account", fetch_redirect_response = False)
+
+    async def test_newvisit(self):
+        response = await asyncPost(self.async_client, "/newvisit/gingin", self.visit)
+        self.assertRedirects(response, "/login?next=/newvisit/gingin", fetch_redirect_response = False)
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await asyncPost(self.async_client, "/newvisit/gingin", self.visit)
+        self.assertRedirects(response, "/account", fetch_redirect_response = False)
+        self.assertEqual(await models.GinginVisit.objects.filter(visitor__user = self.user).acount(), 1)
+        # the same visit again is a double booking
+        response = await asyncPost(self.async_client, "/newvisit/gingin", self.visit)
+        self.assertContains(response, "already has a visit at that time")
+        self.assertEqual(await models.GinginVisit.objects.acount(), 1)
+
+    async def test_teamnewvisit(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        self.assertContains(await self.async_client.get("/teamtransitionpage/1/gingin"), "team_role")
+        data = {"form-TOTAL_FORMS" : "1", "form-INITIAL_FORMS" : "0", "form-0-team_first_name" : "Jane",
+                "form-0-team_last_name" : "Doe", "form-0-team_email" : "jane@doe.com", "form-0-team_phone" : "1234",
+                "form-0-team_role" : str((await models.Role.objects.afirst()).pk), "form-0-team_emergencyname" : "John",
+                "form-0-team_emergencyphone" : "5678", "form-0-team_relationship" : "Friend"}
+        data.update(self.visit)
+        response = await asyncPost(self.async_client, "/teamtransitionpage/1/gingin", data)
+        self.assertRedirects(response, "/account", fetch_redirect_response = False)
+        self.assertEqual(await models.GinginVisit.objects.acount(), 2)
+
+    async def test_sitecontacts(self):
+        await models.SiteEmergencyContact.objects.acreate(name = "Fire warden", phone = "0400000000", site = "Gingin", position = "Warden")
+        self.assertContains(await self.async_client.get("/sitecontacts"), "Fire warden")
+        response = await self.async_client.get("/sitecontacts")
+        self.assertEqual((await self.async_client.get("/sitecontacts", **{"if-none-match" : response["ETag"]})).status_code, 304)
+
+from django.db.models import F
+from visitorsite import seeding
+
+class SeedDemoDataTestCase(TestCase):
+    def test_seed_demo_data(self):
+        call_command("seed_demo_data", visitors = 50, accounts = 5, visits = 301, days = 30, seed = 1, stdout = io.StringIO())
+        self.assertEqual(models.Visitor.objects.count(), 50)
+        self.assertEqual(models.Visitor.objects.filter(user__isnull = False).count(), 5)
+        self.assertEqual(models.RidgefieldVisit.objects.count() + models.GinginVisit.objects.count(), 301)
+        self.assertEqual(models.EmergencyContact.objects.count(), 50)
+        # the demo accounts can log in
+        self.assertTrue(self.client.login(username = "demo0", password = "demo-password"))
+        # all visits are within the requested history
+        earliest = timezone.localdate() - timedelta(days = 31)
+        self.assertFalse(models.Visit.objects.filter(arrival__date__lt = earliest).exists())
+        self.assertFalse(models.Visit.objects.filter(departure__lt = F("arrival")).exists())
+        # the next run numbers its accounts after the first one
+        call_command("seed_demo_data", visitors = 5, accounts = 5, visits = 0, stdout = io.StringIO())
+        self.assertTrue(User.objects.filter(username = "demo9").exists())
+
+    def test_seed_visits_queries(self):
+        visitorids = seeding.seed_visitors(10)
+        # per batch: two INSERT statements (visit table and site table) in a savepoint, none per visit
+        with self.assertNumQueries(4 * 3):
+            seeding.seed_visits("ridgefield", 300, visitorids, batch_size = 100)
+        self.assertEqual(models.RidgefieldVisit.objects.count(), 300)
+
+from visitorsite.management.commands import benchmark_flows
+
+class BenchmarkFlowsTestCase(TestCase):
+    def test_compare(self):
+        result = {"scenario" : "newvisit", "dataset" : 1000, "team" : None, "p50_ms" : 10.0, "p95_ms" : 20.0,
+                  "p99_ms" : 30.0, "queries" : 8, "bytes" : 0, "errors" : 0}
+        command = benchmark_flows.Command()
+        self.assertEqual(command.compare([result], {"results" : [result]}), [])
+        # one more query is a regression, a slightly slower run is not
+        self.assertEqual(len(command.compare([dict(result, queries = 9, p50_ms = 11.0)], {"results" : [result]})), 1)
+        self.assertEqual(len(command.compare([dict(result, p50_ms = 100.0)], {"results" : [result]})), 1)
+        self.assertEqual(len(command.compare([dict(result, errors = 1)], {"results" : [result]})), 1)
+        # scenarios missing from the baseline are not compared
+        self.assertEqual(command.compare([dict(result, dataset = 5000, queries = 50)], {"results" : [result]}), [])
+
+# =======================================================================
+
+# INSTRUMENTATION TEST CASES
+# =======================================================================
+from django.contrib.auth.hashers import identify_hasher
+from visitorsite import instrumentation
+from VisitorManagementApp import settings as projectsettings
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_server_timing_for_staff(self):
+        self.assertFalse(self.client.get("/login").has_header("Server-Timing"))
+        manager = setUpSiteManager("gingin", "ginginmanager", "manager@gingin.com")
+        manager.is_staff = True
+        manager.save()
+        self.client.force_login(manager)
+        timing = self.client.get("/admin/visitorsite/siteemergencycontact/")["Server-Timing"]
+        for i in ("sql;dur=", "template;dur=", "queries;desc=", "total;dur="):
+            self.assertIn(i, timing)
+        # requests that never read the user do not load the session and the user for the header
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/static/missing.css")
+        self.assertEqual(len(queries), 0)
+        self.assertFalse(response.has_header("Server-Timing"))
+
+    def test_metrics(self):
+        self.client.get("/login")
+        self.client.get("/newvisit/gingin")
+        metrics = self.client.get("/metrics")
+        self.assertEqual(metrics.status_code, 200)
+        self.assertTrue(metrics["Content-Type"].startswith("text/plain; version=0.0.4"))
+        text = metrics.content.decode()
+        # one series per URL pattern, not per URL
+        self.assertIn('visitorsite_responses_total{route="login",status="200"}', text)
+        self.assertIn('visitorsite_responses_total{route="newvisit/<str:site>",status="302"}', text)
+        self.assertIn('visitorsite_request_duration_seconds_bucket{method="GET",route="login",le="+Inf"}', text)
+        self.assertIn('visitorsite_request_phase_seconds_count{phase="template",route="login"}', text)
+        # other addresses need a site manager account
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR = "203.0.113.5").status_code, 403)
+
+    @override_settings(PASSWORD_HASHERS = projectsettings.PASSWORD_HASHERS)
+    def test_login_password_timed(self):
+        User.objects.create_user("timed", password = "timedpassword")
+        # stored hashes are checked with the timed hasher, not Django's one of the same name
+        self.assertIsInstance(identify_hasher(User.objects.get(username = "timed").password),
+                              instrumentation.InstrumentedPBKDF2PasswordHasher)
+        series = instrumentation._metrics["visitorsite_request_phase_seconds"]["values"]
+        count = lambda: series.get((("phase", "password"), ("route", "login")), [[], 0, 0])[2]
+        before = count()
+        self.assertEqual(self.client.post("/login", {"username" : "timed", "password" : "timedpassword"}).status_code, 302)
+        self.assertEqual(count(), before + 1)
+
+    def test_histogram(self):
+        instrumentation.define("visitorsite_test_histogram", "histogram", "Test.", (1, 5))
+        for i in (0.5, 2, 2, 10):
+            instrumentation.observe("visitorsite_test_histogram", i, route = 'say "hi"')
+        text = instrumentation.render()
+        self.assertIn('visitorsite_test_histogram_bucket{route="say \\"hi\\"",le="1"} 1\n', text)
+        self.assertIn('visitorsite_test_histogram_bucket{route="say \\"hi\\"",le="5"} 3\n', text)
+        self.assertIn('visitorsite_test_histogram_bucket{route="say \\"hi\\"",le="+Inf"} 4\n', text)
+        self.assertIn('visitorsite_test_histogram_sum{route="say \\"hi\\""} 14.5\n', text)
+
+    @override_settings(METRICS_SLOW_QUERY_MS = 0)
+    def test_slow_queries(self):
+        with self.assertLogs("visitorsite.instrumentation", "WARNING"):
+            self.client.get("/admin/login/?next=/admin/")
+            setUpSiteManager("gingin", "ginginmanager", "manager@gingin.com")
+            self.client.login(username = "ginginmanager", password = "managerpassword")
+            self.client.get("/account")
+        self.assertNotEqual(len(instrumentation.SLOWQUERIES), 0)
+        self.assertIn("visitorsite_slow_queries_total{route=", instrumentation.render())
+
+# =======================================================================
+
+# THROTTLING TEST CASES
+# =======================================================================
+from django.contrib.auth.signals import user_login_failed
+import time
+from visitorsite import throttling
+
+class ThrottlingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        throttling.buckets().clear()
+        self.failures = []
+        user_login_failed.connect(self.loginfailed)
+        self.addCleanup(user_login_failed.disconnect, self.loginfailed)
+
+    def loginfailed(self, **kwargs):
+        self.failures.append(kwargs["credentials"]["username"])
+
+    @override_settings(THROTTLE_RATES = {"login" : {"username" : (2, 60)}})
+    def test_login_per_username(self):
+        for i in range(2):
+            self.assertEqual(self.client.post("/login", {"username" : "johnd", "password" : "wrong"}).status_code, 200)
+        response = self.client.post("/login", {"username" : "JohnD", "password" : "wrong"})
+        self.assertEqual(response.status_code, 429)
+        self.assertContains(response, "Too many attempts", status_code = 429)
+        # the third attempt never reached authentication (no password was hashed)
+        self.assertEqual(self.failures, ["johnd", "johnd"])
+        self.assertEqual(self.client.post("/login", {"username" : "janed", "password" : "wrong"}).status_code, 200)
+
+    @override_settings(THROTTLE_RATES = {"login" : {"ip" : (2, 60)}})
+    def test_login_per_address(self):
+        for i in ("a", "b"):
+            self.client.post("/login", {"username" : i, "password" : "wrong"})
+        self.assertEqual(self.client.post("/login", {"username" : "c", "password" : "wrong"}).status_code, 429)
+        response = self.client.post("/login", {"username" : "c", "password" : "wrong"}, REMOTE_ADDR = "203.0.113.5")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('visitorsite_throttle_total{action="login",limit="ip",result="rejected"}', instrumentation.render())
+
+    @override_settings(THROTTLE_RATES = {"register" : {"ip" : (1, 60)}})
+    def test_register(self):
+        self.client.post("/register", {"username" : "johnd"})
+        self.assertEqual(self.client.post("/register", {"username" : "janed"}).status_code, 429)
+        self.assertFalse(User.objects.exists())
+
+    @override_settings(THROTTLE_CACHE = "default")
+    def test_buckets(self):
+        for backend in (throttling.MemoryBuckets(), throttling.buckets()):
+            self.assertTrue(backend.take("key", 2, 0.05))
+            self.assertTrue(backend.take("key", 2, 0.05))
+            self.assertFalse(backend.take("key", 2, 0.05))
+            self.assertTrue(backend.take("other key", 2, 0.05))
+            time.sleep(0.05) # refilled
+            self.assertTrue(backend.take("key", 2, 0.05))
+
+# =======================================================================
+
+# REQUEST VISITOR TEST CASES
+# =======================================================================
+from django.contrib.auth.models import AnonymousUser
+from visitorsite.middleware import get_visitor
+
+class RequestVisitorTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS[:1])
+        self.client.force_login(User.objects.get(username = JOHND))
+
+    def visitorqueries(self, method:str, path:str, data:dict = None):
+        """Returns the response and the number of queries looking up the user's visitor."""
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, data)
+        reads = [i for i in queries if (i["sql"].startswith("SELECT") and 'FROM "visitorsite_visitor"' in i["sql"]
+                                        and '"visitorsite_visitor"."user_id" =' in i["sql"])]
+        return (response, len(reads))
+
+    def test_loaded_once(self):
+        data = {"first_name" : "Jon", "last_name" : "Doe", "email" : "jon@example.com", "phone" : "0400 123 456"}
+        (response, reads) = self.visitorqueries("post", "/changedetails", data)
+        self.assertRedirects(response, "/account", fetch_redirect_response = False)
+        self.assertEqual(reads, 1)
+        visitor = models.Visitor.objects.get(user__username = JOHND)
+        self.assertEqual((visitor.first_name, visitor.email, visitor.phone_number), ("Jon", "jon@example.com", "0400 123 456"))
+
+        (response, reads) = self.visitorqueries("post", "/changeemergency", {
+            "name" : "Jane", "phone" : "0400 000 000", "relationship" : "Partner"})
+        self.assertEqual(reads, 1)
+        self.assertEqual(models.Visitor.objects.get(user__username = JOHND).emergencycontact.name, "Jane")
+        # the previous contact is gone, the visitor is not
+        self.assertEqual(models.EmergencyContact.objects.count(), 1)
+
+        (response, reads) = self.visitorqueries("post", "/newvisit/gingin", {
+            "arrivaldate" : "2022-11-02", "arrivaltime" : "09:00", "departuredate" : "2022-11-02", "departuretime" : "17:00"})
+        self.assertRedirects(response, "/account", fetch_redirect_response = False)
+        self.assertEqual(reads, 1)
+
+    def test_no_visitor(self):
+        manager = setUpSiteManager("gingin", "ginginmanager", "manager@gingin.com")
+        request = SimpleNamespace(user = manager)
+        self.assertRaises(models.Visitor.DoesNotExist, get_visitor, request)
+        request.user = AnonymousUser()
+        self.assertRaises(models.Visitor.DoesNotExist, get_visitor, request)
+
+# =======================================================================
+
+# PROFILE UPDATE TEST CASES
+# =======================================================================
+import json
+from visitorsite import profileservice
+
+class ProfileUpdateTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS[:1])
+        self.user = User.objects.get(username = JOHND)
+        self.visitor = models.Visitor.objects.get(user = self.user)
+        self.client.force_login(self.user)
+
+    def updates(self, data:dict, queries:int):
+        """
+        Returns (changed fields, UPDATE statements run) of update_profile, which must run the given
+        number of queries in all (the transaction's savepoint and release included).
+        """
+        with CaptureQueriesContext(connection) as captured, self.assertNumQueries(queries):
+            changed = profileservice.update_profile(self.user, self.visitor, data)
+        return (changed, [i["sql"] for i in captured if (i["sql"].startswith("UPDATE"))])
+
+    def test_changed_columns_only(self):
+        role = models.Role.objects.get(name = "UWA Staff")
+        self.user.first_name = self.visitor.first_name
+        self.user.save()
+        # the search index and the daily occupancy follow after the commit
+        with self.captureOnCommitCallbacks(execute = True):
+            (changed, updates) = self.updates({"first_name" : self.visitor.first_name, "last_name" : "Doe-Smith",
+                                               "email" : "", "phone" : "0400 999 999", "role" : role}, 4)
+        self.assertTrue(search.matching_visitors("smith").exists())
+        self.assertEqual(changed, ["last_name", "phone", "role"])
+        self.assertEqual(len(updates), 2) # one for the user, one for the visitor
+        self.assertNotIn('"first_name"', updates[0])
+        self.assertNotIn('"email"', updates[1])
+        self.visitor.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.last_name, self.visitor.last_name, self.visitor.phone_number, self.visitor.role),
+                         ("Doe-Smith", "Doe-Smith", "0400 999 999", role))
+        # the visitor only
+        self.assertEqual(len(self.updates({"phone" : "0400 111 222"}, 3)[1]), 1)
+        # nothing changed, nothing written
+        self.assertEqual(self.updates({"last_name" : "Doe-Smith", "role" : role}, 0), ([], []))
+
+    def test_api(self):
+        response = self.client.patch("/api/profile", {"email" : "john@example.org", "first_name" : ""},
+                                     content_type = "application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["email"], "john@example.org")
+        self.assertEqual(response.json()["changed"], ["email"])
+        self.assertEqual(User.objects.get(username = JOHND).email, "john@example.org")
+        self.assertEqual(self.client.get("/api/profile").json()["username"], JOHND)
+
+        response = self.client.patch("/api/profile", {"email" : "not an address"}, content_type = "application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("email", response.json()["errors"])
+        response = self.client.patch("/api/profile", "{", content_type = "application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post("/api/profile").status_code, 405)
+        self.client.logout()
+        self.assertEqual(self.client.get("/api/profile").status_code, 401)
+
+    def test_changedetails(self):
+        response = self.client.post("/changedetails", {"first_name" : "Jon", "last_name" : ""})
+        self.assertRedirects(response, "/account", fetch_redirect_response = False)
+        self.visitor.refresh_from_db()
+        self.assertEqual((self.visitor.first_name, self.visitor.last_name), ("Jon", BASICVISITORS[0]["last_name"]))
+        self.assertEqual(User.objects.get(username = JOHND).first_name, "Jon")
+
+# =======================================================================
+
+# VISIT ARCHIVE TEST CASES
+# =======================================================================
+import os
+from django.core.management.base import CommandError
+from django.db import DatabaseError
+from django.db.models import ProtectedError
+from visitorsite import archive, rollups
+
+class ArchiveVisitsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        visitors = list(models.Visitor.objects.all())
+        for visit in BASICVISITS[1:]: # all in 2022
+            registerNewVisit("ridgefield", setUpVisitCleanedData(visit), visitors)
+        registerNewVisit("gingin", setUpVisitCleanedData(BASICVISITS[0]), visitors[:1])
+        now = timezone.now()
+        self.recent = models.RidgefieldVisit.objects.create(
+            visitor = visitors[0], arrival = now - timedelta(days = 1), departure = now, induction = True,
+            houserules = True, overnight = True, paddock = "Paddock 1")
+        self.old = list(models.RidgefieldVisit.objects.exclude(pk = self.recent.pk).order_by("pk"))
+        self.exportdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.exportdir)
+
+    def archive(self, **options):
+        # the files are written once each batch commits
+        with self.captureOnCommitCallbacks(execute = True):
+            call_command("archive_visits", days = 365, stdout = io.StringIO(), **options)
+
+    def test_archive(self):
+        self.archive(batch_size = 3, export_dir = self.exportdir)
+        # recent visits stay, old ones move to the archive with their visit id and details
+        self.assertEqual(list(models.RidgefieldVisit.objects.all()), [self.recent])
+        self.assertEqual(models.GinginVisit.objects.count(), 0)
+        self.assertEqual(models.Visit.objects.count(), 1)
+        archived = archive.archived_visits("ridgefield").get(pk = self.old[0].pk)
+        self.assertEqual((archived.arrival, archived.departure, archived.paddock, archived.visitor_id),
+                         (self.old[0].arrival, self.old[0].departure, self.old[0].paddock, self.old[0].visitor_id))
+        self.assertEqual(archived.month, self.old[0].arrival.date().replace(day = 1))
+        self.assertEqual(archive.archived_visits("ridgefield").count(), len(self.old))
+        self.assertEqual(archive.archived_visits("gingin").count(), 1)
+
+        # one compressed CSV per month, with a single header even when appended to
+        models.RidgefieldVisit.objects.create(
+            visitor = self.recent.visitor, arrival = self.old[0].arrival - timedelta(days = 1),
+            departure = self.old[0].arrival - timedelta(hours = 12), induction = False, houserules = False,
+            overnight = False, paddock = "")
+        self.archive(sites = ["ridgefield"], export_dir = self.exportdir)
+        rows = []
+        for name in os.listdir(self.exportdir):
+            if (name.startswith("ridgefield-")):
+                with gzip.open(os.path.join(self.exportdir, name), "rt", newline = "") as f:
+                    rows += list(csv.reader(f))
+        self.assertEqual(rows.count(exportservice.HEADER), len([i for i in os.listdir(self.exportdir) if (i.startswith("ridgefield-"))]))
+        self.assertEqual(len(rows) - rows.count(exportservice.HEADER), len(self.old) + 1)
+        self.assertFalse(any(i.endswith(".tmp") for i in os.listdir(self.exportdir)))
+        # the audit trail keeps its visitors
+        self.assertRaises(ProtectedError, self.old[0].visitor.delete)
+
+    def test_failed_batch_not_exported(self):
+        with patch.object(models.ArchivedVisit.objects, "bulk_create", side_effect = DatabaseError("disk full")):
+            with self.captureOnCommitCallbacks(execute = True):
+                self.assertRaises(DatabaseError, archive.archive_visits, "ridgefield", archive.cutoff(365), export_dir = self.exportdir)
+        self.assertEqual(os.listdir(self.exportdir), [])
+        self.assertEqual(models.RidgefieldVisit.objects.count(), len(self.old) + 1)
+
+    def test_files_only(self):
+        self.archive(files_only = True, export_dir = self.exportdir)
+        self.assertEqual(models.ArchivedVisit.objects.count(), 0)
+        self.assertEqual(models.Visit.objects.count(), 1)
+        self.assertNotEqual(len(os.listdir(self.exportdir)), 0)
+        # the visits leave the daily occupancy, which then matches a rebuild
+        incremental = set(models.DailyOccupancy.objects.filter(visitors__gt = 0).values_list("site", "day", "role", "visitors"))
+        rollups.rebuild()
+        self.assertEqual(set(models.DailyOccupancy.objects.filter(visitors__gt = 0).values_list("site", "day", "role", "visitors")), incremental)
+        self.assertRaises(CommandError, call_command, "archive_visits", files_only = True)
+        self.assertRaises(ValueError, archive.archive_visits, "ridgefield", archive.cutoff(365), keep = False)
+
+    def test_read_path(self):
+        call_command("archive_visits", days = 365, stdout = io.StringIO())
+        manager = setUpSiteManager("gingin", "ginginmanager", "manager@gingin.com")
+        manager.is_staff = True
+        manager.save()
+        self.client.force_login(manager)
+        # the gingin manager only sees and exports the archived gingin visits
+        response = self.client.get("/admin/visitorsite/archivedvisit/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["cl"].result_count, 1)
+        self.assertEqual(self.client.get("/admin/visitorsite/archivedvisit/add/").status_code, 403)
+        response = self.client.get("/exportvisits/gingin?archived=1")
+        rows = list(csv.reader(line.decode("utf-8") for line in response.streaming_content))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(self.client.get("/exportvisits/ridgefield?archived=1").status_code, 403)
+
+# =======================================================================
+
+# KEYSET PAGINATION TEST CASES
+# =======================================================================
+from django.contrib import admin as djangoadmin
+from visitorsite.adminpagination import EstimatedCountPaginator
+
+class KeysetPaginationTestCase(TestCase):
+    URL = "/admin/visitorsite/ridgefieldvisit/"
+
+    def setUp(self):
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS[:1])
+        visitor = models.Visitor.objects.get()
+        start = timezone.now() - timedelta(days = 30)
+        # two visits share each arrival time, so the id decides their order
+        for i in range(11):
+            arrival = start + timedelta(days = i // 2)
+            models.RidgefieldVisit.objects.create(visitor = visitor, arrival = arrival, departure = arrival + timedelta(hours = 1),
+                                                  induction = True, houserules = True, overnight = False, paddock = "")
+        self.expected = list(models.RidgefieldVisit.objects.order_by("-arrival", "-pk").values_list("pk", flat = True))
+        modeladmin = djangoadmin.site._registry[models.RidgefieldVisit]
+        self.addCleanup(setattr, modeladmin, "list_per_page", modeladmin.list_per_page)
+        modeladmin.list_per_page = 3
+        self.client.force_login(User.objects.create_superuser("admin", "admin@uwa.edu.au", "adminpassword"))
+
+    def page(self, query:str = ""):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.URL + query)
+        self.assertEqual(response.status_code, 200)
+        cl = response.context["cl"]
+        return (cl, [i.pk for i in cl.result_list], queries)
+
+    def test_older_and_newer(self):
+        (cl, pks, firstqueries) = self.page()
+        self.assertContains(self.client.get(self.URL), 'Older &rsaquo;</a>')
+        self.assertEqual(cl.result_count, 11)
+        self.assertIsNone(cl.keyset["newer"])
+        pages = [pks]
+        while (cl.keyset["older"] != None):
+            (cl, pks, queries) = self.page(cl.keyset["older"])
+            pages.append(pks)
+            # no OFFSET and the same queries on every page
+            self.assertEqual(len(queries), len(firstqueries))
+            self.assertFalse(any("OFFSET" in i["sql"] for i in queries))
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertEqual([len(i) for i in pages], [3, 3, 3, 2])
+
+        # back to the newest page through the newer links
+        back = []
+        while (cl.keyset["newer"] != None):
+            (cl, pks, queries) = self.page(cl.keyset["newer"])
+            back.insert(0, pks)
+        self.assertEqual(back, pages[:-1])
+
+    def test_fallbacks(self):
+        # a broken key shows the newest rows, sorting by a column uses page numbers
+        (cl, pks, queries) = self.page("?after=yesterday,1")
+        self.assertEqual(pks, self.expected[:3])
+        (cl, pks, queries) = self.page("?o=2&p=2")
+        self.assertIsNone(cl.keyset)
+        self.assertEqual(len(pks), 3)
+        # filters are applied before seeking, and filter links start from the newest rows
+        (cl, pks, queries) = self.page("?isOnSite=current_visit&after=" + cl.key(cl.result_list[0]))
+        self.assertEqual(pks, [])
+        self.assertNotIn("after", cl.get_query_string({"o" : "1"}))
+
+    def test_counts(self):
+        # the unfiltered table is not counted a second time
+        (cl, pks, queries) = self.page()
+        self.assertEqual(len([i for i in queries if ("COUNT(" in i["sql"])]), 1)
+        paginator = EstimatedCountPaginator(models.RidgefieldVisit.objects.order_by("-arrival", "-pk"), 3)
+        self.assertEqual(paginator.count, 11)
+        self.assertFalse(paginator.estimated) # counted exactly below ADMIN_EXACT_COUNT_LIMIT (and on SQLite)
+
+# =======================================================================
+
+# DAILY OCCUPANCY ROLLUP TEST CASES
+# =======================================================================
+from datetime import date
+from visitorsite import rollups
+
+class RollupsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        self.visitors = list(models.Visitor.objects.order_by("pk"))
+        for visit in BASICVISITS[1:]:
+            registerNewVisit("ridgefield", setUpVisitCleanedData(visit), self.visitors)
+
+    def occupancy(self, site:str = "ridgefield"):
+        return {
+            (i.day, i.role_id) : (i.visitors, i.overnight)
+            for i in models.DailyOccupancy.objects.filter(site = site) if (i.visitors or i.overnight)
+        }
+
+    def rebuilt(self, site:str = "ridgefield"):
+        incremental = self.occupancy(site)
+        rollups.rebuild([site])
+        return (incremental, self.occupancy(site))
+
+    def test_registration(self):
+        # the overnight visit is on site on the 27th and 28th and stays the night of the 27th
+        role = self.visitors[0].role_id
+        counts = {(day, visitors, overnight) for ((day, r), (visitors, overnight)) in self.occupancy().items() if (r == role)}
+        perrole = len([i for i in self.visitors if (i.role_id == role)])
+        self.assertEqual(counts, {
+            (date(2022, 12, 27), perrole, perrole), (date(2022, 12, 28), perrole, 0), (date(2022, 12, 31), perrole, 0)
+        })
+        (incremental, rebuilt) = self.rebuilt()
+        self.assertEqual(incremental, rebuilt)
+
+    def test_edit_and_delete(self):
+        visit = models.RidgefieldVisit.objects.filter(overnight = True).order_by("pk").first()
+        visit.departure += timedelta(days = 2)
+        visit.save()
+        models.RidgefieldVisit.objects.filter(overnight = False).order_by("pk").first().delete()
+        (incremental, rebuilt) = self.rebuilt()
+        self.assertEqual(incremental, rebuilt)
+        self.assertIn(date(2022, 12, 30), [day for (day, role) in incremental])
+
+    def test_role_change(self):
+        # archive the first visits, so both archived and current visits change role
+        call_command("archive_visits", days = 365, batch_size = 1, stdout = io.StringIO())
+        for (n, visit) in enumerate(BASICVISITS[1:]):
+            days = [str(timezone.localdate() + timedelta(days = 10 * n + i)) for i in (10, 11)]
+            registerNewVisit("ridgefield", setUpVisitCleanedData(dict(visit, arrivaldate = days[0], departuredate = days[1])), self.visitors)
+        (visitor, other) = (self.visitors[0], models.Role.objects.exclude(pk = self.visitors[0].role_id).first())
+        visitor.role = other
+        with self.captureOnCommitCallbacks(execute = True): # the visits move after the commit
+            visitor.save()
+            profileservice.update_profile(self.visitors[1].user, self.visitors[1], {"role" : other})
+        # saving without the role reads nothing and changes nothing
+        with CaptureQueriesContext(connection) as queries:
+            visitor.save(update_fields = ["first_name"])
+        self.assertFalse(any("dailyoccupancy" in i["sql"] for i in queries))
+        (incremental, rebuilt) = self.rebuilt()
+        self.assertEqual(incremental, rebuilt)
+        self.assertIn(other.pk, [role for (day, role) in incremental])
+
+    def test_role_change_queries(self):
+        (visitor, roles) = (self.visitors[0], list(models.Role.objects.values_list("pk", flat = True)))
+        def change():
+            with CaptureQueriesContext(connection) as queries:
+                rollups.change_roles({visitor.pk : (visitor.role_id, roles[1])})
+            models.Visitor.objects.filter(pk = visitor.pk).update(role = roles[1])
+            (visitor.role_id, roles[1]) = (roles[1], visitor.role_id)
+            return len(queries)
+        registerNewVisit("gingin", setUpVisitCleanedData(BASICVISITS[0]), [visitor])
+        few = change()
+        # a long history, archived and current, costs the same number of queries
+        for day in range(1, 29):
+            registerNewVisit("gingin", setUpVisitCleanedData(dict(BASICVISITS[0], arrivaldate = "2023-02-{:02}".format(day),
+                                                                  departuredate = "2023-02-{:02}".format(day))), [visitor])
+        call_command("archive_visits", days = 365, stdout = io.StringIO())
+        for day in range(1, 11):
+            days = [str(timezone.localdate() + timedelta(days = 3 * day + i)) for i in (0, 1)]
+            registerNewVisit("gingin", setUpVisitCleanedData(dict(BASICVISITS[0], arrivaldate = days[0], departuredate = days[1])), [visitor])
+        self.assertEqual(change(), few)
+        for site in ("ridgefield", "gingin"):
+            (incremental, rebuilt) = self.rebuilt(site)
+            self.assertEqual(incremental, rebuilt)
+
+    def test_archiving_keeps_history(self):
+        before = self.occupancy()
+        call_command("archive_visits", days = 365, stdout = io.StringIO())
+        self.assertEqual(models.RidgefieldVisit.objects.count(), 0)
+        self.assertEqual(self.occupancy(), before)
+        output = io.StringIO()
+        call_command("rebuild_rollups", sites = ["ridgefield"], stdout = output)
+        self.assertIn("Wrote {} daily occupancy rows".format(len(before)), output.getvalue())
+        self.assertEqual(self.occupancy(), before)
+
+    def test_series(self):
+        days = rollups.series(["ridgefield"], date(2022, 12, 1), date(2022, 12, 31))
+        self.assertEqual([i["period"] for i in days], [date(2022, 12, 27), date(2022, 12, 28), date(2022, 12, 31)])
+        self.assertEqual([i["visitors"] for i in days], [len(self.visitors)] * 3)
+        self.assertEqual(days[0]["overnight"], len(self.visitors))
+        months = rollups.series(["ridgefield"], date(2022, 12, 1), date(2022, 12, 31), "month")
+        self.assertEqual(len(months), 1)
+        self.assertEqual(months[0]["visitors"], 3 * len(self.visitors))
+        self.assertEqual(sum(months[0]["roles"].values()), 3 * len(self.visitors))
+        self.assertEqual(rollups.series(["gingin"], date(2022, 12, 1), date(2022, 12, 31)), [])
+
+    def test_dashboard(self):
+        manager = setUpSiteManager("ridgefield", "ridgefieldmanager", "manager@ridgefield.com")
+        manager.is_staff = True
+        manager.save()
+        self.client.force_login(manager)
+        url = "/admin/visitorsite/dailyoccupancy/?start=2022-12-01&end=2022-12-31&period=week"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["totalvisitors"], 3 * len(self.visitors))
+        self.assertEqual(response.context["sites"], [("ridgefield", "UWA Farm Ridgefield")])
+        # the dashboard never reads the visit tables
+        tables = [models.Visit._meta.db_table, models.RidgefieldVisit._meta.db_table, models.GinginVisit._meta.db_table]
+        self.assertFalse(any('"{}"'.format(table) in i["sql"] for i in queries for table in tables))
+        # a gingin manager cannot see the ridgefield counts
+        self.client.force_login(setUpSiteManager("gingin", "ginginmanager", "manager@gingin.com"))
+        User.objects.filter(username = "ginginmanager").update(is_staff = True)
+        response = self.client.get(url + "&site=ridgefield")
+        self.assertEqual(response.context["totalvisitors"], 0)
+        self.client.force_login(User.objects.create_user("visitor", "visitor@uwa.edu.au", "visitorpassword", is_staff = True))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+# =======================================================================
+
+# VISITOR SEARCH TEST CASES
+# =======================================================================
+from visitorsite import search
+
+class VisitorSearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        self.visitors = {i.user.username : i for i in models.Visitor.objects.select_related("user")}
+        registerNewVisit("ridgefield", setUpVisitCleanedData(BASICVISITS[1]), list(self.visitors.values()))
+
+    def found(self, term:str):
+        visitors = models.Visitor.objects.filter(pk__in = search.matching_visitors(term)).select_related("user")
+        return sorted(i.user.username if (i.user != None) else i.first_name for i in visitors)
+
+    def test_fields(self):
+        self.assertEqual(self.found("Appleseed"), [JOHNA])
+        self.assertEqual(self.found("john"), [JOHNA, JOHND])
+        self.assertEqual(self.found("ohn"), [JOHNA, JOHND]) # inside a word
+        self.assertEqual(self.found("john doe"), [JOHND]) # every word
+        self.assertEqual(self.found("doe@jd"), [JOHND])
+        self.assertEqual(self.found("999 888"), [JOHNA])
+        self.assertEqual(self.found("nordström"), [ARI])
+        self.assertEqual(self.found("somebody"), [JOHNA, JOHND]) # emergency contact
+        self.assertEqual(self.found("某人"), [ARI]) # too short for trigrams
+        self.assertEqual(self.found("Appleseeb"), [JOHNA]) # misspelt
+        self.assertEqual(self.found("Zyx"), [])
+
+    def test_index_follows_changes(self):
+        visitor = self.visitors[JOHND]
+        with self.captureOnCommitCallbacks(execute = True): # indexed again after the commit
+            profileservice.update_profile(visitor.user, visitor, {"last_name" : "Whitfield"})
+        self.assertEqual(self.found("whitfield"), [JOHND])
+        self.assertEqual(self.found("doe"), [JOHND]) # still in the e-mail address
+        # saving columns that are not searched does not index the visitor again
+        visitor.role = models.Role.objects.get(name = "Other")
+        with CaptureQueriesContext(connection) as queries:
+            visitor.save(update_fields = ["role"])
+        self.assertFalse(any(models.SearchTrigram._meta.db_table in i["sql"] for i in queries))
+        contact = visitor.emergencycontact
+        contact.name = "Marguerite"
+        contact.save()
+        self.assertEqual(self.found("marguerite"), [JOHND])
+        registerNewVisitors([{
+            "first_name" : "Teamy", "last_name" : "Member", "email" : "teamy@example.com", "phone" : "0411 222 333",
+            "role" : models.Role.objects.get(name = "Other"), "emergencyname" : "Someone", "emergencyphone" : "1",
+            "relationship" : "Friend"
+        }])
+        self.assertEqual(self.found("teamy"), ["Teamy"])
+        index = sorted(models.SearchTrigram.objects.values_list("visitor_id", "trigram"))
+        output = io.StringIO()
+        call_command("rebuild_search_index", stdout = output)
+        self.assertIn("Indexed 4 visitors", output.getvalue())
+        self.assertEqual(sorted(models.SearchTrigram.objects.values_list("visitor_id", "trigram")), index)
+
+    def test_admin(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@uwa.edu.au", "adminpassword"))
+        for (url, expected) in (("/admin/visitorsite/visitor/", [self.visitors[JOHNA].pk]),
+                                ("/admin/visitorsite/ridgefieldvisit/",
+                                 list(models.RidgefieldVisit.objects.filter(visitor__user__username = JOHNA).values_list("pk", flat = True)))):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url + "?q=appleseed")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([i.pk for i in response.context["cl"].result_list], expected)
+            # answered from the search index
+            self.assertTrue(any(models.SearchTrigram._meta.db_table in i["sql"] for i in queries))
+            # keyset pages keep the search
+            self.assertEqual(response.context["cl"].get_query_string({"after" : "x"}).count("q=appleseed"), 1)
+
+@skipUnless(connection.vendor == "postgresql", "the pg_trgm search only runs on PostgreSQL")
+class PostgreSQLSearchTestCase(TestCase):
+    def setUp(self):
+        VisitorSearchTestCase.setUp(self)
+
+    def test_trigram_indexes(self):
+        # migration 0005 created a trigram index on every searched column
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE indexdef LIKE %s", ["%gin_trgm_ops%"])
+            names = set(i[0] for i in cursor.fetchall())
+        self.assertEqual(len(names), len(search.VISITORFIELDS) + len(search.CONTACTFIELDS))
+
+    def test_lookups(self):
+        found = lambda term: VisitorSearchTestCase.found(self, term)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(found("ohn"), [JOHNA, JOHND])
+        self.assertTrue(any(" ILIKE " in i["sql"] for i in queries))
+        self.assertEqual(found("john doe"), [JOHND])
+        self.assertEqual(found("somebody"), [JOHNA, JOHND]) # emergency contact
+        self.assertEqual(found("某人"), [ARI])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(found("Appleseeb"), [JOHNA]) # misspelt
+        self.assertTrue(any(" %> " in i["sql"] for i in queries))
+        # PostgreSQL keeps its own indexes, the SearchTrigram table stays empty
+        self.assertFalse(models.SearchTrigram.objects.exists())
+
+# =======================================================================
+
+# VISITOR IDENTITY TEST CASES
+# =======================================================================
+from visitorsite import identity
+
+class VisitorIdentityTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+        setUpVisitors(BASICVISITORS)
+        self.request = SimpleNamespace(user = User.objects.get(username = ARI))
+
+    def registerteam(self, day:int, team = None):
+        visit = forms.RidgefieldVisitForm(data = dict(setUpVisitForms(BASICVISITS[1:2])[0].data,
+                                                      arrivaldate = "2023-01-{:02}".format(day),
+                                                      departuredate = "2023-01-{:02}".format(day + 1)))
+        self.assertTrue(visit.is_valid())
+        VisitorMiddleware(lambda request: None).process_request(self.request)
+        with CaptureQueriesContext(connection) as queries:
+            _teamnewvisit_internal(self.request, "ridgefield", visit, team or setUpTeamForm(4, [JOHND]))
+        return queries
+
+    def test_key(self):
+        self.assertEqual(identity.canonical_phone("0400 999 888"), "+61400999888")
+        self.assertEqual(identity.canonical_phone("+1-407-123-4567"), "+14071234567")
+        self.assertEqual(identity.canonical_phone("0061 8 9123 4567"), "+61891234567")
+        self.assertEqual(identity.canonical_phone(" "), "")
+        self.assertEqual(identity.identity_key("Ja@AJ.net", "0400-999-888", "Jo", "Ng"),
+                         identity.identity_key("Ja@aj.net", "+61 400 999 888", " JO ", "ng"))
+        self.assertNotEqual(identity.identity_key("JA@aj.net", "0400 999 888", "Jo", "Ng"),
+                            identity.identity_key("ja@aj.net", "0400 999 888", "Jo", "Ng"))
+        # people sharing a parent's e-mail address and phone number
+        self.assertNotEqual(identity.identity_key("ja@aj.net", "0400 999 888", "Jo", "Ng"),
+                            identity.identity_key("ja@aj.net", "0400 999 888", "Al", "Ng"))
+        self.assertEqual(identity.identity_key("", "0400 999 888", "Jo", "Ng"), "")
+        # saved visitors get their key, and keep it up to date when their details change
+        visitor = models.Visitor.objects.get(user__username = JOHNA)
+        self.assertEqual(visitor.identity, "ja@aj.net|+61400999888|john|appleseed")
+        profileservice.update_profile(visitor.user, visitor, {"phone" : "0400 999 777"})
+        self.assertEqual(models.Visitor.objects.get(pk = visitor.pk).identity, "ja@aj.net|+61400999777|john|appleseed")
+
+    def test_registered_again(self):
+        self.registerteam(1)
+        members = list(models.Visitor.objects.filter(user = None).order_by("pk"))
+        self.assertEqual(len(members), 3)
+        # the same members come again, one with their name written differently and a new emergency contact
+        team = setUpTeamForm(4, [JOHND])
+        team.forms[2].cleaned_data.update({"team_last_name" : " TEAM", "team_emergencyname" : "Spouse",
+                                           "team_email" : "member2@Team.com"})
+        queries = self.registerteam(5, team)
+        self.assertEqual(list(models.Visitor.objects.filter(user = None).order_by("pk")), members)
+        for member in members:
+            self.assertEqual(models.RidgefieldVisit.objects.filter(visitor = member).count(), 2)
+        member = models.Visitor.objects.select_related("emergencycontact").get(pk = members[1].pk)
+        self.assertEqual((member.last_name, member.emergencycontact.name), (" TEAM", "Spouse"))
+        self.assertEqual(models.EmergencyContact.objects.count(), len(BASICVISITORS) + 3)
+        # one indexed lookup finds them all
+        self.assertEqual(len([i for i in queries if ('"identity" IN' in i["sql"])]), 1)
+        self.assertEqual(search.matching_visitors("spouse").count(), 1)
+
+    def test_siblings_not_merged(self):
+        # two children registered with their parent's e-mail address and phone number
+        team = setUpTeamForm(3, [JOHND])
+        team.forms[2].cleaned_data.update({"team_email" : "member1@TEAM.com", "team_phone" : "0400 000 001"})
+        self.registerteam(1, team)
+        members = models.Visitor.objects.filter(user = None).order_by("pk")
+        self.assertEqual([i.first_name for i in members], ["Member1", "Member2"])
+        self.assertEqual(len(set(i.identity for i in members)), 2)
+        # and again, each keeping their own visitor and name
+        self.registerteam(5, team)
+        self.assertEqual([i.first_name for i in members.all()], ["Member1", "Member2"])
+        for member in members:
+            self.assertEqual(models.RidgefieldVisit.objects.filter(visitor = member).count(), 2)
+
+    def test_accounts_not_reused(self):
+        johnd = BASICVISITORS[0]
+        team = setUpTeamForm(2, [])
+        team.forms[0].cleaned_data.update({"team_email" : johnd["email"], "team_phone" : johnd["phone"]})
+        self.registerteam(1, team)
+        # someone entering another person's details does not book them or see their account
+        self.assertEqual(models.RidgefieldVisit.objects.filter(visitor__user__username = JOHND).count(), 0)
+        self.assertEqual(models.Visitor.objects.filter(user = None).count(), 2)
+
+    def test_merge_duplicates(self):
+        # duplicates registered before visitors were recognised
+        contact = lambda name: models.EmergencyContact.objects.create(name = name, phone = "1", relationship = "Parent")
+        role = models.Role.objects.get(name = "Other")
+        duplicates = [
+            models.Visitor.objects.create(first_name = "Dup", last_name = ("Lee", "LEE", " lee")[i], email = "dup@uwa.edu.au",
+                                          phone_number = "0400 123 456" if (i % 2) else "+61 400 123 456",
+                                          role = role, emergencycontact = contact("Contact{}".format(i)))
+            for i in range(3)
+        ]
+        for (day, visitor) in enumerate(duplicates, start = 1):
+            registerNewVisit("gingin", setUpVisitCleanedData(dict(BASICVISITS[0], arrivaldate = "2023-02-{:02}".format(day),
+                                                                  departuredate = "2023-02-{:02}".format(day))), [visitor])
+        output = io.StringIO()
+        call_command("merge_duplicate_visitors", dry_run = True, stdout = output)
+        self.assertIn("1 people have duplicate visitors", output.getvalue())
+        self.assertEqual(models.Visitor.objects.filter(user = None).count(), 3)
+
+        call_command("merge_duplicate_visitors", batch_size = 1, stdout = io.StringIO())
+        kept = models.Visitor.objects.select_related("emergencycontact").get(user = None)
+        self.assertEqual(kept.pk, duplicates[0].pk)
+        self.assertEqual((kept.last_name, kept.emergencycontact.name), (" lee", "Contact2")) # the latest details
+        self.assertEqual(models.GinginVisit.objects.filter(visitor = kept).count(), 3)
+        self.assertFalse(models.EmergencyContact.objects.filter(name__in = ["Contact0", "Contact1"]).exists())
+        self.assertEqual(list(identity.duplicate_keys()), [])
+        self.assertEqual(search.matching_visitors("contact2").count(), 1)
+
+# =======================================================================
+
+# ROLE CATALOGUE TEST CASES
+# =======================================================================
+from visitorsite.views import registerNewVisitor
+
+class RoleCatalogueTestCase(TestCase):
+    MEMBERS = 50
+
+    def setUp(self):
+        cache.clear()
+        setUpRoles(BASICROLES)
+
+    def rolequeries(self, function):
+        with CaptureQueriesContext(connection) as queries:
+            result = function()
+        return (result, len([i for i in queries if (models.Role._meta.db_table in i["sql"])]))
+
+    def test_team_formset(self):
+        TeamFormSet = formset_factory(forms.TeamVisitorForm, extra = self.MEMBERS)
+        (html, queries) = self.rolequeries(lambda: str(TeamFormSet()))
+        self.assertLessEqual(queries, 1)
+        self.assertEqual(html.count(">UWA Student</option>"), self.MEMBERS)
+        (html, queries) = self.rolequeries(lambda: str(TeamFormSet()))
+        self.assertEqual(queries, 0)
+
+        other = models.Role.objects.get(name = "Other")
+        data = {"form-TOTAL_FORMS": str(self.MEMBERS), "form-INITIAL_FORMS": "0"}
+        for i in range(self.MEMBERS):
+            data.update({"form-{}-team_username".format(i) : "", "form-{}-team_first_name".format(i) : "A",
+                         "form-{}-team_last_name".format(i) : "B", "form-{}-team_email".format(i) : "a{}@b.com".format(i),
+                         "form-{}-team_phone".format(i) : "0400 000 000", "form-{}-team_role".format(i) : str(other.pk),
+                         "form-{}-team_emergencyname".format(i) : "C", "form-{}-team_emergencyphone".format(i) : "1",
+                         "form-{}-team_relationship".format(i) : "Friend"})
+        formset = TeamFormSet(data)
+        (valid, queries) = self.rolequeries(formset.is_valid)
+        self.assertTrue(valid)
+        self.assertEqual(queries, 0)
+        self.assertEqual(formset.forms[0].cleaned_data["team_role"], other)
+
+        data["form-0-team_role"] = "999"
+        self.assertFalse(TeamFormSet(data).is_valid())
+
+    def test_invalidated(self):
+        self.assertEqual([i.name for i in rolecache.roles()], BASICROLES)
+        role = models.Role.objects.create(name = "Volunteer")
+        self.assertIn(role, rolecache.roles())
+        self.assertIn(">Volunteer</option>", str(forms.VisitorProfileFieldsChangeForm()))
+        role.name = "Helper"
+        role.save()
+        self.assertEqual(rolecache.by_name("Helper"), role)
+        self.assertEqual(rolecache.by_name("Volunteer"), None)
+        role.delete()
+        self.assertEqual(rolecache.by_pk(role.pk), None)
+        self.assertNotIn(">Helper</option>", str(forms.VisitorProfileFieldsChangeForm()))
+
+    def test_registration(self):
+        visitor = dict(BASICVISITORS[0], role = models.Role.objects.get(name = "Contractor"))
+        rolecache.roles()
+        (created, queries) = self.rolequeries(lambda: registerNewVisitor(visitor))
+        self.assertEqual(queries, 0)
+        self.assertEqual(models.Visitor.objects.get(pk = created.pk).role.name, "Contractor")
+
+from django.core.mail.backends.base import BaseEmailBackend
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError("mail server unavailable")
+
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+
+class RefusingEmailBackend(LocmemEmailBackend):
+    # the mail server refuses one site manager's address
+    def send_messages(self, email_messages):
+        if (any("manager2@ridgefield.com" in i.to for i in email_messages)):
+            raise ConnectionError("recipient refused")
+        return super().send_messages(email_messages)
+# =======================================================================
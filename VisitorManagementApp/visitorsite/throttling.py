@@ -0,0 +1,97 @@
+"""Seperate module limiting login and registration attempts per address and per username (token buckets)"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from visitorsite import instrumentation
+
+instrumentation.define("visitorsite_throttle_total", "counter",
+                       "Login and registration attempts checked against each limit, allowed or rejected.")
+
+def _refill(tokens:float, updated:float, now:float, capacity:int, seconds:float):
+    # a bucket holds up to `capacity` attempts and refills completely in `seconds`
+    return min(capacity, tokens + (now - updated) * capacity / seconds)
+
+# BUCKETS
+# A backend keeps one bucket per key. take() removes an attempt from the bucket and returns
+# False if it was empty.
+# ============================================================
+class MemoryBuckets:
+    """Buckets of this process only (each worker process allows the full number of attempts)."""
+    MAXKEYS = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {} # key: (tokens, updated, seconds)
+
+    def take(self, key:str, capacity:int, seconds:float):
+        now = time.monotonic()
+        with self.lock:
+            if (len(self.buckets) >= self.MAXKEYS): self.prune(now)
+            (tokens, updated, s) = self.buckets.get(key, (capacity, now, seconds))
+            tokens = _refill(tokens, updated, now, capacity, seconds)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if (allowed) else tokens, now, seconds)
+        return allowed
+
+    def prune(self, now:float):
+        # buckets untouched for their refill time are full again, the same as a missing bucket
+        self.buckets = {k : v for (k, v) in self.buckets.items() if (now - v[1] < v[2])}
+
+    def clear(self):
+        with self.lock:
+            self.buckets = {}
+
+class CacheBuckets:
+    """
+    Buckets in a cache shared by every worker process (e.g. Redis or Memcached). Two processes
+    updating the same bucket at the same moment may both let an attempt through, which is close
+    enough for a rate limit.
+    """
+    def __init__(self, alias:str):
+        self.alias = alias
+
+    def take(self, key:str, capacity:int, seconds:float):
+        cache = caches[self.alias]
+        now = time.time()
+        # usernames are user input, so they are hashed to make a valid cache key
+        key = "throttle:" + hashlib.md5(key.encode()).hexdigest()
+        (tokens, updated) = cache.get(key, (capacity, now))
+        tokens = _refill(tokens, updated, now, capacity, seconds)
+        allowed = tokens >= 1
+        cache.set(key, (tokens - 1 if (allowed) else tokens, now), int(seconds) + 1)
+        return allowed
+
+    def clear(self):
+        caches[self.alias].clear()
+
+_memory = MemoryBuckets()
+
+def buckets():
+    return _memory if (settings.THROTTLE_CACHE == None) else CacheBuckets(settings.THROTTLE_CACHE)
+# ============================================================
+
+def allow(request, action:str, username:str = None):
+    """
+    Takes an attempt at an action (e.g. "login") from the buckets of the client's address and of
+    the username, with the limits in settings.THROTTLE_RATES. Returns False if either is empty, in
+    which case the view must refuse the attempt before hashing any password. Actions without
+    limits are always allowed.
+    """
+    limits = settings.THROTTLE_RATES.get(action, {})
+    keys = {
+        "ip" : request.META.get("REMOTE_ADDR", ""),
+        # usernames are case insensitive here, so changing the case does not give more attempts
+        "username" : (username or "").strip().lower()
+    }
+    allowed = True
+    for (limit, (capacity, seconds)) in limits.items():
+        if (not keys[limit]): continue # no username given
+        ok = buckets().take("{}:{}:{}".format(action, limit, keys[limit]), capacity, seconds)
+        instrumentation.inc("visitorsite_throttle_total", action = action, limit = limit,
+                            result = "allowed" if (ok) else "rejected")
+        allowed = allowed and ok
+    return allowed
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from visitorsite import views, teamviews
+from visitorsite import views, teamviews, importviews, exportviews, metricsviews
 
 urlpatterns = [
     # welcome page
@@ -16,12 +16,19 @@ urlpatterns = [
     path("deleteaccount", views.deleteaccount),
     path("changeemergency", views.changeemergency),
     path("changedetails", views.changedetails),
+    path("api/profile", views.profileapi),
     path("password", views.password),
     path("newvisit/<str:site>", views.newvisit),
     path("sitecontacts", views.site_emergency_contacts),
     path("transitionpage", views.transitionpage),
     path("bulkregister", teamviews.teamregister),
     path("teamtransitionpage/<int:n>", teamviews.teamtransitionpage),
-    path("teamtransitionpage/<int:n>/<str:site>", teamviews.teamnewvisit, name = "teamnewvisit")
+    path("teamtransitionpage/<int:n>/<str:site>", teamviews.teamnewvisit, name = "teamnewvisit"),
+    path("importvisits", importviews.importvisits),
+    path("exportvisits/<str:site>", exportviews.exportvisits),
+    path("occupancy/<str:site>", views.site_occupancy),
+
+    # monitoring
+    path("metrics", metricsviews.metrics)
     
 ]
\ No newline at end of file
@@ -3,31 +3,37 @@ from django.shortcuts import render, redirect
 from django.contrib import messages # flash messages
 from django.contrib.auth.models import User, auth
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 
 from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.forms import PasswordChangeForm
 
 from django.urls import reverse_lazy
+from django.http import JsonResponse, Http404
+from django.views.decorators.http import require_http_methods
+from django.core.exceptions import PermissionDenied
+
+from django.db import transaction, connections
 
 from .globals import *
 
 from . import models, forms
 
+import json
 from datetime import datetime
+from functools import wraps
+from django.utils import timezone
+from asgiref.sync import sync_to_async
 
-from visitorsite.emailservice import _send_notification
+from visitorsite.emailservice import queue_notifications
+from visitorsite import occupancy, bookingchecks, throttling, profileservice, rollups, search, identity, rolecache
+from visitorsite.identity import normaliseEmail
+from visitorsite.pagecache import cached_page
 
 
 # FUNCTIONS USED MULTIPLE TIMES
 # ============================================================
 
-# Django converts the domain part of the email to lower case (base_user.py line 20, normalize_email)
-# for bulk-registration attempts that do not bind to a User object, normalise the e-mail address
-# as if it were part of the User object. This will make the site manager page more consistent
-def normaliseEmail(x:str):
-    # the first part should include @ because we cannot lower this (for safety)
-    return x[:x.rfind('@') + 1] + x[x.rfind('@') + 1:].lower()
-
 def registerNewVisitor(visitor:forms.VisitorProfileForm, userprofile:bool = True):
     # create user object first
     user = None
@@ -35,12 +41,10 @@ def registerNewVisitor(visitor:forms.VisitorProfileForm, userprofile:bool = True
         user = User.objects.create_user(
             username = visitor["username"],
             email=visitor["email"],
-            password=visitor["password"] # password is hashed upon constructing the object
+            password=visitor["password"], # password is hashed upon constructing the object
+            first_name = visitor["first_name"],
+            last_name = visitor["last_name"]
         )
-        user.first_name = visitor["first_name"]
-        user.last_name = visitor["last_name"]
-
-        user.save()
     
     # create the emergency contact
     newEmergencyContact = models.EmergencyContact.objects.create(
@@ -49,8 +53,6 @@ def registerNewVisitor(visitor:forms.VisitorProfileForm, userprofile:bool = True
         relationship = visitor["relationship"]
     )
 
-    newEmergencyContact.save()
-
     # create the visitor
     newVisitor = models.Visitor.objects.create(
         user = user,
@@ -58,13 +60,142 @@ def registerNewVisitor(visitor:forms.VisitorProfileForm, userprofile:bool = True
         last_name = visitor["last_name"],
         email = normaliseEmail(visitor["email"]),
         phone_number=visitor["phone"],
-        role=models.Role.objects.filter(name=visitor["role"]).first(),
+        role=rolecache.by_name(str(visitor["role"])),
         emergencycontact = newEmergencyContact
         )
-    newVisitor.save()
 
     return newVisitor # return for team registration function
 
+def registerNewVisitors(visitors:list):
+    """
+    registerNewVisitors is the bulk version of registerNewVisitor for visitors without
+    a user profile (team members without an account). Members registered before (same name,
+    e-mail address and phone number, see identity.py) are found with one indexed query and reuse their
+    visitor, with their details and emergency contact brought up to date. All emergency contacts
+    and all visitors are inserted (or updated) with one query each, whatever the number of visitors.
+    The role of each visitor must already be a Role object (as in a cleaned form).
+    Returns the visitor of each member, in order.
+    """
+    keys = [identity.identity_key(visitor["email"], visitor["phone"], visitor["first_name"], visitor["last_name"])
+            for visitor in visitors]
+    existing = identity.existing_visitors(keys)
+    # the same person entered twice gets one visitor (members without a key are always new)
+    new = {}
+    for (i, key) in enumerate(keys):
+        if (key not in existing): new.setdefault(key or i, i)
+
+    newEmergencyContacts = models.EmergencyContact.objects.bulk_create([
+        models.EmergencyContact(
+            name = visitors[i]["emergencyname"],
+            phone = visitors[i]["emergencyphone"],
+            relationship = visitors[i]["relationship"]
+        )
+        for i in new.values()
+    ])
+
+    newVisitors = models.Visitor.objects.bulk_create([
+        models.Visitor(
+            user = None,
+            first_name = visitors[i]["first_name"],
+            last_name = visitors[i]["last_name"],
+            email = normaliseEmail(visitors[i]["email"]),
+            phone_number = visitors[i]["phone"],
+            role = visitors[i]["role"],
+            emergencycontact = newEmergencyContact,
+            identity = keys[i]
+        )
+        for (i, newEmergencyContact) in zip(new.values(), newEmergencyContacts)
+    ])
+    created = dict(zip(new.keys(), newVisitors))
+
+    # returning members: their latest details replace the ones given last time
+    roles = {}
+    for (visitor, key) in zip(visitors, keys):
+        if (key not in existing): continue
+        member = existing[key]
+        roles[member.pk] = (member.role_id, visitor["role"].pk)
+        member.first_name = visitor["first_name"]
+        member.last_name = visitor["last_name"]
+        member.email = normaliseEmail(visitor["email"])
+        member.phone_number = visitor["phone"]
+        member.role = visitor["role"]
+        if (member.emergencycontact != None):
+            member.emergencycontact.name = visitor["emergencyname"]
+            member.emergencycontact.phone = visitor["emergencyphone"]
+            member.emergencycontact.relationship = visitor["relationship"]
+    if (len(existing) != 0):
+        models.Visitor.objects.bulk_update(existing.values(), ["first_name", "last_name", "email", "phone_number", "role"])
+        models.EmergencyContact.objects.bulk_update(
+            [i.emergencycontact for i in existing.values() if (i.emergencycontact != None)], ["name", "phone", "relationship"])
+        rollups.change_roles(roles)
+
+    # bulk inserts and updates do not send post_save, so the visitors are (re)indexed for search here
+    search.index_visitors(newVisitors + list(existing.values()))
+    return [existing[key] if (key in existing) else created[key or i] for (i, key) in enumerate(keys)]
+
+def bulkCreateVisits(visitorm, visits:list, batch_size:int = 500):
+    """
+    Visit-derived models use multi-table inheritance (the visit fields are stored in the Visit
+    table, site-specific fields in the site table), which Django's bulk_create does not support.
+    The Visit rows are bulk-created first, then the site rows are inserted pointing to them, so
+    any number of visits costs two INSERT statements (per batch_size visits).
+    """
+    if (len(visits) == 0): return visits
+    # attname (visitor_id) copies the foreign key without loading the visitor of every visit
+    parentfields = [field.attname for field in models.Visit._meta.concrete_fields if (not field.primary_key)]
+    parents = models.Visit.objects.bulk_create(
+        [models.Visit(**{field: getattr(visit, field) for field in parentfields}) for visit in visits],
+        batch_size = batch_size
+    )
+    for (visit, parent) in zip(visits, parents):
+        visit.visit_ptr_id = parent.pk
+
+    # same as what Model.save() does for the child table of an inherited model
+    childfields = visitorm._meta.local_concrete_fields
+    db = parents[0]._state.db
+    batch_size = min(batch_size, connections[db].ops.bulk_batch_size(childfields, visits))
+    for i in range(0, len(visits), batch_size):
+        visitorm._base_manager._insert(visits[i:i + batch_size], fields = childfields, using = db)
+    for visit in visits:
+        visit._state.adding = False
+        visit._state.db = db
+    return visits
+
+def newVisitObject(site, visit:forms.VisitForm, visitor:models.Visitor):
+    """Builds (but does not save) the Visit-derived object for a cleaned visit form and a visitor."""
+    visitorm = models.visitmodel(site)
+    kwargs = {
+        "visitor" : visitor,
+        # the form has no time zone, the visit is in the time zone of the server (TIME_ZONE)
+        "arrival" : timezone.make_aware(datetime.combine(visit["arrivaldate"], visit["arrivaltime"])),
+        "departure" : timezone.make_aware(datetime.combine(visit["departuredate"], visit["departuretime"])),
+        "induction" : visit["induction"],
+        "houserules" : visit["houserules"],
+        "overnight" : visit["overnight"],
+    }
+    if (site == "ridgefield"): kwargs.update({"paddock": visit["paddock"]})
+
+    # unpack arguments with **kwargs
+    return visitorm(**kwargs)
+
+def saveNewVisits(site, visits:list):
+    """
+    Saves visits built by newVisitObject and notifies the site manager about them, with a
+    fixed number of queries however many visits there are. Raises bookingchecks.BookingConflict
+    (a ValueError) without saving anything if a visitor is double-booked or the site is full.
+    """
+    with transaction.atomic():
+        bookingchecks.check_new_visits(site, visits)
+        visits = bulkCreateVisits(models.visitmodel(site), visits)
+
+        # finally, notify the site manager (the notification worker sends the e-mails)
+        queue_notifications(site, visits)
+        # bulk inserts do not send post_save, so drop the cached site occupancy and count the
+        # visits in the daily occupancy here
+        occupancy.invalidate(site)
+        rollups.add_visits(site, visits)
+    return visits
+
 def registerNewVisit(site, visit:forms.VisitForm, visitors:list):
     """
     registerNewVisit takes in a cleaned visit form and a list
@@ -74,35 +205,28 @@ def registerNewVisit(site, visit:forms.VisitForm, visitors:list):
     registration which would make the code look more tidy in the bulk
     registration function.
     """
-
-    visitorm = None
-
-    if (site == "ridgefield"):
-        visitorm = models.RidgefieldVisit
-    elif (site == "gingin"):
-        visitorm = models.GinginVisit
-
-    if (visitorm == None): # back-end developer hired by the client might not have done their job
-        raise ValueError("{} could not be converted into a Visit-derived model (did you forget to make it)?".format(site))
+    return saveNewVisits(site, [newVisitObject(site, visit, visitor) for visitor in visitors])
     
-    for visitor in visitors:
-        kwargs = {
-            "visitor" : visitor,
-            "arrival" : datetime.combine(visit["arrivaldate"], visit["arrivaltime"]),
-            "departure" : datetime.combine(visit["departuredate"], visit["departuretime"]),
-            "induction" : visit["induction"],
-            "houserules" : visit["houserules"],
-            "overnight" : visit["overnight"],
-        }
-        if (site == "ridgefield"): kwargs.update({"paddock": visit["paddock"]})
-        
-        # unpack arguments with **kwargs
-        newVisit = visitorm.objects.create(**kwargs)
-        newVisit.save()
 
-        # finally, notify the site manager
-        _send_notification(site, newVisit)
-    
+# Async views
+# Django 4.1 loads request.user (and the session it comes from) from the database on first use,
+# which is not allowed in async code, and login_required only wraps sync views
+async def loadUser(request):
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+async def loadVisitor(request):
+    # request.visitor is loaded lazily as well (see middleware.py)
+    await sync_to_async(lambda: request.visitor.pk)()
+    return request.visitor
+
+def asyncLoginRequired(view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if (not (await loadUser(request)).is_authenticated):
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
 # ============================================================
 
 # ROUTES
@@ -110,6 +234,7 @@ def registerNewVisit(site, visit:forms.VisitForm, visitors:list):
 
 # General
 # ------------------------------------------------------------
+@cached_page("index")
 def index(request):
     if (request.user.is_authenticated): return redirect(account)
     return render(request, "index.html", {"logged_in" : request.user.is_authenticated})
@@ -118,6 +243,7 @@ def index(request):
 # Logged out forms
 # ------------------------------------------------------------
 def register(request):
+    status = 200
     if (request.method == "GET"):
         # if the user had authenticated, no need to log in again
         if (request.user.is_authenticated):
@@ -127,7 +253,11 @@ def register(request):
         
     if (request.method == "POST"): # user submitted a form
         visitorForm = forms.VisitorProfileForm(request.POST)
-        if visitorForm.is_valid(): # the form contains no errors
+        # refused before the form validates the password
+        if (not throttling.allow(request, "register", request.POST.get("username"))):
+            messages.error(request, "Too many attempts, please try again in a few minutes.")
+            status = 429
+        elif visitorForm.is_valid(): # the form contains no errors
             if User.objects.filter(username = visitorForm.cleaned_data["username"]).exists():
                 # username existed
                 messages.error(request, "The username already exists!")
@@ -146,25 +276,30 @@ def register(request):
         "submit_button_value" : "Register",
     }
 
-    return render(request, BASICFORMTEMPLATE, context)
+    return render(request, BASICFORMTEMPLATE, context, status = status)
 
-def login(request):
+async def login(request):
     # if logged in, no need to log in again
-    if (request.user.is_authenticated): return redirect(account)
+    if ((await loadUser(request)).is_authenticated): return redirect(account)
 
+    status = 200
     if (request.method == "GET"):
         visitorLogin = forms.VisitorLoginForm()
 
     if (request.method == "POST"): # user submitted the form
         visitorLogin = forms.VisitorLoginForm(request.POST)
-        if visitorLogin.is_valid(): # no errors
-            # attempt to authenticate with Django
-            user = auth.authenticate(
+        # refused before the password is hashed (the buckets may be in the cache, so not in the event loop)
+        if (not await sync_to_async(throttling.allow)(request, "login", request.POST.get("username"))):
+            messages.error(request, "Too many attempts, please try again in a few minutes.")
+            status = 429
+        elif visitorLogin.is_valid(): # no errors
+            # attempt to authenticate with Django (password hashing runs in a thread, not in the event loop)
+            user = await sync_to_async(auth.authenticate)(
                 username = visitorLogin.cleaned_data["username"],
                 password = visitorLogin.cleaned_data["password"]
                 )
             if user is not None: # successful authentication
-                auth.login(request, user)
+                await sync_to_async(auth.login)(request, user)
                 return redirect(account)
             else: # either username or pasword is wrong (Django does not specify)
                 messages.error(request, "Username or password is wrong!")
@@ -179,7 +314,7 @@ def login(request):
         "submit_button_value" : "Login"
     }
 
-    return render(request, BASICFORMTEMPLATE, context)
+    return render(request, BASICFORMTEMPLATE, context, status = status)
 
 # Logged in forms
 # ------------------------------------------------------------
@@ -204,7 +339,7 @@ def deleteaccount(request):
     # deleting the user will automatically delete the visitor
     # and log out   
     if (request.method == "POST"):
-        models.Visitor.objects.get(user = request.user).delete()
+        request.visitor.delete()
         request.user.delete()
         messages.success(request, "Your account has been deleted!")
         return redirect(index)
@@ -223,27 +358,8 @@ def changedetails(request):
     elif (request.method == "POST"):
         passwordForm = forms.VisitorProfileFieldsChangeForm(request.POST)
         if (passwordForm.is_valid()):
-            for (field, value) in passwordForm.cleaned_data.items():
-                # ignore empty fields
-                if (value == "" or value == None): continue
-                # remaining fields are attached to the Visitor object
-                visitor = models.Visitor.objects.get(user = request.user)
-                if (field == "first_name"): 
-                    request.user.first_name = value
-                    visitor.first_name = value
-                elif (field == "last_name"): 
-                    request.user.last_name = value
-                    visitor.last_name = value
-                elif (field == "email"): 
-                    request.user.email = value
-                    visitor.email = value
-                elif (field == "role"):
-                    visitor.role = value
-                elif (field == "phone"):
-                    visitor.phone_number = value
-                
-                visitor.save()
-                request.user.save() # save each iteration
+            # empty fields are ignored, only the fields that changed are written
+            profileservice.update_profile(request.user, request.visitor, passwordForm.cleaned_data)
             messages.success(request, "Successfully changed specified fields!")
             return redirect(account)
 
@@ -257,7 +373,33 @@ def changedetails(request):
             "submit_button_value": "Change details"
         }
     return render(request, BASICFORMTEMPLATE, context)
-    
+
+@require_http_methods(["GET", "PATCH"])
+def profileapi(request):
+    """
+    The visitor's details as JSON for the mobile front-end. PATCH changes the details given in a
+    JSON object (same fields and rules as changedetails, the role is given by its id) and returns
+    the new details with the names of the fields that changed.
+    """
+    if (not request.user.is_authenticated):
+        return JsonResponse({"error" : "Not logged in"}, status = 401)
+    if (request.user.is_staff):
+        return JsonResponse({"error" : "Site managers do not have a visitor profile"}, status = 403)
+
+    if (request.method == "GET"):
+        return JsonResponse(profileservice.profile(request.user, request.visitor))
+
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error" : "The request body is not valid JSON"}, status = 400)
+    if (not isinstance(data, dict)):
+        return JsonResponse({"error" : "The request body must be a JSON object"}, status = 400)
+    details = forms.VisitorProfileFieldsChangeForm(data)
+    if (not details.is_valid()):
+        return JsonResponse({"errors" : details.errors.get_json_data()}, status = 400)
+    changed = profileservice.update_profile(request.user, request.visitor, details.cleaned_data)
+    return JsonResponse(dict(profileservice.profile(request.user, request.visitor), changed = changed))
 
 @login_required       
 def password(request):
@@ -301,23 +443,25 @@ def changeemergency(request):
     elif (request.method == "POST"): # user submitted the form
         ec = forms.VisitorEmergencyContactForm(request.POST)
         if ec.is_valid():
-            # attempt to remove the current contact if present
-            visitor = models.Visitor.objects.get(user = request.user)
-            if (visitor.emergencycontact != None):
-                visitor.emergencycontact.delete()
-                
+            visitor = request.visitor
+            oldEc = visitor.emergencycontact
+
             # create a new contact
             newEc = models.EmergencyContact.objects.create(
                 name = ec.cleaned_data["name"],
                 phone = ec.cleaned_data["phone"],
                 relationship = ec.cleaned_data["relationship"]
             )
-            newEc.save()
 
             # one-to-one relation with the new contact on the visitor
             visitor.emergencycontact = newEc
             visitor.save()
 
+            # remove the previous contact once nothing refers to it (deleting it while the visitor
+            # still refers to it would delete the visitor and their visits too)
+            if (oldEc != None):
+                oldEc.delete()
+
             messages.success(request, "Changed emergency contact!")
             return redirect(account)
         else:
@@ -343,8 +487,8 @@ def transitionpage(request):
             "sites": SITES
         })    
 
-@login_required
-def newvisit(request, site):
+@asyncLoginRequired
+async def newvisit(request, site):
     """
     In this function, the specific site form is loaded depending on the GET
     argument provided. If the GET argument is invalid, an error message is generated
@@ -368,10 +512,14 @@ def newvisit(request, site):
 
     if (request.method == "POST"): # user submitted the form
         if visit.is_valid():
-            # VISIT MODELS NOT DONE YET
-            registerNewVisit(site, visit.cleaned_data, [models.Visitor.objects.get(user = request.user)])
-            messages.success(request, "Added new visit! Site manager will be notified.")
-            return redirect(account)
+            try:
+                visitor = await loadVisitor(request)
+                # the booking checks and the visits are saved in one transaction, which needs a thread
+                await sync_to_async(registerNewVisit)(site, visit.cleaned_data, [visitor])
+                messages.success(request, "Added new visit! Site manager will be notified.")
+                return redirect(account)
+            except bookingchecks.BookingConflict as bc:
+                messages.error(request, str(bc))
         else:
             messages.error(request, "Form is not valid!")
 
@@ -382,14 +530,28 @@ def newvisit(request, site):
         }
     return render(request, "registervisit.html", context)
 
-def site_emergency_contacts(request):
-    if (request.user.is_staff):
+@cached_page("sitecontacts")
+async def site_emergency_contacts(request):
+    if ((await loadUser(request)).is_staff):
         # SITE MANAGER REDIRECT TO ADMIN PAGE
         return redirect(reverse_lazy("admin:index"))
-    site_contacts = models.SiteEmergencyContact.objects.all()
+    site_contacts = [i async for i in models.SiteEmergencyContact.objects.all()]
     context = {'contacts': site_contacts, "logged_in" : request.user.is_authenticated}
     return render(request, "site_emergency_contact.html", context)
 # ------------------------------------------------------------
-# ============================================================
-
 
+# Site managers
+# ------------------------------------------------------------
+@login_required
+def site_occupancy(request, site):
+    """
+    Everyone currently on a site with their emergency contacts, as JSON, for emergency wardens
+    and wall displays that poll it. Requires the same permission as viewing the site's visits.
+    """
+    if (site not in SITES):
+        raise Http404("{} is not a site".format(site))
+    if (not request.user.has_perm("visitorsite.view_{sitename}visit".format(sitename = site))):
+        raise PermissionDenied
+    return JsonResponse(occupancy.current_occupants(site))
+# ------------------------------------------------------------
+# ============================================================